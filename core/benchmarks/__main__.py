@@ -0,0 +1,69 @@
+# benchmarks/__main__.py
+"""
+Controller benchmarks against a local SSH/Docker stand-in.
+
+    cd core
+    python -m benchmarks --levels 1,4,16 --requests 32 --latency docker-compose=0.5 --json bench.json
+    python -m benchmarks --baseline bench.json --tolerance 0.25   # exits 1 on a regression (for CI)
+"""
+import argparse
+import json
+import sys
+
+from .harness import SCENARIOS, compare, format_table, load_baseline, run
+from .standin import TOOLS
+
+
+def _tool_values(pairs, cast):
+    values = {}
+    for pair in pairs or []:
+        tool, sep, value = pair.partition('=')
+        if not sep or tool not in TOOLS:
+            raise argparse.ArgumentTypeError(f"expected TOOL=VALUE with TOOL one of {', '.join(TOOLS)}, got '{pair}'")
+        values[tool] = cast(value)
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--levels', default='1,2,4,8,16', help="concurrency ramp, comma separated")
+    parser.add_argument('--requests', type=int, default=32, help="requests per scenario and level")
+    parser.add_argument('--hosts', type=int, default=8, help="fake VPSes (127.0.0.1 .. 127.0.0.N)")
+    parser.add_argument('--containers', type=int, default=5, help="containers each fake host reports")
+    parser.add_argument('--latency', action='append', metavar='TOOL=SECONDS', help="delay a faked tool")
+    parser.add_argument('--output-bytes', action='append', metavar='TOOL=BYTES', help="output a faked tool prints")
+    parser.add_argument('--json', metavar='PATH', help="write the results here")
+    parser.add_argument('--baseline', metavar='PATH', help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed rps drop / p95 growth against the baseline (default 0.25)")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    try:
+        latency = _tool_values(args.latency, float)
+        output = _tool_values(args.output_bytes, int)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    levels = [int(level) for level in args.levels.split(',') if level]
+
+    report = run(scenarios, levels, args.requests, args.hosts, latency, output, args.containers)
+    print()
+    print(format_table(report['results']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        regressions = compare(report['results'], load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+# benchmarks/harness.py
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .standin import StandIn
+
+SCENARIOS = ('connect', 'install', 'deploy', 'containers')
+JOB_POLL_SECONDS = 0.05
+
+
+def setup_django(root, port=None, sqlite_options=None):
+    """
+    Configure the controller against the stand-in: SSH_PORT points at it and a
+    fresh sqlite database under `root` holds the benchmark's VPS and job rows.
+    `sqlite_options` replaces the database OPTIONS from settings.
+    Must run before anything imports django_deploy.
+    """
+    if port is not None:
+        os.environ['SSH_PORT'] = str(port)
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    os.environ['JOB_LOG_DIR'] = os.path.join(root, 'job_logs')
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = os.path.join(root, 'benchmark.sqlite3')
+    if sqlite_options is not None:
+        settings.DATABASES['default']['OPTIONS'] = sqlite_options
+    django.setup()
+
+    from django.apps import apps
+    from django.core.management import call_command
+    from django.db import connection
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    # Apps without committed migrations still need their tables
+    existing = set(connection.introspection.table_names())
+    with connection.schema_editor() as editor:
+        for model in apps.get_models():
+            if model._meta.managed and model._meta.db_table not in existing:
+                editor.create_model(model)
+                existing.add(model._meta.db_table)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def rss_mb():
+    """Current resident set size of the controller process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+class Driver:
+    """Calls the controller's views in-process, one Django test client per request."""
+
+    def __init__(self, standin):
+        self.standin = standin
+        self.pem = standin.client_pem()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _client(self):
+        from rest_framework.test import APIClient
+        return APIClient()
+
+    def next_ip(self):
+        with self._lock:
+            self._counter += 1
+            return self.standin.ips[self._counter % len(self.standin.ips)]
+
+    def connect(self, ip):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        return self._client().post('/api/django/connect-vps/', {
+            'ip': ip, 'name': f"bench-{ip}", 'pem_file': SimpleUploadedFile('bench.pem', self.pem),
+        }).json()
+
+    def install(self, ip):
+        return self._client().post('/api/django/install-dependencies/', {'ip': ip}, format='json').json()
+
+    def deploy(self, ip):
+        from django_deploy.models import DeploymentJob
+        body = self._client().post('/api/django/deploy-project/', {
+            'ip': ip, 'repo_url': f"https://example.invalid/bench/{ip.replace('.', '-')}.git",
+            'django_root': 'app', 'wsgi_path': 'app/wsgi.py', 'force': 'true',
+        }).json()
+        if body.get('status') != 'queued':
+            return body
+        # The endpoint only queues; the deploy is done when its job is
+        while True:
+            job = DeploymentJob.objects.get(pk=body['job_id'])
+            if job.status in ('succeeded', 'failed'):
+                return job.result or {'status': 'error', 'message': job.message}
+            time.sleep(JOB_POLL_SECONDS)
+
+    def containers(self, ip):
+        # refresh=true so every request goes over SSH rather than the inventory cache
+        return self._client().get(f'/api/django/docker-containers/?ip={ip}&refresh=true').json()
+
+    def call(self, scenario):
+        from django.db import close_old_connections
+        ip = self.next_ip()
+        started = time.perf_counter()
+        try:
+            body = getattr(self, scenario)(ip)
+            ok = body.get('status') == 'success'
+            error = None if ok else body.get('message')
+        except Exception as e:
+            ok, error = False, str(e)
+        finally:
+            close_old_connections()
+        return time.perf_counter() - started, ok, error
+
+
+def run_level(driver, scenario, concurrency, requests):
+    """`requests` calls of `scenario` with `concurrency` in flight."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"bench-{scenario}") as pool:
+        results = list(pool.map(lambda _: driver.call(scenario), range(requests)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(r[0] * 1000 for r in results)
+    errors = [r[2] for r in results if not r[1]]
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(elapsed, 3),
+        'rps': round(requests / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'max_ms': round(latencies[-1], 1),
+        'rss_mb': round(rss_mb() or 0, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Levels whose rps dropped or p95 grew by more than `tolerance` against the baseline run."""
+    previous = {(r['scenario'], r['concurrency']): r for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        base = previous.get((r['scenario'], r['concurrency']))
+        if not base:
+            continue
+        if base['rps'] and r['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}@{r['concurrency']}: rps {base['rps']} -> {r['rps']}")
+        if base['p95_ms'] and r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}@{r['concurrency']}: p95 {base['p95_ms']}ms -> {r['p95_ms']}ms")
+        if r['errors'] > base['errors']:
+            regressions.append(f"{r['scenario']}@{r['concurrency']}: {r['errors']} errors (was {base['errors']})")
+    return regressions
+
+
+def format_table(results):
+    columns = ('scenario', 'concurrency', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+               'rss_mb', 'peak_rss_mb')
+    rows = [columns] + [tuple(str(r[c]) for c in columns) for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
+
+
+def run(scenarios, levels, requests, hosts, latency=None, output=None, containers=5, log=print):
+    """Start the stand-in, point the controller at it and ramp each scenario through `levels`."""
+    with tempfile.TemporaryDirectory(prefix='devdeploy-bench-') as root:
+        standin = StandIn(root, hosts=hosts, latency=latency, output=output, containers=containers)
+        port = standin.start()
+        try:
+            setup_django(root, port)
+            driver = Driver(standin)
+            # Every other scenario needs connected hosts
+            for ip in standin.ips:
+                body = driver.connect(ip)
+                if body.get('status') != 'success':
+                    raise Exception(f"Could not connect to the stand-in at {ip}: {body.get('message')}")
+            results = []
+            for scenario in scenarios:
+                for concurrency in levels:
+                    result = run_level(driver, scenario, concurrency, max(requests, concurrency))
+                    results.append(result)
+                    log(f"{scenario:>10} x{concurrency:<4} {result['rps']:>8} req/s  p95 {result['p95_ms']}ms"
+                        f"  errors {result['errors']}")
+            return {
+                'hosts': hosts,
+                'latency': latency or {},
+                'output': output or {},
+                'results': results,
+            }
+        finally:
+            if 'django_deploy.ssh_pool' in sys.modules:
+                sys.modules['django_deploy.ssh_pool'].ssh_pool.close_all()
+            standin.stop()
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
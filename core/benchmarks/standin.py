@@ -0,0 +1,350 @@
+# benchmarks/standin.py
+import io
+import os
+import shutil
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+# Tools the deploy pipelines call on a VPS, faked by shell scripts on the stand-in's PATH
+TOOLS = ('git', 'docker', 'docker-compose', 'nginx', 'systemctl', 'apt', 'apt-get', 'dpkg-query', 'sudo')
+
+# Absolute paths the pipelines use, moved under a per-host directory
+HOST_PATHS = ('/home/ubuntu', '/etc/nginx', '/var/lib/apt')
+
+COMMIT_SHA = 'b' * 40
+
+_PRELUDE = r'''#!/bin/bash
+# Generated by benchmarks/standin.py
+_latency="${BENCH_LATENCY_%(var)s:-0}"
+_output="${BENCH_OUTPUT_%(var)s:-0}"
+_emit() {
+    if [ "$_output" -gt 0 ]; then head -c "$_output" /dev/zero | tr '\0' 'x' | fold -w 100; echo; fi
+    sleep "$_latency"
+}
+'''
+
+_SHIMS = {
+    'git': r'''
+dir=.
+if [ "$1" = "-C" ]; then dir=$2; shift 2; fi
+case "$1" in
+    init) mkdir -p "${@: -1}/.git" ;;
+    remote)
+        case "$2" in
+            get-url) cat "$dir/.git/origin-url" 2>/dev/null || exit 2 ;;
+            add) echo "$4" > "$dir/.git/origin-url" ;;
+            *) _emit ;;
+        esac ;;
+    clone)
+        target="${@: -1}"
+        mkdir -p "$target/.git" && echo "${@: -2:1}" > "$target/.git/origin-url"
+        cp -r "$BENCH_TEMPLATE/." "$target/"
+        _emit ;;
+    fetch) _emit >&2 ;;
+    reset) cp -r "$BENCH_TEMPLATE/." "$dir/" ;;
+    rev-parse) echo "$BENCH_COMMIT" ;;
+esac
+''',
+    'docker': r'''
+_rows() {
+    for i in $(seq 1 "${BENCH_CONTAINERS:-5}"); do printf "$1\n" "$i" "$i"; done
+}
+case "$1" in
+    ps) _rows '{"ID":"%012d","Names":"bench_web_%d","Image":"bench","State":"running","Status":"Up 1 hour","Ports":"","CreatedAt":"2024-01-01 00:00:00","Labels":"com.docker.compose.project=bench,com.docker.compose.service=web"}'; sleep "$_latency" ;;
+    stats) _rows '{"ID":"%012d","Name":"bench_web_%d","CPUPerc":"1.50%%","MemUsage":"64MiB / 1.944GiB","MemPerc":"3.22%%"}'; sleep "$_latency" ;;
+    build|pull) _emit ;;
+    image) exit 1 ;;  # no base images yet, so bootstrap prefetches them
+    inspect) echo true ;;
+    *) sleep "$_latency" ;;
+esac
+''',
+    'docker-compose': r'''
+project=default
+if [ "$1" = "-p" ]; then project=$2; shift 2; fi
+case "$1" in
+    build) _emit ;;
+    up) _emit; touch ".bench-running-$project" ;;
+    down) rm -f ".bench-running-$project"; sleep "$_latency" ;;
+    ps) [ -f ".bench-running-$project" ] && echo 0123456789ab ;;
+    *) sleep "$_latency" ;;
+esac
+''',
+    'nginx': 'sleep "$_latency"\n',
+    'systemctl': 'sleep "$_latency"\n',
+    'apt': '_emit\n',
+    'apt-get': '_emit\n',
+    # A fresh host: nothing installed, so install-dependencies runs every step
+    'dpkg-query': 'exit 1\n',
+    # Everything already runs as the benchmark user; keep the VAR=value prefixes
+    'sudo': r'''
+while [[ "$1" == *=* ]]; do export "$1"; shift; done
+exec "$@"
+''',
+}
+
+# A project that deploy_project can be pointed at with django_root=app, wsgi_path=app/wsgi.py
+_TEMPLATE = {
+    'app/requirements.txt': 'django\ngunicorn\n',
+    'app/manage.py': '',
+    'app/app/__init__.py': '',
+    'app/app/wsgi.py': 'application = None\n',
+}
+
+
+def _env_name(tool):
+    return tool.upper().replace('-', '_')
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _SFTP(SFTPServerInterface):
+    """Plain file access with the host's paths moved under its directory."""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = server
+
+    def _path(self, path):
+        return self.host.local_path(path)
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(self._path(path)):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(self._path(path), name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.replace(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+
+class _Host(paramiko.ServerInterface):
+    """One SSH connection to the fake VPS at `ip`."""
+
+    def __init__(self, standin, ip):
+        self.standin = standin
+        self.root = os.path.join(standin.root, 'hosts', ip)
+        self.home = self.root + '/home/ubuntu'
+        for path in HOST_PATHS:
+            os.makedirs(self.root + path, exist_ok=True)
+        os.makedirs(self.root + '/etc/nginx/sites-available', exist_ok=True)
+        os.makedirs(self.root + '/etc/nginx/sites-enabled', exist_ok=True)
+
+    def local_path(self, path):
+        if not path.startswith('/'):
+            return os.path.join(self.home, path)
+        return self.root + path if path.startswith(HOST_PATHS) else path
+
+    def rewrite(self, text):
+        for path in HOST_PATHS:
+            text = text.replace(path, self.root + path)
+        return text
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if key == self.standin.client_key else paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        # run_script sends its batch script on stdin to `bash -s`; rewrite it whole
+        script = None
+        if command.strip() == 'bash -s':
+            chunks = []
+            for chunk in iter(lambda: channel.recv(65536), b''):
+                chunks.append(chunk)
+            script = self.rewrite(b''.join(chunks).decode()).encode()
+        proc = subprocess.Popen(
+            ['bash', '-c', self.rewrite(command)], cwd=self.home, env=self.standin.environ(self.home),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+        def feed():
+            try:
+                if script is not None:
+                    proc.stdin.write(script)
+                else:
+                    for chunk in iter(lambda: channel.recv(65536), b''):
+                        proc.stdin.write(chunk)
+                proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+        def pump(stream, send):
+            for chunk in iter(lambda: stream.read1(65536), b''):
+                send(chunk)
+
+        threading.Thread(target=feed, daemon=True).start()
+        stderr = threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr))
+        stderr.start()
+        pump(proc.stdout, channel.sendall)
+        stderr.join()
+        channel.send_exit_status(proc.wait())
+        channel.close()
+
+
+class StandIn:
+    """
+    Local SSH server that plays a fleet of VPSes for the benchmarks.
+
+    Every loopback address from 127.0.0.1 to 127.0.0.<hosts> is its own host
+    with its own /home/ubuntu and /etc/nginx under `root`, all on one port.
+    Commands run with a real bash, but git, docker, docker-compose, nginx,
+    systemctl and apt are shims that sleep for `latency[tool]` seconds and
+    print `output[tool]` bytes.
+    """
+
+    def __init__(self, root, hosts=1, latency=None, output=None, containers=5):
+        self.root = root
+        self.hosts = hosts
+        self.latency = latency or {}
+        self.output = output or {}
+        self.containers = containers
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+        self.port = None
+        self._sockets = []
+        self._transports = []
+        self._lock = threading.Lock()
+
+    @property
+    def ips(self):
+        return [f"127.0.0.{i}" for i in range(1, self.hosts + 1)]
+
+    def client_pem(self):
+        buffer = io.StringIO()
+        self.client_key.write_private_key(buffer)
+        return buffer.getvalue().encode()
+
+    def environ(self, home):
+        env = dict(os.environ, HOME=home, PATH=f"{self.root}/bin:{os.environ.get('PATH', '')}",
+                   BENCH_TEMPLATE=f"{self.root}/template", BENCH_COMMIT=COMMIT_SHA,
+                   BENCH_CONTAINERS=str(self.containers))
+        for tool, seconds in self.latency.items():
+            env[f"BENCH_LATENCY_{_env_name(tool)}"] = str(seconds)
+        for tool, size in self.output.items():
+            env[f"BENCH_OUTPUT_{_env_name(tool)}"] = str(int(size))
+        return env
+
+    def _install(self):
+        shutil.rmtree(f"{self.root}/bin", ignore_errors=True)
+        os.makedirs(f"{self.root}/bin")
+        for tool in TOOLS:
+            path = f"{self.root}/bin/{tool}"
+            with open(path, 'w') as f:
+                f.write(_PRELUDE % {'var': _env_name(tool)} + _SHIMS[tool])
+            os.chmod(path, 0o755)
+        for name, content in _TEMPLATE.items():
+            path = f"{self.root}/template/{name}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def start(self):
+        """Listen on every host address (loopback only) and return the shared port."""
+        self._install()
+        for ip in self.ips:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, self.port or 0))
+            sock.listen(128)
+            self.port = sock.getsockname()[1]
+            self._sockets.append(sock)
+            threading.Thread(target=self._accept, args=(sock, ip), name=f"standin-{ip}", daemon=True).start()
+        return self.port
+
+    def _accept(self, sock, ip):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return  # stopped
+            # Handshakes run off the accept loop so concurrent connects don't queue behind each other
+            threading.Thread(target=self._serve, args=(conn, ip), daemon=True).start()
+
+    def _serve(self, conn, ip):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, _SFTP)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_Host(self, ip))
+        except paramiko.SSHException:
+            transport.close()
+
+    def stop(self):
+        for sock in self._sockets:
+            sock.close()
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
@@ -0,0 +1,149 @@
+# benchmarks/state_writes.py
+"""
+Deploy state write throughput under concurrent deploys, direct vs through the single state writer.
+
+    cd core
+    python -m benchmarks.state_writes --deploys 50 --steps 10
+    python -m benchmarks.state_writes --sqlite-tuning off   # plain sqlite settings (rollback journal)
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .harness import percentile, setup_django
+
+MODES = ('direct', 'batched')
+PHASES_PER_DEPLOY = 8
+
+
+def simulated_deploy(writer, n, steps, work):
+    """
+    The state writes one deploy makes: create its job, mark it running, report
+    `steps` progress steps `work` seconds apart, record the Deployment and its
+    phases and finish the job. Returns ([write latencies], [errors]).
+    """
+    from django.db import close_old_connections
+    from django.utils.timezone import now
+    from django_deploy.models import Deployment, DeploymentJob, DeploymentPhase
+
+    latencies, errors = [], []
+
+    def timed(func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    def record(ip):
+        deployment = Deployment.objects.create(ip_address=ip, repo_url='https://example.invalid/bench.git',
+                                               django_root='app', status='deployed')
+        DeploymentPhase.objects.bulk_create([
+            DeploymentPhase(deployment=deployment, name=f"phase{i}", started_at=now(), duration_ms=i)
+            for i in range(PHASES_PER_DEPLOY)
+        ])
+        return deployment
+
+    ip = f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}"
+    try:
+        job = timed(writer.call, DeploymentJob.objects.create, kind='deploy', ip_address=ip)
+        if job is None:
+            return latencies, errors
+        timed(writer.update, DeploymentJob, job.pk, status='running', started_at=now())
+        history = []
+        for i in range(steps):
+            time.sleep(work)
+            history.append({'step': f"step{i}", 'at': now().isoformat()})
+            timed(writer.update, DeploymentJob, job.pk, step=f"step{i}", steps=list(history))
+        deployment = timed(writer.call, record, ip)
+        timed(writer.update, DeploymentJob, job.pk, status='succeeded',
+              deployment_id=deployment.pk if deployment else None, finished_at=now())
+        return latencies, errors
+    finally:
+        close_old_connections()
+
+
+def run_mode(mode, deploys, steps, work):
+    from django_deploy.models import DeploymentJob
+    from django_deploy.state import StateWriter
+
+    writer = StateWriter(batched=mode == 'batched')
+    before = DeploymentJob.objects.count()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=deploys, thread_name_prefix=f"bench-{mode}") as pool:
+        results = list(pool.map(lambda n: simulated_deploy(writer, n, steps, work), range(deploys)))
+    writer.flush()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(l * 1000 for r in results for l in r[0])
+    errors = [e for r in results for e in r[1]]
+    finished = DeploymentJob.objects.filter(status='succeeded').count() - before
+    stats = writer.stats()
+    return {
+        'mode': mode,
+        'deploys': deploys,
+        'writes': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'finished_jobs': finished,
+        'seconds': round(elapsed, 3),
+        'writes_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(latencies[-1], 2),
+        'batches': stats['batches'] if writer.batched else None,
+    }
+
+
+def format_table(results):
+    columns = ('mode', 'deploys', 'writes', 'errors', 'finished_jobs', 'seconds', 'writes_per_s',
+               'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'batches')
+    rows = [columns] + [tuple(str(r[c]) for c in columns) for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.state_writes',
+                                     description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--deploys', type=int, default=50, help="concurrent deploys")
+    parser.add_argument('--steps', type=int, default=10, help="progress steps each deploy reports")
+    parser.add_argument('--work-ms', type=float, default=20, help="time between two steps")
+    parser.add_argument('--modes', default=','.join(MODES), help=f"comma separated, from {', '.join(MODES)}")
+    parser.add_argument('--sqlite-tuning', choices=('on', 'off'), default='on',
+                        help="off: no WAL/IMMEDIATE/busy timeout settings, as sqlite3 comes")
+    parser.add_argument('--json', metavar='PATH', help="write the results here")
+    args = parser.parse_args(argv)
+
+    modes = [m for m in args.modes.split(',') if m]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory(prefix='devdeploy-bench-') as root:
+        setup_django(root, sqlite_options=None if args.sqlite_tuning == 'on' else {})
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            journal = cursor.fetchone()[0]
+        print(f"sqlite journal_mode={journal}")
+        results = [run_mode(mode, args.deploys, args.steps, args.work_ms / 1000) for mode in modes]
+
+    print(format_table(results))
+    for r in results:
+        if r['first_error']:
+            print(f"{r['mode']}: first error: {r['first_error']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'sqlite_tuning': args.sqlite_tuning, 'journal_mode': journal, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -82,12 +82,75 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. WAL lets status reads run while a deploy writes, IMMEDIATE
+# takes the write lock when a transaction starts (instead of failing to upgrade
+# a read lock halfway through) and timeout is how long a writer waits for it.
+# Set DB_ENGINE=postgresql (needs psycopg[pool]) for a pooled PostgreSQL instead.
+if os.getenv('DB_ENGINE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'devdeploy'),
+            'USER': os.getenv('DB_USER', 'devdeploy'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 20)),
+                    'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+                },
+            },
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': int(os.getenv('DB_BUSY_TIMEOUT', 20)),
+            },
+        }
+    }
+
+# Deploy state writes (django_deploy.state); batched through one writer thread by default on SQLite
+STATE_WRITER_BATCHED = {'1': True, 'true': True, '0': False, 'false': False}.get(os.getenv('STATE_WRITER_BATCHED', '').lower())
+STATE_WRITER_MAX_BATCH = int(os.getenv('STATE_WRITER_MAX_BATCH', 500))
+STATE_WRITER_RETRIES = int(os.getenv('STATE_WRITER_RETRIES', 3))
+
+# SSH session pool (django_deploy.ssh_pool)
+SSH_USERNAME = os.getenv('SSH_USERNAME', 'ubuntu')
+SSH_PORT = int(os.getenv('SSH_PORT', 22))
+SSH_CONNECT_TIMEOUT = int(os.getenv('SSH_CONNECT_TIMEOUT', 15))
+SSH_POOL_MAX_SESSIONS_PER_HOST = int(os.getenv('SSH_POOL_MAX_SESSIONS_PER_HOST', 4))
+SSH_POOL_IDLE_TIMEOUT = int(os.getenv('SSH_POOL_IDLE_TIMEOUT', 300))
+SSH_POOL_KEEPALIVE_INTERVAL = int(os.getenv('SSH_POOL_KEEPALIVE_INTERVAL', 30))
+
+# Background deployment workers (django_deploy.jobs)
+DEPLOY_WORKERS = int(os.getenv('DEPLOY_WORKERS', 4))
+DEPLOY_QUEUE_SIZE = int(os.getenv('DEPLOY_QUEUE_SIZE', 32))
+FLEET_CONCURRENCY = int(os.getenv('FLEET_CONCURRENCY', 10))
+FLEET_MAX_CONCURRENCY = int(os.getenv('FLEET_MAX_CONCURRENCY', 50))
+JOB_LOG_DIR = os.getenv('JOB_LOG_DIR', os.path.join(BASE_DIR, 'job_logs'))
+JOB_STREAM_MAX_SECONDS = int(os.getenv('JOB_STREAM_MAX_SECONDS', 300))  # an SSE connection is closed (and resumed by the browser) after this
+BOOTSTRAP_APT_INDEX_MAX_AGE = int(os.getenv('BOOTSTRAP_APT_INDEX_MAX_AGE', 6 * 3600))  # seconds before apt update runs again
+AWS_WARM_POOL_SIZE = int(os.getenv('AWS_WARM_POOL_SIZE', 0))  # booted + bootstrapped instances kept ready
+AWS_PEM_PATH = os.getenv('AWS_PEM_PATH')  # private key of AWS_KEY_PAIR_NAME, for SSH into launched instances
+AWS_SSH_READY_TIMEOUT = int(os.getenv('AWS_SSH_READY_TIMEOUT', 300))
+AWS_WARM_POOL_LEASE_SECONDS = int(os.getenv('AWS_WARM_POOL_LEASE_SECONDS', 120))  # heartbeat age after which a preparing instance counts as abandoned
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 60))  # seconds between samples
+METRICS_RETENTION_RAW_HOURS = int(os.getenv('METRICS_RETENTION_RAW_HOURS', 24))
+METRICS_RETENTION_1M_DAYS = int(os.getenv('METRICS_RETENTION_1M_DAYS', 7))
+METRICS_RETENTION_1H_DAYS = int(os.getenv('METRICS_RETENTION_1H_DAYS', 90))
+CONTAINER_INVENTORY_TTL = int(os.getenv('CONTAINER_INVENTORY_TTL', 15))
+CONTAINER_INVENTORY_MAX_STALE = int(os.getenv('CONTAINER_INVENTORY_MAX_STALE', 300))
+REACT_RELEASES_KEEP = int(os.getenv('REACT_RELEASES_KEEP', 5))
+REACT_RELEASES_MAX_MB = int(os.getenv('REACT_RELEASES_MAX_MB', 500))
+PHASE_STATS_MAX_DAYS = int(os.getenv('PHASE_STATS_MAX_DAYS', 90))  # longest window deployment phase stats are computed over
 
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",
@@ -1,30 +1,61 @@
+import functools
 import boto3
 import os
 import dotenv
 
 dotenv.load_dotenv()
 
-def create_instance():
-    ec2 = boto3.resource(
+
+@functools.lru_cache(maxsize=None)
+def ec2_client():
+    """
+    One EC2 client for the whole process (boto3 clients are thread safe).
+    AWS_ENDPOINT_URL points it at a local stand-in such as moto_server.
+    """
+    return boto3.client(
         'ec2',
         region_name=os.getenv('AWS_REGION'),
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        endpoint_url=os.getenv('AWS_ENDPOINT_URL') or None,
     )
 
-    instance = ec2.create_instances(
+
+def launch_instances(count=1, client=None):
+    """Start `count` instances and return their ids without waiting for them to boot."""
+    client = client or ec2_client()
+    response = client.run_instances(
         ImageId=os.getenv('AWS_AMI_ID'),
-        InstanceType='t2.micro',
-        MinCount=1,
-        MaxCount=1,
+        InstanceType=os.getenv('AWS_INSTANCE_TYPE', 't2.micro'),
+        MinCount=count,
+        MaxCount=count,
         KeyName=os.getenv('AWS_KEY_PAIR_NAME'),
-        SecurityGroups=['launch-wizard-10'],  # <- Ensure this group allows ports 22 & 80
+        SecurityGroups=[os.getenv('AWS_SECURITY_GROUP', 'launch-wizard-10')],  # <- Ensure this group allows ports 22 & 80
         TagSpecifications=[{
             'ResourceType': 'instance',
             'Tags': [{'Key': 'Name', 'Value': 'AutoDeploy'}]
         }]
-    )[0]
+    )
+    return [instance['InstanceId'] for instance in response['Instances']]
+
 
-    instance.wait_until_running()
-    instance.reload()
-    return instance.instance_id, instance.public_ip_address
+def wait_until_running(instance_ids, client=None):
+    """Block until the instances run; returns {instance_id: public ip}."""
+    client = client or ec2_client()
+    client.get_waiter('instance_running').wait(InstanceIds=list(instance_ids))
+    response = client.describe_instances(InstanceIds=list(instance_ids))
+    return {
+        instance['InstanceId']: instance.get('PublicIpAddress')
+        for reservation in response['Reservations']
+        for instance in reservation['Instances']
+    }
+
+
+def terminate_instances(instance_ids, client=None):
+    if instance_ids:
+        (client or ec2_client()).terminate_instances(InstanceIds=list(instance_ids))
+
+
+def create_instance():
+    instance_id = launch_instances(1)[0]
+    return instance_id, wait_until_running([instance_id])[instance_id]
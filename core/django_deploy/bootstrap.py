@@ -0,0 +1,141 @@
+# deployer/bootstrap.py
+import shlex
+
+from django.conf import settings
+
+from .remote import run_script
+from .utils import PYTHON_BUILD_IMAGE, PYTHON_RUNTIME_IMAGE
+
+PACKAGES = ['git', 'curl', 'python3', 'python3-pip', 'python3-venv', 'docker.io', 'nginx']
+COMPOSE_PACKAGES = ['docker-compose', 'docker-compose-plugin']  # either one will do
+PREFETCH_LOG = "/tmp/devdeploy-prefetch.log"
+
+
+def base_images():
+    """Images the generated Dockerfiles start FROM, worth having on a host before its first build."""
+    from react_deploy.utils import NODE_BUILD_IMAGE, NODE_RUNTIME_IMAGE
+    return [PYTHON_BUILD_IMAGE, PYTHON_RUNTIME_IMAGE, NODE_BUILD_IMAGE, NODE_RUNTIME_IMAGE]
+
+
+def _probe_commands(images):
+    packages = ' '.join(PACKAGES + COMPOSE_PACKAGES)
+    quoted = ' '.join(shlex.quote(image) for image in images)
+    return [
+        f"dpkg-query -W -f='${{Package}}\\t${{db:Status-Abbrev}}\\t${{Version}}\\n' {packages} 2>/dev/null",
+        "date +%s",
+        "stat -c %Y /var/lib/apt/lists/*_Packages 2>/dev/null | sort -n | tail -n 1",
+        "systemctl is-enabled docker 2>/dev/null",
+        "systemctl is-active docker 2>/dev/null",
+        f"for image in {quoted}; do "
+        f"sudo docker image inspect \"$image\" >/dev/null 2>&1 && echo \"$image\"; done; true",
+    ]
+
+
+def probe_host_state(ssh, images=None):
+    """
+    Installed package versions, apt index age, docker service state and which
+    base images are present, in one round trip.
+    """
+    images = base_images() if images is None else images
+    details, _ = run_script(ssh, _probe_commands(images))
+    out = [d['stdout'] for d in details]
+    versions = {}
+    for line in out[0].splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[1].startswith('ii'):
+            versions[fields[0]] = fields[2]
+    now_ts, lists_ts = out[1].strip(), out[2].strip()
+    return {
+        'versions': versions,
+        'apt_index_age': int(now_ts) - int(lists_ts) if now_ts.isdigit() and lists_ts.isdigit() else None,
+        'docker_enabled': out[3].strip() == 'enabled',
+        'docker_active': out[4].strip() == 'active',
+        'images': [image for image in out[5].split() if image in images],
+    }
+
+
+def prefetch_script(images):
+    """
+    Pull each image in turn, logging whether it worked. A failed pull (a typo,
+    a registry hiccup) doesn't stop the images after it.
+    """
+    return '; '.join(
+        f"if docker pull {shlex.quote(image)}; then echo \"prefetch: pulled {image}\"; "
+        f"else echo \"prefetch: failed to pull {image} (exit $?)\"; fi"
+        for image in images
+    )
+
+
+def plan_bootstrap(state, images, force=False, apt_max_age=None):
+    """
+    Steps needed to bring a host in `state` up to date: ([(step, [commands])], [{'step', 'reason'}]).
+    With force every install step runs, as on a fresh host.
+    """
+    apt_max_age = getattr(settings, 'BOOTSTRAP_APT_INDEX_MAX_AGE', 6 * 3600) if apt_max_age is None else apt_max_age
+    versions = {} if force else state['versions']
+    missing = [p for p in PACKAGES if p not in versions]
+    needs_compose = not any(p in versions for p in COMPOSE_PACKAGES)
+    steps, skipped = [], []
+
+    def skip(step, reason):
+        skipped.append({'step': step, 'reason': reason})
+
+    age = state['apt_index_age']
+    if not (missing or needs_compose):
+        skip('apt_update', 'all packages already installed')
+    elif not force and age is not None and age < apt_max_age:
+        skip('apt_update', f"package index is {age // 60} min old")
+    else:
+        steps.append(('apt_update', ["sudo apt update"]))
+
+    if missing:
+        steps.append(('install_packages', [f"sudo apt install -y {' '.join(missing)}"]))
+    else:
+        skip('install_packages', 'already installed: ' + ', '.join(f"{p} {versions[p]}" for p in PACKAGES))
+
+    if needs_compose:
+        # Modern Ubuntu only ships the plugin
+        steps.append(('install_compose', [
+            "sudo apt install -y docker-compose || sudo apt install -y docker-compose-plugin || true"
+        ]))
+    else:
+        installed = next(p for p in COMPOSE_PACKAGES if p in versions)
+        skip('install_compose', f"{installed} {versions[installed]} already installed")
+
+    if state['docker_enabled'] and not force:
+        skip('enable_docker', 'docker service already enabled')
+    else:
+        steps.append(('enable_docker', ["sudo systemctl enable docker"]))
+    if state['docker_active'] and not force:
+        skip('start_docker', 'docker service already running')
+    else:
+        steps.append(('start_docker', ["sudo systemctl start docker"]))
+
+    to_pull = [image for image in images if image not in state['images']]
+    if to_pull:
+        # Detached so the bootstrap returns now; the first build finds the images (or a pull in progress)
+        steps.append(('prefetch_images', [
+            f"setsid nohup sudo sh -c {shlex.quote(prefetch_script(to_pull))} > {PREFETCH_LOG} 2>&1 < /dev/null &"
+        ]))
+    else:
+        skip('prefetch_images', 'base images already present: ' + ', '.join(images))
+    return steps, skipped
+
+
+def bootstrap_host(ssh, sink=None, force=False, images=None):
+    """
+    Install git, python, docker, docker-compose and nginx where they are missing
+    and start pulling the base images in the background.
+    Returns (details, failed, skipped).
+    """
+    images = base_images() if images is None else images
+    state = probe_host_state(ssh, images)
+    steps, skipped = plan_bootstrap(state, images, force)
+    if sink is not None:
+        for s in skipped:
+            sink.line(f"==> skip {s['step']}: {s['reason']}")
+    commands = [command for _, step_commands in steps for command in step_commands]
+    if not commands:
+        return [], [], skipped
+    details, failed = run_script(ssh, commands, sink)
+    return details, failed, skipped
@@ -0,0 +1,27 @@
+# deployer/expressions.py
+from django.db.models import FloatField, Func
+
+
+class SecondsBetween(Func):
+    """
+    SecondsBetween(start, end): `end - start` in seconds as a float, computed by the database.
+    Django's DurationField arithmetic returns different types per backend; this doesn't.
+    """
+    arity = 2
+    output_field = FloatField()
+
+    def _render(self, compiler, template):
+        (start_sql, start_params), (end_sql, end_params) = (
+            compiler.compile(expression) for expression in self.get_source_expressions()
+        )
+        # Every template uses {end} before {start}, so the params go in that order
+        return template.format(end=end_sql, start=start_sql), (*end_params, *start_params)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return self._render(compiler, "CAST(EXTRACT(EPOCH FROM ({end} - {start})) AS DOUBLE PRECISION)")
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self._render(compiler, "((julianday({end}) - julianday({start})) * 86400.0)")
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self._render(compiler, "(-TIMESTAMPDIFF(MICROSECOND, {end}, {start}) / 1000000.0)")
@@ -0,0 +1,104 @@
+# deployer/fleet.py
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from .models import VPS
+from .pipelines import deploy_django_project, install_host_dependencies
+from .streams import PrefixedLog
+
+OPERATIONS = ('install_dependencies', 'deploy', 'deploy_react')
+
+SELECTORS = {
+    'all': lambda: VPS.objects.all(),
+    'all_connected': lambda: VPS.objects.filter(connected=True),
+}
+
+
+def select_fleet(vps_ids=None, selector=None):
+    """Resolve explicit VPS ids or a named selector to a list of ip addresses."""
+    if vps_ids:
+        queryset = VPS.objects.filter(pk__in=vps_ids)
+    elif selector in SELECTORS:
+        queryset = SELECTORS[selector]()
+    else:
+        raise Exception(f"Provide vps_ids or a selector ({', '.join(SELECTORS)})")
+    return list(queryset.order_by('pk').values_list('ip_address', flat=True))
+
+
+class _HostProgress:
+    """Per-host stand-in for JobProgress: steps go to the shared log, not the job row."""
+
+    def __init__(self, log, ip):
+        self.log = PrefixedLog(log, f"[{ip}] ") if log is not None else None
+        self.steps = []
+
+    def step(self, name):
+        self.steps.append({'step': name, 'at': now().isoformat()})
+        self.note(name)
+
+    def note(self, text):
+        if self.log is not None:
+            self.log.line(f"==> {text}")
+
+
+def _run_on_host(operation, ip, params, log):
+    progress = _HostProgress(log, ip)
+    started = time.monotonic()
+    try:
+        if operation == 'install_dependencies':
+            result = install_host_dependencies(progress, ip)
+        elif operation == 'deploy':
+            result = deploy_django_project(
+                progress, ip, params['repo_url'], params['django_root'], params['wsgi_path'],
+                ip, params.get('env_content'), params.get('options')
+            )
+        elif operation == 'deploy_react':
+            from react_deploy.pipelines import deploy_react_project
+            result = deploy_react_project(
+                progress, ip, params['repo_url'], params['app_root'], ip, params.get('env_content'),
+                params.get('options')
+            )
+        else:
+            raise Exception(f"Unknown fleet operation '{operation}'")
+    except Exception as e:
+        result = {'status': 'error', 'message': str(e)}
+    finally:
+        if progress.log is not None:
+            progress.log.flush()
+        close_old_connections()
+    result.pop('deployment_id', None)
+    result['steps'] = progress.steps
+    result['duration_seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def run_fleet_operation(progress, operation, ips, params, concurrency=None):
+    """
+    Run `operation` on every host with at most `concurrency` hosts in flight.
+    Results are published per host as each one finishes, so a slow host never
+    holds back the results of fast ones.
+    """
+    concurrency = max(1, min(concurrency or settings.FLEET_CONCURRENCY, settings.FLEET_MAX_CONCURRENCY, len(ips) or 1))
+    progress.step('fleet')
+    hosts = {ip: {'status': 'pending'} for ip in ips}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fleet') as pool:
+        futures = {pool.submit(_run_on_host, operation, ip, params, progress.log): ip for ip in ips}
+        for future in as_completed(futures):
+            hosts[futures[future]] = future.result()
+            progress.partial_result({'status': 'running', 'operation': operation, 'hosts': hosts})
+
+    succeeded = [ip for ip, result in hosts.items() if result.get('status') == 'success']
+    failed = [ip for ip in ips if ip not in succeeded]
+    return {
+        'status': 'error' if failed else 'success',
+        'message': f"{operation} succeeded on {len(succeeded)}/{len(ips)} hosts",
+        'operation': operation,
+        'concurrency': concurrency,
+        'succeeded': succeeded,
+        'failed': failed,
+        'hosts': hosts,
+    }
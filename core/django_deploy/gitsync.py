@@ -0,0 +1,86 @@
+# deployer/gitsync.py
+import hashlib
+import re
+import shlex
+
+from .remote import run_script
+
+SYNC_MODES = ('incremental', 'fresh')
+MIRROR_ROOT = "$HOME/.devdeploy/mirrors"
+
+_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def mirror_path(repo_url):
+    return f"{MIRROR_ROOT}/{hashlib.sha1(repo_url.encode()).hexdigest()}.git"
+
+
+def git_sync_script(repo_url, project_name, ref=None, mode='incremental', use_mirror=False):
+    """
+    Shell script that brings ~/{project_name} to `ref` (branch, tag or commit;
+    default: the remote HEAD) and prints the checked out commit SHA last.
+
+    incremental: shallow fetch of just `ref` into the existing checkout (or a new
+    one) followed by a hard reset, so history is never re-downloaded.
+    With use_mirror, objects come from a per-host bare mirror of the remote that
+    every project cloned from the same URL shares.
+    fresh: the old behaviour, delete the folder and clone from scratch.
+    """
+    if mode not in SYNC_MODES:
+        raise Exception(f"Unknown sync mode '{mode}', expected one of: {', '.join(SYNC_MODES)}")
+    repo = shlex.quote(repo_url)
+    target = shlex.quote(ref or 'HEAD')
+    lines = ["set -e", "cd ~", f"dir={shlex.quote(project_name)}"]
+
+    if mode == 'fresh':
+        lines += [
+            'rm -rf "$dir"',
+            f'git clone {repo} "$dir"',
+        ]
+        if ref:
+            lines.append(f'git -C "$dir" checkout -q {target}')
+    else:
+        lines += [
+            # Reuse the checkout only if it tracks the same remote
+            f'if [ "$(git -C "$dir" remote get-url origin 2>/dev/null)" != {repo} ]; then',
+            '  rm -rf "$dir"',
+            '  git init -q "$dir"',
+            f'  git -C "$dir" remote add origin {repo}',
+            'fi',
+        ]
+        if use_mirror:
+            lines += [
+                f'mirror="{mirror_path(repo_url)}"',
+                'if [ -d "$mirror" ]; then',
+                '  git -C "$mirror" remote update --prune >/dev/null',
+                'else',
+                '  mkdir -p "$(dirname "$mirror")"',
+                f'  git clone -q --mirror {repo} "$mirror"',
+                'fi',
+                # Share the mirror's object store instead of copying objects
+                'echo "$mirror/objects" > "$dir/.git/objects/info/alternates"',
+                f'git -C "$dir" fetch -q --no-tags "$mirror" {target}',
+            ]
+        else:
+            lines.append(f'git -C "$dir" fetch -q --depth 1 --no-tags origin {target}')
+        # No `git clean`: untracked files (.env, generated files, an app's sqlite db
+        # or media mounted into the container) must survive a sync
+        lines.append('git -C "$dir" reset -q --hard FETCH_HEAD')
+    lines.append('git -C "$dir" rev-parse HEAD')
+    return '\n'.join(lines)
+
+
+def sync_repository(ssh, repo_url, project_name, ref=None, mode='incremental', use_mirror=False, sink=None):
+    """
+    Sync the project checkout on the host and return the deployed commit SHA.
+    Raises if the sync fails.
+    """
+    script = git_sync_script(repo_url, project_name, ref, mode, use_mirror)
+    details, failed = run_script(ssh, [script], sink, stop_on_error=True)
+    if failed:
+        raise Exception(f"Git sync of {repo_url} failed: {failed[0]['stderr'].strip()}")
+    lines = details[0]['stdout'].strip().splitlines()
+    commit_sha = lines[-1].strip() if lines else ''
+    if not _SHA_RE.match(commit_sha):
+        raise Exception(f"Git sync of {repo_url} did not report a commit SHA")
+    return commit_sha
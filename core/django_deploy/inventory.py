@@ -0,0 +1,173 @@
+# deployer/inventory.py
+import hashlib
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import VPS
+from .remote import FULL_OUTPUT_BYTES, run_script
+from .ssh_pool import ssh_pool
+
+DOCKER_PS = "sudo docker ps -a --format '{{json .}}'"
+
+
+def _labels(raw):
+    """`docker ps` prints labels as one "k=v,k=v" string."""
+    labels = {}
+    for item in (raw or '').split(','):
+        key, sep, value = item.partition('=')
+        if sep:
+            labels[key.strip()] = value
+    return labels
+
+
+@dataclass(frozen=True)
+class ContainerRecord:
+    id: str
+    names: str
+    image: str
+    state: str
+    status: str
+    ports: str
+    created_at: str
+    project: str
+    service: str
+
+    @classmethod
+    def from_docker(cls, data):
+        labels = _labels(data.get('Labels'))
+        return cls(
+            id=data.get('ID', ''),
+            names=data.get('Names', ''),
+            image=data.get('Image', ''),
+            state=data.get('State', ''),
+            status=data.get('Status', ''),
+            ports=data.get('Ports', ''),
+            created_at=data.get('CreatedAt', ''),
+            project=labels.get('com.docker.compose.project', ''),
+            service=labels.get('com.docker.compose.service', ''),
+        )
+
+    def as_dict(self):
+        """Docker's own key names, which the dashboard already renders."""
+        return {
+            'ID': self.id,
+            'Names': self.names,
+            'Image': self.image,
+            'State': self.state,
+            'Status': self.status,
+            'Ports': self.ports,
+            'CreatedAt': self.created_at,
+            'Project': self.project,
+            'Service': self.service,
+        }
+
+
+def parse_docker_ps(output):
+    """One ContainerRecord per `docker ps --format '{{json .}}'` line, skipping anything that isn't JSON."""
+    records = []
+    for line in output.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            records.append(ContainerRecord.from_docker(data))
+    return records
+
+
+class _Snapshot:
+    def __init__(self, records, fetched_at, fetched_wall):
+        self.records = records
+        self.fetched_at = fetched_at  # monotonic, for expiry
+        self.fetched_wall = fetched_wall  # epoch seconds, for clients
+        self.etag = hashlib.sha256(
+            json.dumps([asdict(r) for r in records], sort_keys=True).encode()
+        ).hexdigest()[:32]
+
+
+class ContainerInventory:
+    """
+    Per-VPS cache of `docker ps -a`.
+
+    A snapshot younger than `ttl` is served as is. Up to `max_stale` seconds it
+    is still served, but a background refresh is started (one per host at a
+    time). Older or missing snapshots are fetched before answering.
+    Deploys and container deletes call `invalidate`.
+    """
+
+    def __init__(self, ttl=15, max_stale=300):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._refreshing = set()
+        self._generation = {}  # bumped by invalidate, so a refresh started earlier can't store pre-deploy data
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            ttl=getattr(settings, 'CONTAINER_INVENTORY_TTL', 15),
+            max_stale=getattr(settings, 'CONTAINER_INVENTORY_MAX_STALE', 300),
+        )
+
+    def get(self, vps, refresh=False):
+        """Returns (snapshot, cached) for the VPS."""
+        ip = vps.ip_address
+        with self._lock:
+            snapshot = self._snapshots.get(ip)
+        age = time.monotonic() - snapshot.fetched_at if snapshot else None
+        if snapshot is None or refresh or age > self.max_stale:
+            return self.refresh(vps), False
+        if age > self.ttl:
+            self._refresh_in_background(ip)
+        return snapshot, True
+
+    def refresh(self, vps):
+        with self._lock:
+            generation = self._generation.get(vps.ip_address, 0)
+        with ssh_pool.session(vps) as ssh:
+            details, failed = run_script(ssh, [DOCKER_PS], tail_bytes=FULL_OUTPUT_BYTES)
+        if failed:
+            raise Exception(f"docker ps failed: {failed[0]['stderr'].strip()}")
+        if details[0]['stdout_truncated']:
+            # A partial list would be cached and paginated as if it were complete
+            raise Exception(f"docker ps output on {vps.ip_address} is larger than {FULL_OUTPUT_BYTES} bytes")
+        snapshot = _Snapshot(parse_docker_ps(details[0]['stdout']), time.monotonic(), time.time())
+        with self._lock:
+            if self._generation.get(vps.ip_address, 0) == generation:
+                self._snapshots[vps.ip_address] = snapshot
+        return snapshot
+
+    def invalidate(self, ip):
+        with self._lock:
+            self._snapshots.pop(ip, None)
+            self._generation[ip] = self._generation.get(ip, 0) + 1
+
+    def _refresh_in_background(self, ip):
+        with self._lock:
+            if ip in self._refreshing:
+                return
+            self._refreshing.add(ip)
+
+        def run():
+            try:
+                self.refresh(VPS.objects.get(ip_address=ip))
+            except Exception:
+                pass  # the stale snapshot stays until the next attempt
+            finally:
+                with self._lock:
+                    self._refreshing.discard(ip)
+                close_old_connections()
+
+        threading.Thread(target=run, name=f"inventory-refresh-{ip}", daemon=True).start()
+
+
+container_inventory = ContainerInventory.from_settings()
@@ -0,0 +1,129 @@
+# deployer/jobs.py
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from .models import DeploymentJob
+from .state import state_writer
+from .streams import JobLog
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobProgress:
+    """
+    Handle passed to a pipeline so it can report which step it is on.
+    `log` receives remote command output as it is produced (see streams.py).
+    """
+
+    def __init__(self, job_id, log=None):
+        self.job_id = job_id
+        self.log = log
+        self.steps = []
+
+    def step(self, name):
+        self.steps.append({'step': name, 'at': now().isoformat()})
+        if self.log is not None:
+            self.log.line(f"==> {name}")
+        state_writer.update(DeploymentJob, self.job_id, step=name, steps=list(self.steps))
+
+    def note(self, text):
+        """Write an informational line to the job log."""
+        if self.log is not None:
+            self.log.line(f"==> {text}")
+
+    def partial_result(self, result):
+        """Publish intermediate results while the job is still running."""
+        state_writer.update(DeploymentJob, self.job_id, result=result)
+
+
+class DeploymentWorkerPool:
+    """
+    Fixed set of daemon worker threads fed from a bounded queue.
+
+    `submit` never blocks: when the queue is full it raises JobQueueFull so the
+    view can answer immediately instead of tying up a request worker.
+    """
+
+    def __init__(self, workers=4, max_queue=32):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            workers=getattr(settings, 'DEPLOY_WORKERS', 4),
+            max_queue=getattr(settings, 'DEPLOY_QUEUE_SIZE', 32),
+        )
+
+    def submit(self, kind, func, *args, ip_address=None, repo_url='', **kwargs):
+        """
+        Create a DeploymentJob and queue `func(progress, *args, **kwargs)` to run it.
+        func must return a response-style dict ({'status': 'success'|'error', ...}).
+        """
+        self._ensure_workers()
+        job = state_writer.call(DeploymentJob.objects.create, kind=kind, ip_address=ip_address, repo_url=repo_url or '')
+        try:
+            self._queue.put_nowait((job.pk, func, args, kwargs))
+        except queue.Full:
+            state_writer.update(
+                DeploymentJob, job.pk, status='failed', message='Deployment queue is full', finished_at=now()
+            )
+            raise JobQueueFull('Deployment queue is full, try again later')
+        return job
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                t = threading.Thread(target=self._work, name=f"deploy-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job_id, func, args, kwargs = self._queue.get()
+            try:
+                self._run(job_id, func, args, kwargs)
+            finally:
+                self._queue.task_done()
+                close_old_connections()
+
+    def _run(self, job_id, func, args, kwargs):
+        state_writer.update(DeploymentJob, job_id, status='running', started_at=now())
+        log = JobLog(job_id)
+        progress = JobProgress(job_id, log)
+        try:
+            try:
+                result = func(progress, *args, **kwargs)
+            except Exception as e:
+                log.line(f"==> failed: {e}")
+                state_writer.update(DeploymentJob, job_id, status='failed', message=str(e), finished_at=now())
+                return
+            deployment_id = result.pop('deployment_id', None)
+            succeeded = result.get('status') == 'success'
+            if succeeded:
+                progress.step('done')
+            state_writer.update(
+                DeploymentJob, job_id,
+                status='succeeded' if succeeded else 'failed',
+                message=result.get('message', ''),
+                result=result,
+                deployment_id=deployment_id,
+                finished_at=now(),
+            )
+        finally:
+            log.close()
+
+
+deploy_workers = DeploymentWorkerPool.from_settings()
@@ -0,0 +1,16 @@
+# deployer/management/commands/collect_metrics.py
+from django.core.management.base import BaseCommand
+
+from django_deploy.metrics import run_collector
+
+
+class Command(BaseCommand):
+    help = ("Sample load, memory, disk and docker stats on every connected VPS, then downsample and prune. "
+            "Also rolls up EC2 usage of closed days.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=None, help="Seconds between samples (default METRICS_INTERVAL)")
+        parser.add_argument('--once', action='store_true', help="Take one sample round and exit")
+
+    def handle(self, *args, **options):
+        run_collector(interval=options['interval'], once=options['once'], log=self.stdout.write)
@@ -0,0 +1,23 @@
+# deployer/management/commands/rollup_instance_usage.py
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_deploy.usage import rollup_closed_days
+
+
+class Command(BaseCommand):
+    help = "Write the daily EC2 runtime/cost rollups for every finished day not rolled up yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-from', metavar='YYYY-MM-DD', help="Recompute every day from this date on")
+
+    def handle(self, *args, **options):
+        try:
+            rebuild_from = date.fromisoformat(options['rebuild_from']) if options['rebuild_from'] else None
+        except ValueError:
+            raise CommandError("--rebuild-from must be a date (YYYY-MM-DD)")
+        done = rollup_closed_days(rebuild_from)
+        for day, rows in done.items():
+            self.stdout.write(f"{day}: {rows} instances")
+        self.stdout.write(f"rolled up {len(done)} days")
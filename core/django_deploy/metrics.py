@@ -0,0 +1,299 @@
+# deployer/metrics.py
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Max, Sum
+from django.db.models.functions import TruncHour, TruncMinute
+from django.utils.timezone import now
+
+from .models import ContainerMetric, HostMetric, VPS
+from .remote import FULL_OUTPUT_BYTES, run_script
+from .ssh_pool import ssh_pool
+from .state import state_writer
+from .usage import rollup_closed_days
+
+# One round trip per host; every command is run even if an earlier one fails
+SAMPLE_COMMANDS = [
+    "cat /proc/loadavg",
+    "nproc",
+    "grep -E '^(MemTotal|MemAvailable):' /proc/meminfo",
+    "df -Pk / | tail -n 1",
+    "sudo docker stats --no-stream --format '{{json .}}'",
+]
+
+HOST_FIELDS = ('load1', 'load5', 'mem_used_mb', 'mem_total_mb', 'disk_used_gb', 'disk_total_gb')
+CONTAINER_FIELDS = ('cpu_pct', 'mem_used_mb', 'mem_pct')
+
+# source resolution -> (target resolution, truncation, bucket length)
+ROLLUPS = [
+    ('raw', '1m', TruncMinute, timedelta(minutes=1)),
+    ('1m', '1h', TruncHour, timedelta(hours=1)),
+]
+
+MAX_POINTS = 720  # upper bound for a series picked with resolution=auto
+
+_SIZE_UNITS = {
+    'b': 1, 'kb': 1e3, 'mb': 1e6, 'gb': 1e9, 'tb': 1e12,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+
+
+def _percent(value):
+    try:
+        return float(str(value).strip().rstrip('%') or 0)
+    except ValueError:
+        return 0.0
+
+
+def _size_mb(value):
+    """'12.5MiB' -> 12.5, '1GB' -> 953.7 (MiB, like /proc/meminfo / 1024)"""
+    match = re.match(r'\s*([\d.]+)\s*([a-zA-Z]*)', value or '')
+    if not match:
+        return 0.0
+    return float(match.group(1)) * _SIZE_UNITS.get(match.group(2).lower(), 1) / 1024 ** 2
+
+
+def parse_host_sample(details):
+    """Turn the outputs of SAMPLE_COMMANDS[:4] into HostMetric field values."""
+    loadavg, nproc, meminfo, df = (d['stdout'] for d in details[:4])
+    load = loadavg.split()
+    mem = {}
+    for line in meminfo.splitlines():
+        key, _, rest = line.partition(':')
+        mem[key.strip()] = int(rest.split()[0]) / 1024  # kB -> MB
+    disk = df.split()
+    total_mb = mem.get('MemTotal', 0.0)
+    return {
+        'load1': float(load[0]),
+        'load5': float(load[1]),
+        'cpu_count': int(nproc.strip() or 1),
+        'mem_used_mb': total_mb - mem.get('MemAvailable', total_mb),
+        'mem_total_mb': total_mb,
+        'disk_used_gb': int(disk[2]) / 1024 ** 2,  # 1K blocks -> GB
+        'disk_total_gb': int(disk[1]) / 1024 ** 2,
+    }
+
+
+def parse_docker_stats(output):
+    """{container name: ContainerMetric field values} from `docker stats --format '{{json .}}'`."""
+    stats = {}
+    for line in output.splitlines():
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(data, dict) or not data.get('Name'):
+            continue
+        stats[data['Name']] = {
+            'cpu_pct': _percent(data.get('CPUPerc')),
+            'mem_used_mb': _size_mb((data.get('MemUsage') or '').split('/')[0]),
+            'mem_pct': _percent(data.get('MemPerc')),
+        }
+    return stats
+
+
+def collect_host(vps, at=None):
+    """Sample one VPS and store the raw rows. Returns the number of containers sampled."""
+    at = at or now()
+    with ssh_pool.session(vps) as ssh:
+        details, failed = run_script(ssh, SAMPLE_COMMANDS, tail_bytes=FULL_OUTPUT_BYTES)
+    host_failures = [d for d in failed if d['command'] != SAMPLE_COMMANDS[-1]]
+    if host_failures:
+        raise Exception(f"Failed to run '{host_failures[0]['command']}': {host_failures[0]['stderr'].strip()}")
+    if details[4]['stdout_truncated']:
+        raise Exception(f"docker stats output on {vps.ip_address} is larger than {FULL_OUTPUT_BYTES} bytes")
+    host = parse_host_sample(details)
+    # No docker (or no containers) just means no container series for this sample
+    containers = parse_docker_stats(details[4]['stdout']) if details[4]['exit_status'] == 0 else {}
+
+    state_writer.call(_store_sample, vps.ip_address, at, host, containers)
+    return len(containers)
+
+
+def _store_sample(ip_address, at, host, containers):
+    HostMetric.objects.create(ip_address=ip_address, bucket=at, **host)
+    ContainerMetric.objects.bulk_create([
+        ContainerMetric(ip_address=ip_address, container=name, bucket=at, **values)
+        for name, values in containers.items()
+    ])
+
+
+def _collect(vps, at):
+    try:
+        return {'status': 'success', 'containers': collect_host(vps, at)}
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+    finally:
+        close_old_connections()
+
+
+def collect_all(concurrency=None):
+    """Sample every connected VPS, `concurrency` hosts at a time. Returns {ip: result}."""
+    hosts = list(VPS.objects.filter(connected=True))
+    if not hosts:
+        return {}
+    concurrency = max(1, min(concurrency or settings.FLEET_CONCURRENCY, settings.FLEET_MAX_CONCURRENCY, len(hosts)))
+    at = now()  # one timestamp per round keeps hosts aligned
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='metrics') as pool:
+        futures = {pool.submit(_collect, vps, at): vps.ip_address for vps in hosts}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def _rollup(model, keys, source, target, trunc, step, until):
+    """
+    Average complete `source` buckets before `until` into `target` buckets,
+    weighting by sample count so a 1h bucket is the mean of its raw samples.
+    Picks up after the newest `target` bucket of each host, so it is safe to
+    run as often as needed.
+    """
+    fields = HOST_FIELDS if model is HostMetric else CONTAINER_FIELDS
+    created = 0
+    ips = model.objects.filter(resolution=source).values_list('ip_address', flat=True).distinct()
+    for ip in list(ips):
+        last = model.objects.filter(ip_address=ip, resolution=target).aggregate(last=Max('bucket'))['last']
+        rows = model.objects.filter(ip_address=ip, resolution=source, bucket__lt=until)
+        if last is not None:
+            rows = rows.filter(bucket__gte=last + step)
+        aggregates = {f: Sum(F(f) * F('samples')) for f in fields}
+        if model is HostMetric:
+            aggregates['cpu_count'] = Max('cpu_count')
+        grouped = (
+            rows.annotate(period=trunc('bucket')).values('period', *keys)
+            .annotate(n=Sum('samples'), **aggregates).order_by('period')
+        )
+        buckets = []
+        for g in grouped:
+            values = {f: g[f] / g['n'] for f in fields}
+            if model is HostMetric:
+                values['cpu_count'] = g['cpu_count']
+            buckets.append(model(
+                ip_address=ip, resolution=target, bucket=g['period'], samples=g['n'],
+                **{k: g[k] for k in keys}, **values
+            ))
+        state_writer.call(model.objects.bulk_create, buckets)
+        created += len(buckets)
+    return created
+
+
+def downsample(at=None):
+    """Roll raw samples into minutes and minutes into hours. Returns rows created per model."""
+    at = at or now()
+    periods = {'1m': at.replace(second=0, microsecond=0), '1h': at.replace(minute=0, second=0, microsecond=0)}
+    created = {'host': 0, 'container': 0}
+    for source, target, trunc, step in ROLLUPS:
+        created['host'] += _rollup(HostMetric, (), source, target, trunc, step, periods[target])
+        created['container'] += _rollup(ContainerMetric, ('container',), source, target, trunc, step, periods[target])
+    return created
+
+
+def retention():
+    """{resolution: how long rows are kept}"""
+    return {
+        'raw': timedelta(hours=getattr(settings, 'METRICS_RETENTION_RAW_HOURS', 24)),
+        '1m': timedelta(days=getattr(settings, 'METRICS_RETENTION_1M_DAYS', 7)),
+        '1h': timedelta(days=getattr(settings, 'METRICS_RETENTION_1H_DAYS', 90)),
+    }
+
+
+def prune(at=None):
+    """Delete rows past their resolution's retention. Returns the number deleted."""
+    at = at or now()
+    deleted = 0
+    for resolution, keep in retention().items():
+        for model in (HostMetric, ContainerMetric):
+            deleted += state_writer.call(model.objects.filter(resolution=resolution, bucket__lt=at - keep).delete)[0]
+    return deleted
+
+
+def parse_window(value, default='1h'):
+    """'90' / '30m' / '6h' / '7d' -> timedelta"""
+    match = re.fullmatch(r'\s*(\d+)\s*([smhd]?)\s*', str(value or default))
+    if not match:
+        raise Exception(f"Invalid window '{value}', use e.g. 30m, 6h or 7d")
+    unit = {'': 'seconds', 's': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+    return timedelta(**{unit: int(match.group(1))})
+
+
+def pick_resolution(window):
+    """Finest resolution that still has the whole window and stays under MAX_POINTS points."""
+    kept = retention()
+    interval = getattr(settings, 'METRICS_INTERVAL', 60)
+    if window <= kept['raw'] and window.total_seconds() / interval <= MAX_POINTS:
+        return 'raw'
+    if window <= kept['1m'] and window.total_seconds() / 60 <= MAX_POINTS:
+        return '1m'
+    return '1h'
+
+
+def _series(rows, fields):
+    series = {'t': []}
+    series.update({f: [] for f in fields})
+    for row in rows:
+        series['t'].append(int(row['bucket'].timestamp()))
+        for f in fields:
+            series[f].append(round(row[f], 2))
+    return series
+
+
+def metric_series(ip, window, resolution='auto', container=None):
+    """
+    Sparkline-ready series for one host: parallel arrays keyed by field, with
+    `t` holding epoch seconds. Host series include derived mem_pct/disk_pct.
+    """
+    if resolution == 'auto':
+        resolution = pick_resolution(window)
+    since = now() - window
+    host_fields = ('load1', 'load5', 'cpu_count') + HOST_FIELDS[2:]
+    host_rows = (
+        HostMetric.objects.filter(ip_address=ip, resolution=resolution, bucket__gte=since)
+        .order_by('bucket').values('bucket', *host_fields)
+    )
+    host = _series(host_rows, host_fields)
+    host['mem_pct'] = [round(100 * u / t, 2) if t else 0.0 for u, t in zip(host['mem_used_mb'], host['mem_total_mb'])]
+    host['disk_pct'] = [round(100 * u / t, 2) if t else 0.0 for u, t in zip(host['disk_used_gb'], host['disk_total_gb'])]
+
+    container_rows = ContainerMetric.objects.filter(ip_address=ip, resolution=resolution, bucket__gte=since)
+    if container:
+        container_rows = container_rows.filter(container=container)
+    by_container = {}
+    for row in container_rows.order_by('container', 'bucket').values('container', 'bucket', *CONTAINER_FIELDS):
+        by_container.setdefault(row['container'], []).append(row)
+    return {
+        'ip': ip,
+        'resolution': resolution,
+        'window_seconds': int(window.total_seconds()),
+        'host': host,
+        'containers': {name: _series(rows, CONTAINER_FIELDS) for name, rows in by_container.items()},
+    }
+
+
+def run_collector(interval=None, once=False, log=print):
+    """
+    Sample, downsample and prune every `interval` seconds (the collect_metrics
+    command). Each round also rolls up EC2 usage for days that have closed.
+    """
+    interval = interval or getattr(settings, 'METRICS_INTERVAL', 60)
+    while True:
+        started = time.monotonic()
+        results = collect_all()
+        created = downsample()
+        deleted = prune()
+        usage_days = rollup_closed_days()
+        failed = {ip: r['message'] for ip, r in results.items() if r['status'] != 'success'}
+        log(f"sampled {len(results) - len(failed)}/{len(results)} hosts, "
+            f"rolled up {created['host']}+{created['container']} rows, pruned {deleted}")
+        if usage_days:
+            log(f"rolled up EC2 usage for {len(usage_days)} days")
+        for ip, message in failed.items():
+            log(f"  {ip}: {message}")
+        if once:
+            return results
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
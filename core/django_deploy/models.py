@@ -1,5 +1,22 @@
 # deployer/models.py
+import uuid
+
 from django.db import models
+from django.db.models.functions import Cast, Coalesce, Greatest, Least
+
+from .expressions import SecondsBetween
+
+class VPSQuerySet(models.QuerySet):
+    def with_key(self):
+        """Also load pem_file_content, which VPS.objects leaves out."""
+        return self.defer(None)
+
+
+class VPSManager(models.Manager.from_queryset(VPSQuerySet)):
+    def get_queryset(self):
+        # The key is only needed when an SSH session is opened; ssh_pool reads it then
+        return super().get_queryset().defer('pem_file_content')
+
 
 class VPS(models.Model):
     name = models.CharField(max_length=100)
@@ -8,6 +25,11 @@ class VPS(models.Model):
     pem_file_content = models.BinaryField(null=True, blank=True)  # PEM file binary content
     connected = models.BooleanField(default=False)
 
+    objects = VPSManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['connected', 'id'])]  # fleet/metrics selection, listing pages
+
     def __str__(self):
         return f"{self.name} ({'Connected' if self.connected else 'Disconnected'})"
 
@@ -16,23 +38,190 @@ class Deployment(models.Model):
     repo_url = models.URLField()
     django_root = models.CharField(max_length=255)
     wsgi_path = models.CharField(max_length=255,null=True, blank=True)
+    git_ref = models.CharField(max_length=255, blank=True)
+    commit_sha = models.CharField(max_length=40, blank=True)
+    fingerprint = models.CharField(max_length=64, blank=True)  # sha256 of commit + generated files + env
+    build_skipped = models.BooleanField(default=False)
+    color = models.CharField(max_length=10, blank=True)  # blue/green compose project serving traffic
+    gunicorn_config = models.JSONField(null=True, blank=True)  # tuned worker settings + host facts
     deployed_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=50, default="pending")
 
+    class Meta:
+        indexes = [
+            # History pages, newest first: per host, per host and status, and across all hosts
+            models.Index(fields=['ip_address', '-deployed_at', '-id']),
+            models.Index(fields=['ip_address', 'status', '-deployed_at', '-id']),
+            models.Index(fields=['-deployed_at', '-id']),
+            # last_deployed_fingerprint
+            models.Index(fields=['ip_address', 'repo_url', 'status', '-deployed_at']),
+        ]
+
     def __str__(self):
         return f"Deployment to {self.ip_address} ({self.status})"
 
 
+class DeploymentPhase(models.Model):
+    """How long one pipeline phase (connect, git_sync, upload, build, ...) of a deployment took."""
+    deployment = models.ForeignKey(Deployment, on_delete=models.CASCADE, related_name='phases')
+    name = models.CharField(max_length=30)
+    started_at = models.DateTimeField()
+    duration_ms = models.PositiveIntegerField()
+    bytes = models.BigIntegerField(null=True, blank=True)  # transferred/written during the phase, when known
+    exit_code = models.IntegerField(null=True, blank=True)  # of the remote command, when the phase is one
+    succeeded = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['name', 'started_at'])]
+
+    def __str__(self):
+        return f"{self.name} {self.duration_ms}ms ({self.deployment_id})"
+
+
+
+class DeploymentJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+    STEP_CHOICES = [
+        ('queued', 'Queued'),
+        ('provisioning', 'Provisioning instance'),
+        ('connecting', 'Connecting'),
+        ('installing', 'Installing dependencies'),
+        ('cloning', 'Cloning repository'),
+        ('uploading', 'Uploading files'),
+        ('configuring_nginx', 'Configuring nginx'),
+        ('building', 'Building and starting containers'),
+        ('recording', 'Recording deployment'),
+        ('fleet', 'Running across hosts'),
+        ('done', 'Done'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=50)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    repo_url = models.URLField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    step = models.CharField(max_length=30, choices=STEP_CHOICES, default='queued')
+    steps = models.JSONField(default=list, blank=True)  # [{'step': ..., 'at': ...}]
+    message = models.TextField(blank=True)
+    result = models.JSONField(null=True, blank=True)
+    deployment = models.ForeignKey(Deployment, null=True, blank=True, on_delete=models.SET_NULL, related_name='jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} job {self.id} ({self.status}/{self.step})"
+
+
+
+RESOLUTION_CHOICES = [
+    ('raw', 'Raw samples'),
+    ('1m', '1 minute'),
+    ('1h', '1 hour'),
+]
+
+
+class HostMetric(models.Model):
+    """One host sample (raw) or the average of the samples in a bucket (1m, 1h)."""
+    ip_address = models.GenericIPAddressField()
+    resolution = models.CharField(max_length=3, choices=RESOLUTION_CHOICES, default='raw')
+    bucket = models.DateTimeField()  # sample time, or bucket start when downsampled
+    samples = models.PositiveIntegerField(default=1)
+    load1 = models.FloatField()
+    load5 = models.FloatField()
+    cpu_count = models.PositiveSmallIntegerField(default=1)
+    mem_used_mb = models.FloatField()
+    mem_total_mb = models.FloatField()
+    disk_used_gb = models.FloatField()
+    disk_total_gb = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=['ip_address', 'resolution', 'bucket'])]
+
+    def __str__(self):
+        return f"{self.ip_address} {self.resolution} @ {self.bucket}"
+
+
+class ContainerMetric(models.Model):
+    ip_address = models.GenericIPAddressField()
+    container = models.CharField(max_length=255)
+    resolution = models.CharField(max_length=3, choices=RESOLUTION_CHOICES, default='raw')
+    bucket = models.DateTimeField()
+    samples = models.PositiveIntegerField(default=1)
+    cpu_pct = models.FloatField()
+    mem_used_mb = models.FloatField()
+    mem_pct = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=['ip_address', 'resolution', 'bucket'])]
+
+    def __str__(self):
+        return f"{self.container}@{self.ip_address} {self.resolution} @ {self.bucket}"
+
+
+class UserInstanceQuerySet(models.QuerySet):
+    def with_usage(self, start=None, end=None):
+        """
+        Annotate runtime_seconds and cost, computed by the database. With start/end
+        only the part of each instance's lifetime inside [start, end) counts (use
+        overlapping() to drop the rest); instances still running count up to now.
+        """
+        return self.annotate(runtime_seconds=self.runtime_expression(start, end)).annotate(
+            cost=self.cost_expression(models.F('runtime_seconds')),
+        )
+
+    @staticmethod
+    def runtime_expression(start=None, end=None):
+        """Seconds of an instance's lifetime inside [start, end), as a database expression (see with_usage)."""
+        from django.utils.timezone import now
+        current = now() if end is None else min(end, now())
+        running_until = Coalesce('stopped_at', models.Value(current, output_field=models.DateTimeField()))
+        if end is not None:
+            running_until = Least(running_until, models.Value(end, output_field=models.DateTimeField()))
+        running_from = models.F('started_at')
+        if start is not None:
+            running_from = Greatest(running_from, models.Value(start, output_field=models.DateTimeField()))
+        return Greatest(SecondsBetween(running_from, running_until), models.Value(0.0))
+
+    @staticmethod
+    def cost_expression(runtime_seconds):
+        return models.ExpressionWrapper(
+            runtime_seconds / 3600.0 * Cast('hourly_rate', models.FloatField()), output_field=models.FloatField(),
+        )
+
+    def overlapping(self, start, end):
+        """Instances that were running at some point in [start, end)."""
+        return self.filter(started_at__lt=end).filter(models.Q(stopped_at__isnull=True) | models.Q(stopped_at__gt=start))
 
 
 # using amazon ec2
 class UserInstance(models.Model):
+    POOL_STATE_CHOICES = [
+        ('launching', 'Launching'),  # run_instances returned, not booted yet
+        ('bootstrapping', 'Installing dependencies'),
+        ('warm', 'Ready to hand out'),
+        ('assigned', 'Handed out to a deploy'),
+        ('failed', 'Failed to start'),
+    ]
+
     instance_id = models.CharField(max_length=50)
-    ip_address = models.GenericIPAddressField()
+    ip_address = models.GenericIPAddressField(null=True, blank=True)  # known once the instance runs
     started_at = models.DateTimeField(auto_now_add=True)
     stopped_at = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=20, default='running')
     hourly_rate = models.DecimalField(max_digits=6, decimal_places=3, default=0.020)
+    pool_state = models.CharField(max_length=20, choices=POOL_STATE_CHOICES, default='assigned')
+    bootstrapped = models.BooleanField(default=False)
+    assigned_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by the process preparing a launching/bootstrapping instance; a stale one means that process is gone
+    pool_heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    objects = UserInstanceQuerySet.as_manager()
 
     def runtime_hours(self):
         from django.utils.timezone import now
@@ -41,3 +230,19 @@ class UserInstance(models.Model):
 
     def estimated_cost(self):
         return round(self.runtime_hours() * float(self.hourly_rate), 4)
+
+
+class InstanceUsageDaily(models.Model):
+    """Runtime and cost of one instance on one closed (UTC) day; see usage.py."""
+    day = models.DateField()
+    instance = models.ForeignKey(UserInstance, on_delete=models.CASCADE, related_name='daily_usage')
+    status = models.CharField(max_length=20)  # the instance's status when the day was rolled up
+    runtime_seconds = models.FloatField()
+    cost = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'instance'], name='unique_instance_usage_day')]
+        indexes = [models.Index(fields=['day', 'status'])]
+
+    def __str__(self):
+        return f"{self.instance_id} on {self.day}: {self.runtime_seconds / 3600:.2f}h"
@@ -0,0 +1,92 @@
+# deployer/nginx.py
+import hashlib
+import secrets
+
+from .remote import run_script
+from .transfer import upload_files
+
+SITES_AVAILABLE = "/etc/nginx/sites-available"
+SITES_ENABLED = "/etc/nginx/sites-enabled"
+BACKUP_SUFFIX = ".devdeploy-bak"
+
+
+class NginxSites:
+    """
+    Site configs to put on one host, applied together.
+
+    `apply` compares each staged config with the sha256 of the one on the host
+    and only writes the sites that differ (or are not enabled). All writes are
+    validated with one `nginx -t` and picked up with one reload; if the test
+    fails every written site is restored to what it was before.
+    """
+
+    def __init__(self, ssh, sftp=None):
+        self.ssh = ssh
+        self.sftp = sftp
+        self.sites = {}
+
+    def stage(self, server_name, conf_content):
+        self.sites[server_name] = conf_content
+        return self
+
+    def remote_state(self):
+        """{server_name: (sha256 of the available config or '', enabled symlink target or '')}"""
+        names = list(self.sites)
+        commands = [
+            f'echo "$(sha256sum {SITES_AVAILABLE}/{name} 2>/dev/null | cut -c1-64)"; '
+            f'echo "$(readlink {SITES_ENABLED}/{name})"'
+            for name in names
+        ]
+        details, _ = run_script(self.ssh, commands)
+        state = {}
+        for name, d in zip(names, details):
+            lines = d['stdout'].split('\n')
+            state[name] = (lines[0].strip(), lines[1].strip() if len(lines) > 1 else '')
+        return state
+
+    def apply(self, reload=False):
+        """
+        Write the changed sites and reload nginx if anything changed (or `reload`).
+        Returns {'changed': [...], 'unchanged': [...], 'reloaded': bool}.
+        """
+        state = self.remote_state() if self.sites else {}
+        changed = [
+            name for name, conf in self.sites.items()
+            if state[name] != (hashlib.sha256(conf.encode('utf-8')).hexdigest(), f"{SITES_AVAILABLE}/{name}")
+        ]
+        unchanged = [name for name in self.sites if name not in changed]
+        if changed:
+            self._write(changed, state)
+        if changed or reload:
+            details, failed = run_script(self.ssh, ["sudo systemctl reload nginx"])
+            if failed:
+                raise Exception(f"Failed to reload nginx: {failed[0]['stderr']}")
+        return {'changed': changed, 'unchanged': unchanged, 'reloaded': bool(changed or reload)}
+
+    def _write(self, names, state):
+        nonce = secrets.token_hex(4)
+        upload_files(self.sftp or self.ssh, "/tmp", {f"devdeploy-nginx-{nonce}-{name}": self.sites[name] for name in names})
+
+        install = []
+        for name in names:
+            available = f"{SITES_AVAILABLE}/{name}"
+            install.append(
+                f"if [ -e {available} ]; then sudo cp -p {available} {available}{BACKUP_SUFFIX}; fi && "
+                f"sudo mv /tmp/devdeploy-nginx-{nonce}-{name} {available} && "
+                f"sudo ln -sfn {available} {SITES_ENABLED}/{name}"
+            )
+        details, failed = run_script(self.ssh, install + ["sudo nginx -t"], stop_on_error=True)
+        if not failed:
+            run_script(self.ssh, [f"sudo rm -f {SITES_AVAILABLE}/{name}{BACKUP_SUFFIX}" for name in names])
+            return
+
+        # Put back what was there so the running nginx config stays loadable
+        rollback = []
+        for name in names:
+            available = f"{SITES_AVAILABLE}/{name}"
+            had_config, link = state[name]
+            restore = f"sudo mv {available}{BACKUP_SUFFIX} {available}" if had_config else f"sudo rm -f {available}"
+            relink = f"sudo ln -sfn {link} {SITES_ENABLED}/{name}" if link else f"sudo rm -f {SITES_ENABLED}/{name}"
+            rollback.append(f"rm -f /tmp/devdeploy-nginx-{nonce}-{name}; {restore}; {relink}")
+        run_script(self.ssh, rollback)
+        raise Exception(f"Failed to run '{failed[0]['command']}': {failed[0]['stderr']}")
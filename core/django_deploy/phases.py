@@ -0,0 +1,120 @@
+# deployer/phases.py
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from .models import Deployment, DeploymentPhase
+from .state import state_writer
+from .ssh_pool import ssh_pool
+
+PHASES = ('connect', 'git_sync', 'probe', 'upload', 'nginx', 'build', 'start', 'release')
+
+
+class PhaseTimer:
+    """
+    Collects the phases of one deploy. Each phase is a `with timer.phase(name) as phase:`
+    block; the block can fill in phase['bytes'] and phase['exit_code'].
+    A phase that raises is kept and marked as failed.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        record = {'name': name, 'started_at': now(), 'duration_ms': 0, 'bytes': None, 'exit_code': None,
+                  'succeeded': True}
+        started = time.monotonic()
+        try:
+            yield record
+        except Exception:
+            record['succeeded'] = False
+            raise
+        finally:
+            record['duration_ms'] = int((time.monotonic() - started) * 1000)
+            if record['exit_code']:
+                record['succeeded'] = False
+            self.phases.append(record)
+
+    @contextmanager
+    def session(self, vps):
+        """ssh_pool.session with the wait for a free (or new) connection timed as `connect`."""
+        with self.phase('connect'):
+            client = ssh_pool.acquire(vps)
+        try:
+            yield client
+        finally:
+            ssh_pool.release(vps, client)
+
+    def summary(self):
+        """[{name, duration_ms, bytes, exit_code}] for API responses."""
+        return [
+            {k: p[k] for k in ('name', 'duration_ms', 'bytes', 'exit_code')}
+            for p in self.phases
+        ]
+
+    def save(self, deployment):
+        DeploymentPhase.objects.bulk_create([DeploymentPhase(deployment=deployment, **p) for p in self.phases])
+
+    def record(self, **fields):
+        """Create the Deployment row and store the phases against it."""
+        return state_writer.call(self._record, fields)
+
+    def _record(self, fields):
+        deployment = Deployment.objects.create(**fields)
+        self.save(deployment)
+        return deployment
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+def phase_stats(since, until=None, ip=None, repo_url=None):
+    """
+    Per-phase duration percentiles over the phases started from `since` up to
+    `until` (default: now), optionally for one host and/or one repository.
+    The window is capped at PHASE_STATS_MAX_DAYS, every phase in it is loaded.
+    """
+    until = until or now()
+    max_window = timedelta(days=getattr(settings, 'PHASE_STATS_MAX_DAYS', 90))
+    if until - since > max_window:
+        raise Exception(f"Phase stats window is longer than {max_window.days} days")
+    phases = DeploymentPhase.objects.filter(started_at__gte=since, started_at__lt=until)
+    if ip:
+        phases = phases.filter(deployment__ip_address=ip)
+    if repo_url:
+        phases = phases.filter(deployment__repo_url=repo_url)
+
+    by_name = {}
+    for name, duration, size, succeeded in phases.order_by('duration_ms').values_list(
+            'name', 'duration_ms', 'bytes', 'succeeded'):
+        entry = by_name.setdefault(name, {'durations': [], 'bytes': [], 'failed': 0})
+        entry['durations'].append(duration)
+        if size is not None:
+            entry['bytes'].append(size)
+        if not succeeded:
+            entry['failed'] += 1
+
+    stats = {}
+    for name in sorted(by_name, key=lambda n: (PHASES.index(n) if n in PHASES else len(PHASES), n)):
+        entry = by_name[name]
+        durations = entry['durations']
+        stats[name] = {
+            'count': len(durations),
+            'failed': entry['failed'],
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'max_ms': durations[-1],
+            'mean_ms': round(sum(durations) / len(durations), 1),
+            'p50_bytes': percentile(sorted(entry['bytes']), 50),
+        }
+    return stats
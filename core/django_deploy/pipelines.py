@@ -0,0 +1,384 @@
+# deployer/pipelines.py
+import os
+import secrets
+import shlex
+
+from .bootstrap import bootstrap_host
+from .gitsync import sync_repository
+from .inventory import container_inventory
+from .models import VPS
+from .phases import PhaseTimer
+from .remote import run_script
+from .ssh_pool import ssh_pool
+from .streams import run_streamed
+from .transfer import upload_files
+from .tuning import GUNICORN_OVERRIDES, probe_host, tune_gunicorn
+from .utils import COLORS, DEFAULT_PROXY_PROFILE, active_color, compose_command, set_active_color
+from .utils import generate_dockerfile, generate_dockerignore, generate_docker_compose
+from .utils import compose_is_running, deployment_fingerprint, generate_system_nginx_conf, last_deployed_fingerprint, merge_profile
+from .utils import upload_and_enable_nginx_conf
+
+
+def provision_host(ssh, sink=None, force=False):
+    """
+    Make sure git, python, docker, docker-compose and nginx are installed and docker
+    is running on an open SSH client, skipping whatever the host already has.
+    Returns (details, failed, skipped) in the format the install-dependencies view responds with.
+    """
+    return bootstrap_host(ssh, sink, force=force)
+
+
+def install_host_dependencies(progress, ip, force=False):
+    vps = VPS.objects.get(ip_address=ip)
+    progress.step('connecting')
+    with ssh_pool.session(vps) as ssh:
+        progress.step('installing')
+        details, failed, skipped = provision_host(ssh, progress.log, force)
+    if failed:
+        return {'status': 'error', 'message': 'Some commands failed', 'details': details, 'failed': failed,
+                'skipped': skipped}
+    message = 'Dependencies installed' if details else 'Dependencies already installed'
+    return {'status': 'success', 'message': message, 'details': details, 'skipped': skipped}
+
+
+def deploy_options(data):
+    """
+    Optional deploy settings shared by every deploy endpoint:
+    git_ref (branch, tag or commit), sync_mode (incremental|fresh), git_mirror,
+    force (rebuild even if nothing changed), build_mode (React only: export|create|compose),
+    proxy_profile (Django only: overrides of DEFAULT_PROXY_PROFILE for the nginx proxy),
+    gunicorn (Django only: worker settings to use instead of the autotuned ones).
+    """
+    return {
+        'git_ref': data.get('git_ref') or None,
+        'sync_mode': data.get('sync_mode') or 'incremental',
+        'git_mirror': str(data.get('git_mirror', '')).lower() in ('1', 'true', 'yes'),
+        'force': str(data.get('force', '')).lower() in ('1', 'true', 'yes'),
+        'build_mode': data.get('build_mode') or 'export',
+        'proxy_profile': merge_profile(DEFAULT_PROXY_PROFILE, data, 'proxy_profile'),
+        'gunicorn': merge_profile(GUNICORN_OVERRIDES, data, 'gunicorn'),
+    }
+
+
+def sync_project_source(progress, ssh, repo_url, options=None):
+    """Bring the project checkout on the host up to date and return the commit SHA."""
+    options = options or deploy_options({})
+    project_name = os.path.basename(repo_url).replace('.git', '')
+    progress.step('cloning')
+    return sync_repository(
+        ssh, repo_url, project_name,
+        ref=options['git_ref'], mode=options['sync_mode'], use_mirror=options['git_mirror'],
+        sink=progress.log,
+    )
+
+
+def _deploy_over_ssh(progress, ssh, ip, repo_url, django_root, wsgi_path, server_name, env_content=None, options=None,
+                     timer=None):
+    """
+    Sync the repo, write Docker/nginx files and start docker-compose on an open SSH client.
+    The build is skipped when the fingerprint matches the running deployment (unless options['force']).
+    Each phase is timed on `timer` (a PhaseTimer).
+    Returns a dict with commit_sha, fingerprint, build_skipped, the gunicorn settings, the serving color
+    and the exit status/output of the docker-compose build or start that ran last.
+    """
+    options = options or deploy_options({})
+    timer = timer or PhaseTimer()
+    project_name = os.path.basename(repo_url).replace('.git', '')
+    with timer.phase('git_sync'):
+        commit_sha = sync_project_source(progress, ssh, repo_url, options)
+
+    # Size gunicorn for this host
+    with timer.phase('probe'):
+        host = probe_host(ssh, f"/home/ubuntu/{project_name}", django_root, wsgi_path)
+    gunicorn = tune_gunicorn(host, options.get('gunicorn'))
+    progress.note(f"gunicorn: {gunicorn['workers']} {gunicorn['worker_class']} workers"
+                  f" x {gunicorn['threads']} threads ({host['cpus']} CPUs, {host['memory_mb']} MB)")
+
+    # Generate deployment files using utils
+    progress.step('uploading')
+    artifacts = {
+        "Dockerfile": generate_dockerfile(wsgi_path, gunicorn=gunicorn, requirements=host['requirements']),
+        ".dockerignore": generate_dockerignore(),
+        # Compose file: only web service, no nginx, no static volume, .env only if present
+        "docker-compose.yml": generate_docker_compose(env_file=env_content is not None),
+    }
+    fingerprint = deployment_fingerprint(commit_sha, artifacts, env_content)
+    remote_path = f"/home/ubuntu/{project_name}/{django_root}"
+    with timer.phase('upload') as phase:
+        # Dockerfile, .dockerignore, docker-compose.yml and .env if provided, in one tar stream
+        files = dict(artifacts, **({'.env': env_content} if env_content is not None else {}))
+        upload = upload_files(ssh, remote_path, files)
+        phase['bytes'] = upload['bytes']
+    progress.note(f"uploaded {upload['files']} files ({upload['bytes']} bytes, {upload['wire_bytes']} compressed) "
+                  f"in {upload['seconds']}s")
+
+    # Generate and upload system nginx config, pointing at whichever color is live
+    progress.step('configuring_nginx')
+    with timer.phase('nginx') as phase:
+        color = active_color(ssh, remote_path)
+        nginx_conf = generate_system_nginx_conf(server_name, proxy_port=COLORS[color], profile=options.get('proxy_profile'))
+        nginx = upload_and_enable_nginx_conf(ssh, nginx_conf, server_name)
+        phase['bytes'] = len(nginx_conf.encode('utf-8')) if nginx['changed'] else 0
+
+    result = {'commit_sha': commit_sha, 'fingerprint': fingerprint, 'build_skipped': False, 'gunicorn': gunicorn,
+              'color': color, 'nginx_reloaded': nginx['reloaded'], 'exit_status': 0, 'stdout': '', 'stderr': ''}
+    if (not options['force'] and fingerprint == last_deployed_fingerprint(ip, repo_url, django_root)
+            and compose_is_running(ssh, remote_path, color)):
+        progress.note("unchanged since the running deployment, skipping build")
+        result['build_skipped'] = True
+        return result
+
+    # Build, then start, with docker-compose, streaming output to the job log.
+    # Same as `up --build -d`, split so the image build and the container start are timed apart.
+    progress.step('building')
+    for name, command in (('build', 'build'), ('start', 'up -d')):
+        with timer.phase(name) as phase:
+            result['exit_status'], result['stdout'], result['stderr'] = run_streamed(
+                ssh, f"{compose_command(remote_path, color)} {command}", progress.log
+            )
+            phase['exit_code'] = result['exit_status']
+        if result['exit_status'] != 0:
+            result['failed_phase'] = name
+            break
+    return result
+
+
+def deploy_django_project(progress, ip, repo_url, django_root, wsgi_path, server_name, env_content=None, options=None):
+    options = options or deploy_options({})
+    vps = VPS.objects.get(ip_address=ip)
+    timer = PhaseTimer()
+    record = dict(ip_address=ip, repo_url=repo_url, django_root=django_root, wsgi_path=wsgi_path,
+                  git_ref=options['git_ref'] or '')
+    progress.step('connecting')
+    try:
+        with timer.session(vps) as ssh:
+            try:
+                deployed = _deploy_over_ssh(
+                    progress, ssh, ip, repo_url, django_root, wsgi_path, server_name, env_content, options, timer
+                )
+            finally:
+                container_inventory.invalidate(ip)
+    except Exception:
+        # Failed deploys keep their timings too, they are often the slow ones
+        timer.record(status="failed", **record)
+        raise
+
+    if deployed['exit_status'] != 0:
+        timer.record(status="failed", commit_sha=deployed['commit_sha'], fingerprint=deployed['fingerprint'],
+                     gunicorn_config=deployed['gunicorn'], color=deployed['color'], **record)
+        return {'status': 'error', 'message': f"docker-compose {deployed['failed_phase']} failed",
+                'stdout': deployed['stdout'], 'stderr': deployed['stderr'], 'phases': timer.summary()}
+
+    progress.step('recording')
+    deployment = timer.record(
+        commit_sha=deployed['commit_sha'],
+        fingerprint=deployed['fingerprint'],
+        build_skipped=deployed['build_skipped'],
+        gunicorn_config=deployed['gunicorn'],
+        color=deployed['color'],
+        status="deployed",
+        **record
+    )
+    message = 'Project unchanged, build skipped' if deployed['build_skipped'] else 'Project deployed'
+    return {'status': 'success', 'message': f'{message} at http://{server_name}', 'stdout': deployed['stdout'],
+            'commit_sha': deployed['commit_sha'], 'build_skipped': deployed['build_skipped'],
+            'gunicorn': deployed['gunicorn'], 'nginx_reloaded': deployed['nginx_reloaded'],
+            'phases': timer.summary(), 'deployment_id': deployment.pk}
+
+
+HEALTH_TIMEOUT = 60
+DRAIN_SECONDS = 5
+REDEPLOY_STRATEGIES = ('bluegreen', 'inplace')
+
+
+def _health_check_command(port, server_name, path='/', timeout=HEALTH_TIMEOUT):
+    """Waits until the app on `port` answers with anything below 500."""
+    url = shlex.quote(f"http://127.0.0.1:{port}{path}")
+    host = shlex.quote(f"Host: {server_name}")
+    return (
+        f"for i in $(seq 1 {timeout}); do "
+        f"code=$(curl -s -o /dev/null -w '%{{http_code}}' -H {host} --max-time 2 {url}); "
+        f'if [ "$code" -ge 200 ] && [ "$code" -lt 500 ]; then echo "healthy: HTTP $code"; exit 0; fi; '
+        "sleep 1; done; "
+        f'echo "port {port} did not become healthy within {timeout}s (last: HTTP $code)" >&2; exit 1'
+    )
+
+
+def _start_traffic_probe(ssh, server_name, probe_id):
+    """
+    Request the site through nginx every 50ms in the background until
+    _stop_traffic_probe, recording each status code (000 = connection failed).
+    """
+    base = f"/tmp/devdeploy-probe-{probe_id}"
+    host = shlex.quote(f"Host: {server_name}")
+    loop = (f"while [ -e {base}.run ]; do "
+            f"curl -s -o /dev/null -w '%{{http_code}}\\n' -H {host} --max-time 2 http://127.0.0.1/ >> {base}.log; "
+            "sleep 0.05; done")
+    # Only the loop is backgrounded, with every stream detached, so the channel can close
+    run_script(ssh, [f"touch {base}.run\nsetsid sh -c {shlex.quote(loop)} </dev/null >/dev/null 2>&1 &"])
+
+
+def _stop_traffic_probe(ssh, probe_id):
+    base = f"/tmp/devdeploy-probe-{probe_id}"
+    details, _ = run_script(ssh, [
+        f"rm -f {base}.run && sleep 0.5 && "
+        f"awk '{{n++}} !($1 >= 200 && $1 < 500) {{f++}} END {{print n+0, f+0}}' {base}.log 2>/dev/null; rm -f {base}.log"
+    ])
+    fields = details[0]['stdout'].split() if details else []
+    requests, failed = (int(fields[0]), int(fields[1])) if len(fields) == 2 else (0, 0)
+    return {'requests': requests, 'failed': failed}
+
+
+def _bluegreen_switch(ssh, remote_path, live, server_name, proxy_profile=None, health_path='/', sink=None,
+                      timer=None):
+    """
+    Build and start the idle color next to the live one, switch nginx over once
+    it is healthy, then drain and stop the old color. The live color keeps
+    serving until the switch, and stays up if anything before it fails.
+    Requests sent through nginx during the switch are counted in 'probe'.
+    The build and health check are timed as `build`, the switch and drain as `release`.
+    """
+    timer = timer or PhaseTimer()
+    idle = 'green' if live == 'blue' else 'blue'
+    idle_compose = compose_command(remote_path, idle)
+    with timer.phase('build') as phase:
+        details, failed = run_script(ssh, [
+            # Compose files from before blue/green pin port 8000 and can't run twice
+            f"grep -q DEVDEPLOY_PORT {remote_path}/docker-compose.yml || "
+            "{ echo 'docker-compose.yml predates blue/green, run deploy-project once first' >&2; exit 1; }",
+            f"{idle_compose} up --build -d",
+            _health_check_command(COLORS[idle], server_name, health_path),
+        ], sink, stop_on_error=True)
+        phase['exit_code'] = next((d['exit_status'] for d in details if d['exit_status'] != 0), 0)
+    if failed:
+        if len(details) > 1:
+            run_script(ssh, [f"{idle_compose} down"], sink)
+        return {'status': 'error', 'message': f'New {idle} deployment did not come up, {live} is still serving',
+                'details': details, 'failed': failed, 'color': live}
+
+    probe_id = secrets.token_hex(4)
+    _start_traffic_probe(ssh, server_name, probe_id)
+    try:
+        with timer.phase('release'):
+            try:
+                nginx_conf = generate_system_nginx_conf(server_name, proxy_port=COLORS[idle], profile=proxy_profile)
+                upload_and_enable_nginx_conf(ssh, nginx_conf, server_name)
+            except Exception:
+                run_script(ssh, [f"{idle_compose} down"], sink)
+                raise
+            set_active_color(ssh, remote_path, idle)
+            # nginx reloads gracefully, give in-flight requests on the old color time to finish
+            drained, _ = run_script(ssh, [
+                f"sleep {DRAIN_SECONDS}",
+                f"{compose_command(remote_path, live)} down --timeout 30",
+            ], sink)
+    finally:
+        probe = _stop_traffic_probe(ssh, probe_id)
+    return {'status': 'success', 'message': f'Project redeployed to {idle} (port {COLORS[idle]})',
+            'color': idle, 'probe': probe, 'details': details + drained, 'build_skipped': False}
+
+
+def _remote_fingerprint(ssh, project_name, remote_path):
+    """(commit_sha, fingerprint) of the checkout, generated files and .env currently on the host."""
+    names = ["Dockerfile", ".dockerignore", "docker-compose.yml"]
+    details, _ = run_script(ssh, [f"git -C /home/ubuntu/{project_name} rev-parse HEAD"] +
+                            [f"cat {remote_path}/{name}" for name in names + ['.env']])
+    commit_sha = details[0]['stdout'].strip()
+    artifacts = {name: d['stdout'] for name, d in zip(names, details[1:]) if d['exit_status'] == 0}
+    env_content = details[-1]['stdout'] if details[-1]['exit_status'] == 0 else None
+    return commit_sha, deployment_fingerprint(commit_sha, artifacts, env_content)
+
+
+def redeploy_django_project(ssh, ip, repo_url, django_root, force=False, strategy='inplace', server_name=None,
+                            proxy_profile=None, health_path='/', sink=None, timer=None):
+    """
+    Rebuild and restart an already deployed project from what is on the host.
+    Skipped when the remote checkout, generated files and .env still hash to
+    the fingerprint of the running deployment.
+    strategy: 'inplace' stops the running containers before rebuilding,
+    'bluegreen' switches traffic only once the new containers are healthy.
+    The result carries the commit_sha, fingerprint and serving color to record
+    the redeploy with; each phase is timed on `timer` (a PhaseTimer).
+    """
+    if strategy not in REDEPLOY_STRATEGIES:
+        raise Exception(f"Unknown redeploy strategy '{strategy}', expected one of: {', '.join(REDEPLOY_STRATEGIES)}")
+    timer = timer or PhaseTimer()
+    project_name = os.path.basename(repo_url).replace('.git', '')
+    remote_path = f"/home/ubuntu/{project_name}/{django_root}"
+    color = active_color(ssh, remote_path)
+    commit_sha, fingerprint = _remote_fingerprint(ssh, project_name, remote_path)
+    deployed = {'commit_sha': commit_sha, 'fingerprint': fingerprint}
+    if (not force and fingerprint == last_deployed_fingerprint(ip, repo_url, django_root)
+            and compose_is_running(ssh, remote_path, color)):
+        return dict(deployed, status='success', message='Project unchanged, redeploy skipped', details=[],
+                    build_skipped=True, color=color)
+
+    if strategy == 'bluegreen':
+        return dict(deployed, **_bluegreen_switch(ssh, remote_path, color, server_name or ip, proxy_profile,
+                                                  health_path, sink, timer))
+
+    # Stop and remove running containers,git pull then rebuild and restart
+    commands = [
+        f"{compose_command(remote_path, color)} down",
+        # f"cd {remote_path} && git pull",
+        f"{compose_command(remote_path, color)} up --build -d"
+    ]
+    with timer.phase('build') as phase:
+        details, failed = run_script(ssh, commands, sink)
+        phase['exit_code'] = next((d['exit_status'] for d in details if d['exit_status'] != 0), 0)
+    if failed:
+        return dict(deployed, status='error', message='Some commands failed', details=details, failed=failed,
+                    color=color)
+    return dict(deployed, status='success', message='Project redeployed', details=details, build_skipped=False,
+                color=color)
+
+
+def redeploy_on_host(progress, ip, repo_url, django_root, force=False, strategy='bluegreen', server_name=None,
+                     proxy_profile=None, health_path='/'):
+    vps = VPS.objects.get(ip_address=ip)
+    timer = PhaseTimer()
+    record = dict(ip_address=ip, repo_url=repo_url, django_root=django_root)
+    progress.step('connecting')
+    try:
+        with timer.session(vps) as ssh:
+            progress.step('building')
+            try:
+                result = redeploy_django_project(ssh, ip, repo_url, django_root, force, strategy, server_name,
+                                                 proxy_profile, health_path, sink=progress.log, timer=timer)
+            finally:
+                container_inventory.invalidate(ip)
+    except Exception:
+        timer.record(status="failed", **record)
+        raise
+
+    # Recorded like a deploy, so the next skip check compares against what is now running
+    progress.step('recording')
+    deployment = timer.record(
+        commit_sha=result['commit_sha'],
+        fingerprint=result['fingerprint'],
+        build_skipped=result.get('build_skipped', False),
+        color=result['color'],
+        status="deployed" if result['status'] == 'success' else "failed",
+        **record
+    )
+    return dict(result, phases=timer.summary(), deployment_id=deployment.pk)
+
+
+def deploy_django_project_aws(progress, repo_url, django_root, wsgi_path, env_content=None, options=None):
+    """
+    Deploy to an EC2 instance from the warm pool (launched on demand when the
+    pool is empty), then deploy to it like to any connected VPS.
+    """
+    from .warmpool import warm_pool
+    progress.step('provisioning')
+    instance = warm_pool.acquire(progress)
+    progress.note(f"deploying to {instance.instance_id} ({instance.ip_address})")
+
+    project_name = os.path.basename(repo_url).replace('.git', '')
+    if not django_root:
+        django_root = project_name
+    result = deploy_django_project(
+        progress, instance.ip_address, repo_url, django_root, wsgi_path, instance.ip_address, env_content, options
+    )
+    result['instance_id'] = instance.instance_id
+    return result
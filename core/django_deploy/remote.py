@@ -0,0 +1,146 @@
+# deployer/remote.py
+import secrets
+
+from .streams import TAIL_BYTES, _Tail, pump_channel
+
+MAX_PARTIAL_LINE = 4096
+# tail_bytes for commands whose whole output is parsed (docker ps, docker stats)
+FULL_OUTPUT_BYTES = 32 * 2 ** 20
+
+
+def _label(cmd):
+    """First line of a command, marked when it continues (multi-line scripts)."""
+    lines = cmd.strip().splitlines() or ['']
+    return lines[0] + (' ...' if len(lines) > 1 else '')
+
+
+class _StreamDemux:
+    """
+    Split one output stream of a batch script back into per-command buffers
+    using the BEGIN/END marker lines the script prints around each command.
+    """
+
+    def __init__(self, begin, end, count, sink=None, commands=None, tail_bytes=TAIL_BYTES):
+        self.begin = begin
+        self.end = end
+        self.sink = sink
+        self.commands = commands
+        self.tails = [_Tail(tail_bytes) for _ in range(count)]
+        self.results = {}  # index -> (exit_status, duration_ms)
+        self.current = None
+        self._partial = b''
+        self._held_newline = False
+
+    def feed(self, data):
+        self._partial += data
+        while b'\n' in self._partial:
+            line, self._partial = self._partial.split(b'\n', 1)
+            self._line(line)
+        if len(self._partial) > MAX_PARTIAL_LINE:
+            # Markers always start a fresh line, so a long partial line is plain output
+            self._content(self._partial, complete=False)
+            self._partial = b''
+
+    def close(self):
+        if self._partial:
+            self._content(self._partial, complete=False)
+            self._partial = b''
+
+    def _line(self, line):
+        if line.startswith(self.begin):
+            self.current = int(line[len(self.begin):])
+            self._held_newline = False
+            if self.sink is not None and self.commands is not None:
+                self.sink.line(f"$ {_label(self.commands[self.current])}")
+        elif line.startswith(self.end):
+            fields = line[len(self.end):].split()
+            if len(fields) == 3:
+                self.results[int(fields[0])] = (int(fields[1]), int(fields[2]))
+            # The newline before the END marker was added by the script, drop it
+            self._held_newline = False
+            self.current = None
+        else:
+            self._content(line, complete=True)
+
+    def _content(self, data, complete):
+        if self.current is None:
+            return
+        if self._held_newline:
+            data = b'\n' + data
+        self._held_newline = complete
+        self.tails[self.current].append(data)
+        if self.sink is not None and data:
+            self.sink.write(data)
+
+
+def build_batch_script(commands, nonce, stop_on_error=False):
+    """
+    Wrap `commands` in a bash script that runs each one in its own subshell and
+    frames its output with marker lines carrying the exit status and duration.
+    """
+    begin = f"__DD_BEGIN_{nonce}_"
+    end = f"__DD_END_{nonce}_"
+    lines = []
+    for i, cmd in enumerate(commands):
+        lines += [
+            f"printf '%s\\n' '{begin}{i}'; printf '%s\\n' '{begin}{i}' >&2",
+            "__dd_t=$(date +%s%3N)",
+            # stdin is the script itself, keep commands from reading it
+            f"( {cmd}\n) </dev/null",
+            "__dd_rc=$?",
+            "__dd_ms=$(( $(date +%s%3N) - __dd_t ))",
+            f"printf '\\n%s%s %s %s\\n' '{end}' {i} \"$__dd_rc\" \"$__dd_ms\"; printf '\\n%s%s\\n' '{end}' {i} >&2",
+        ]
+        if stop_on_error:
+            lines.append('[ "$__dd_rc" -eq 0 ] || exit "$__dd_rc"')
+    return '\n'.join(lines) + '\n'
+
+
+def run_script(ssh, commands, sink=None, stop_on_error=False, tail_bytes=TAIL_BYTES):
+    """
+    Run a list of shell commands as one script over a single SSH channel.
+
+    Each command still runs in its own subshell (a `cd` does not leak into the
+    next one) and gets its own exit status, stdout, stderr and duration.
+    With stop_on_error the script exits at the first failing command and the
+    remaining commands are not reported. Only the last `tail_bytes` of each
+    output are kept; details[i]['stdout_truncated'] tells when stdout was cut.
+    Returns (details, failed) in the format the views respond with.
+    """
+    nonce = secrets.token_hex(8)
+    begin = f"__DD_BEGIN_{nonce}_".encode()
+    end = f"__DD_END_{nonce}_".encode()
+    out = _StreamDemux(begin, end, len(commands), sink, commands, tail_bytes)
+    err = _StreamDemux(begin, end, len(commands), sink, None, tail_bytes)
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command("bash -s")
+    channel.sendall(build_batch_script(commands, nonce, stop_on_error).encode())
+    channel.shutdown_write()
+    script_status = pump_channel(channel, out.feed, err.feed)
+    channel.close()
+    out.close()
+    err.close()
+
+    details = []
+    failed = []
+    for i, cmd in enumerate(commands):
+        if i in out.results:
+            exit_status, duration_ms = out.results[i]
+        elif out.current == i:
+            # The script died while this command was running
+            exit_status, duration_ms = script_status or -1, None
+        else:
+            break
+        stderr_text = err.tails[i].text()
+        details.append({
+            'command': cmd,
+            'exit_status': exit_status,
+            'stdout': out.tails[i].text(),
+            'stderr': stderr_text,
+            'duration_ms': duration_ms,
+            'stdout_truncated': out.tails[i].dropped > 0,
+        })
+        if exit_status != 0:
+            failed.append({'command': cmd, 'stderr': stderr_text})
+    return details, failed
@@ -0,0 +1,246 @@
+# deployer/ssh_pool.py
+import hashlib
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+from django.conf import settings
+
+_KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+def load_private_key(pem_content):
+    """
+    Parse PEM/OpenSSH private key bytes into a paramiko key without touching disk.
+    """
+    if isinstance(pem_content, memoryview):
+        pem_content = pem_content.tobytes()
+    if isinstance(pem_content, bytes):
+        pem_content = pem_content.decode('utf-8')
+    last_error = None
+    for key_class in _KEY_CLASSES:
+        try:
+            return key_class.from_private_key(io.StringIO(pem_content))
+        except paramiko.SSHException as e:
+            last_error = e
+    raise paramiko.SSHException(f"Unsupported or invalid private key: {last_error}")
+
+
+class _HostSlot:
+    def __init__(self, max_sessions):
+        self.semaphore = threading.BoundedSemaphore(max_sessions)
+        self.idle = []  # [(client, last_used)]
+        self.in_use = 0
+        self.key = None
+        self.key_digest = None  # digest of `key`; sessions opened with another key aren't reused
+
+
+class SSHSessionPool:
+    """
+    Process-wide pool of live SSH sessions keyed by VPS ip address.
+
+    A session is checked out exclusively with `session(vps)` and returned to the
+    pool afterwards. Dead transports are reconnected on checkout, idle sessions
+    are closed after `idle_timeout` seconds and at most `max_per_host` sessions
+    are open to a single host at any time.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=300, keepalive_interval=30,
+                 connect_timeout=15, acquire_timeout=120, username="ubuntu", port=22):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self.username = username
+        self.port = port
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._reaper = None
+        self._counters = {'hits': 0, 'misses': 0, 'reconnects': 0, 'evictions': 0, 'timeouts': 0}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_per_host=getattr(settings, 'SSH_POOL_MAX_SESSIONS_PER_HOST', 4),
+            idle_timeout=getattr(settings, 'SSH_POOL_IDLE_TIMEOUT', 300),
+            keepalive_interval=getattr(settings, 'SSH_POOL_KEEPALIVE_INTERVAL', 30),
+            connect_timeout=getattr(settings, 'SSH_CONNECT_TIMEOUT', 15),
+            username=getattr(settings, 'SSH_USERNAME', 'ubuntu'),
+            port=getattr(settings, 'SSH_PORT', 22),
+        )
+
+    @contextmanager
+    def session(self, vps):
+        client = self.acquire(vps)
+        try:
+            yield client
+        finally:
+            self.release(vps, client)
+
+    def acquire(self, vps):
+        ip = vps.ip_address
+        slot = self._slot(ip)
+        if not slot.semaphore.acquire(timeout=self.acquire_timeout):
+            self._count('timeouts')
+            raise Exception(f"Timed out waiting for a free SSH session to {ip}")
+        try:
+            self._ensure_reaper()
+            with self._lock:
+                while slot.idle:
+                    client, _ = slot.idle.pop()
+                    if self._is_current(client, slot):
+                        slot.in_use += 1
+                        self._counters['hits'] += 1
+                        return client
+                    client.close()
+                    self._counters['reconnects'] += 1
+                self._counters['misses'] += 1
+            client = self._connect(vps, slot)
+            with self._lock:
+                slot.in_use += 1
+            return client
+        except Exception:
+            slot.semaphore.release()
+            raise
+
+    def release(self, vps, client):
+        slot = self._slot(vps.ip_address)
+        with self._lock:
+            slot.in_use -= 1
+            if self._is_current(client, slot):
+                slot.idle.append((client, time.monotonic()))
+                client = None
+        if client is not None:
+            client.close()
+        slot.semaphore.release()
+
+    def invalidate(self, ip):
+        """
+        Close idle sessions and forget the cached key for a host (e.g. after a key
+        change). Sessions checked out at the time are closed when released.
+        """
+        with self._lock:
+            slot = self._hosts.get(ip)
+            if slot is None:
+                return
+            idle, slot.idle = slot.idle, []
+            slot.key = slot.key_digest = None
+        for client, _ in idle:
+            client.close()
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._lock:
+            for slot in self._hosts.values():
+                keep = []
+                for client, last_used in slot.idle:
+                    if last_used < deadline or not self._is_alive(client):
+                        expired.append(client)
+                    else:
+                        keep.append((client, last_used))
+                slot.idle = keep
+            self._counters['evictions'] += len(expired)
+        for client in expired:
+            client.close()
+        return len(expired)
+
+    def close_all(self):
+        with self._lock:
+            hosts = list(self._hosts)
+        for ip in hosts:
+            self.invalidate(ip)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                **self._counters,
+                'hit_rate': round(self._counters['hits'] / lookups, 4) if lookups else None,
+                'max_sessions_per_host': self.max_per_host,
+                'hosts': {
+                    ip: {'idle': len(slot.idle), 'in_use': slot.in_use}
+                    for ip, slot in self._hosts.items()
+                },
+            }
+
+    def _slot(self, ip):
+        with self._lock:
+            slot = self._hosts.get(ip)
+            if slot is None:
+                slot = self._hosts[ip] = _HostSlot(self.max_per_host)
+            return slot
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def _pem_for(vps):
+        """
+        The stored key. VPS.objects defers it, so unless the caller already holds it
+        it is read here, on a pool miss, and not kept on the instance.
+        """
+        if 'pem_file_content' not in vps.get_deferred_fields():
+            return vps.pem_file_content
+        return type(vps)._default_manager.filter(pk=vps.pk).values_list('pem_file_content', flat=True).first()
+
+    def _key_for(self, vps, slot):
+        pem_content = self._pem_for(vps)
+        if not pem_content:
+            raise Exception(f"No PEM key stored for {vps.ip_address}")
+        digest = hashlib.sha256(bytes(pem_content)).hexdigest()
+        with self._lock:
+            if slot.key_digest == digest:
+                return slot.key, digest
+        key = load_private_key(pem_content)
+        with self._lock:
+            slot.key, slot.key_digest = key, digest
+        return key, digest
+
+    def _connect(self, vps, slot):
+        key, digest = self._key_for(vps, slot)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            vps.ip_address,
+            port=self.port,
+            username=self.username,
+            pkey=key,
+            timeout=self.connect_timeout,
+            allow_agent=False,
+            look_for_keys=False,
+        )
+        ssh.get_transport().set_keepalive(self.keepalive_interval)
+        ssh.pool_key_digest = digest
+        return ssh
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _is_current(self, client, slot):
+        """Alive and opened with the host's current key (call with the lock held)."""
+        return getattr(client, 'pool_key_digest', None) == slot.key_digest and self._is_alive(client)
+
+    def _ensure_reaper(self):
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        with self._lock:
+            if self._reaper is not None and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name="ssh-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_forever(self):
+        interval = max(1, self.idle_timeout / 2)
+        while True:
+            time.sleep(interval)
+            self.evict_idle()
+
+
+ssh_pool = SSHSessionPool.from_settings()
@@ -0,0 +1,180 @@
+# deployer/state.py
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+
+_FLUSH = object()
+
+logger = logging.getLogger(__name__)
+
+
+class StateWriter:
+    """
+    Single writer for deploy state: job progress and status, deployment records
+    and VPS connection state.
+
+    `update(model, pk, **fields)` is queued and returns at once; queued updates
+    of the same row are merged, so a job that reports ten steps while the
+    writer is busy costs one UPDATE. `call(func, ...)` runs a write whose result
+    is needed (a create) on the writer thread and waits for it. The writer
+    applies everything queued since its last pass in one transaction.
+
+    SQLite allows one writer at a time; with every deploy thread writing on its
+    own they queue up on the database lock (and give up with "database is
+    locked" after the busy timeout). Here they queue in memory instead and the
+    lock is taken once per batch. A batch whose commit fails is retried
+    `retries` times before its writes are given up on. With batched=False (the default on databases
+    with row locking, e.g. PostgreSQL) writes run directly in the calling thread.
+    """
+
+    def __init__(self, batched=True, max_batch=500, retries=3, retry_delay=0.5):
+        self.batched = batched
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._counters = {'updates': 0, 'merged': 0, 'calls': 0, 'batches': 0, 'errors': 0, 'retries': 0}
+
+    @classmethod
+    def from_settings(cls):
+        batched = getattr(settings, 'STATE_WRITER_BATCHED', None)
+        if batched is None:
+            batched = settings.DATABASES['default']['ENGINE'].endswith('sqlite3')
+        return cls(
+            batched=batched,
+            max_batch=getattr(settings, 'STATE_WRITER_MAX_BATCH', 500),
+            retries=getattr(settings, 'STATE_WRITER_RETRIES', 3),
+        )
+
+    def update(self, model, pk, **fields):
+        """UPDATE the row `pk` of `model` with `fields`, eventually (in order with other writes)."""
+        if not self.batched:
+            model.objects.filter(pk=pk).update(**fields)
+            return
+        self._ensure_writer()
+        self._queue.put(('update', (model, pk), fields))
+
+    def call(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) as a write and return its result once committed."""
+        if not self.batched or threading.current_thread() is self._thread:
+            return func(*args, **kwargs)
+        future = Future()
+        self._ensure_writer()
+        self._queue.put(('call', (func, args, kwargs), future))
+        return future.result()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued before now is committed."""
+        if not self.batched or threading.current_thread() is self._thread:
+            return
+        future = Future()
+        self._ensure_writer()
+        self._queue.put(('flush', _FLUSH, future))
+        future.result(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'batched': self.batched, 'queued': self._queue.qsize(), **self._counters}
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._write_forever, name="state-writer", daemon=True)
+            self._thread.start()
+
+    def _write_forever(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                done, merged = self._apply(batch)
+                break
+            except Exception as e:
+                # The commit itself failed (e.g. the database stayed locked): nothing in the batch was written
+                connection.close()
+                if attempt < self.retries:
+                    logger.warning("state writer: commit of %d writes failed (%s), retrying", len(batch), e)
+                    self._count('retries')
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                logger.exception("state writer: commit of %d writes failed, giving them up", len(batch))
+                self._count('errors')
+                for kind, target, payload in batch:
+                    if kind == 'update':
+                        logger.error("state writer: lost update of %s pk=%s: %s",
+                                     target[0].__name__, target[1], sorted(payload))
+                done, merged = [(payload, None, e) for kind, _, payload in batch if kind != 'update'], 0
+
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['merged'] += merged
+            for kind, _, _ in batch:
+                if kind in ('update', 'call'):
+                    self._counters[kind + 's'] += 1
+        for future, result, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _apply(self, batch):
+        """Run the batch in one transaction. Returns ([(future, result, error)], merged updates)."""
+        pending = {}  # (model, pk) -> fields, in arrival order
+        done = []  # resolved by the caller once committed
+        merged = 0
+
+        def apply_pending():
+            for (model, pk), fields in pending.items():
+                try:
+                    with transaction.atomic():
+                        model.objects.filter(pk=pk).update(**fields)
+                except Exception:
+                    logger.exception("state writer: update of %s pk=%s failed", model.__name__, pk)
+                    self._count('errors')
+            pending.clear()
+
+        with transaction.atomic():
+            for kind, target, payload in batch:
+                if kind == 'update':
+                    if target in pending:
+                        pending[target].update(payload)
+                        merged += 1
+                    else:
+                        pending[target] = dict(payload)
+                    continue
+                # Calls and flushes see every update queued before them
+                apply_pending()
+                if kind == 'flush':
+                    done.append((payload, None, None))
+                    continue
+                func, args, kwargs = target
+                try:
+                    with transaction.atomic():
+                        done.append((payload, func(*args, **kwargs), None))
+                except Exception as e:
+                    done.append((payload, None, e))
+            apply_pending()
+        return done, merged
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+state_writer = StateWriter.from_settings()
@@ -0,0 +1,245 @@
+# deployer/streams.py
+import asyncio
+import os
+import select
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import DeploymentJob
+
+CHUNK_SIZE = 64 * 1024
+TAIL_BYTES = 64 * 1024
+HEARTBEAT_SECONDS = 15
+
+
+def job_log_path(job_id):
+    return os.path.join(settings.JOB_LOG_DIR, f"{job_id}.log")
+
+
+class JobLog:
+    """
+    Append-only on-disk output log for a job.
+
+    Remote output is spooled here as it arrives so readers can follow it at
+    their own pace (or resume from a byte offset) without the producer ever
+    holding the whole output in memory.
+    """
+
+    def __init__(self, job_id):
+        os.makedirs(settings.JOB_LOG_DIR, exist_ok=True)
+        self.path = job_log_path(job_id)
+        self._file = open(self.path, 'ab')
+        self._lock = threading.Lock()
+        self._at_line_start = True
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            self._at_line_start = data.endswith(b'\n')
+
+    def line(self, text):
+        """Write `text` as a line of its own, even if the previous output ended mid-line."""
+        self.write(("" if self._at_line_start else "\n") + text + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PrefixedLog:
+    """
+    Line-buffered view of a JobLog that prefixes every line, so output from
+    several hosts writing to one log concurrently stays readable.
+    """
+
+    def __init__(self, log, prefix):
+        self.log = log
+        self.prefix = prefix.encode('utf-8')
+        self._partial = b''
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        *lines, self._partial = (self._partial + data).split(b'\n')
+        if len(self._partial) > CHUNK_SIZE:
+            lines.append(self._partial)
+            self._partial = b''
+        if lines:
+            self.log.write(b''.join(self.prefix + line + b'\n' for line in lines))
+
+    def line(self, text):
+        self.flush()
+        self.write(text + "\n")
+
+    def flush(self):
+        if self._partial:
+            partial, self._partial = self._partial, b''
+            self.log.write(self.prefix + partial + b'\n')
+
+
+class _Tail:
+    """Keeps only the last `limit` bytes written to it; `dropped` counts the rest."""
+
+    def __init__(self, limit=TAIL_BYTES):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def append(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.limit:
+            self.dropped += len(self.buffer) - self.limit
+            del self.buffer[:len(self.buffer) - self.limit]
+
+    def text(self):
+        return self.buffer.decode('utf-8', errors='replace')
+
+
+def run_streamed(ssh, cmd, sink=None, tail_bytes=TAIL_BYTES):
+    """
+    Run `cmd` on one channel, passing stdout/stderr chunks to `sink.write` as they
+    arrive. Only the last `tail_bytes` of each stream are kept in memory.
+    Returns (exit_status, stdout_tail, stderr_tail).
+    """
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(cmd)
+    out, err = _Tail(tail_bytes), _Tail(tail_bytes)
+
+    def on_stdout(data):
+        out.append(data)
+        if sink is not None:
+            sink.write(data)
+
+    def on_stderr(data):
+        err.append(data)
+        if sink is not None:
+            sink.write(data)
+
+    exit_status = pump_channel(channel, on_stdout, on_stderr)
+    channel.close()
+    return exit_status, out.text(), err.text()
+
+
+def pump_channel(channel, on_stdout, on_stderr):
+    """
+    Hand stdout/stderr chunks to the callbacks as they arrive until the remote
+    command exits. Both streams are drained together so neither can stall the
+    channel window. Returns the exit status.
+    """
+    while True:
+        select.select([channel], [], [], 1.0)
+        progressed = False
+        while channel.recv_ready():
+            on_stdout(channel.recv(CHUNK_SIZE))
+            progressed = True
+        while channel.recv_stderr_ready():
+            on_stderr(channel.recv_stderr(CHUNK_SIZE))
+            progressed = True
+        if not progressed and channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+            return channel.recv_exit_status()
+
+
+def _sse_event(offset, line):
+    text = line.rstrip(b'\r\n').decode('utf-8', errors='replace')
+    return f"id: {offset}\ndata: {text}\n\n"
+
+
+class _LogFollower:
+    """
+    Polls a job log and turns what is new into server-sent events, one event per
+    line, starting at byte `offset`. Each event id is the byte offset just past
+    that line, so a client reconnecting with Last-Event-ID resumes exactly where
+    it left off. `poll` never blocks; the sync and async streams below only
+    differ in how they wait between polls.
+    """
+
+    def __init__(self, job_id, offset=0, max_seconds=None):
+        self.job_id = job_id
+        self.path = job_log_path(job_id)
+        self.offset = offset
+        self.pending = b''
+        self.finished = None
+        self.done = False
+        self.last_sent = time.monotonic()
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+
+    def poll(self):
+        """Return (events, idle): the events available now and whether to wait before polling again."""
+        data = b''
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset + len(self.pending))
+                data = f.read(CHUNK_SIZE)
+        if data:
+            events = []
+            self.pending += data
+            *lines, self.pending = self.pending.split(b'\n')
+            for line in lines:
+                self.offset += len(line) + 1
+                events.append(_sse_event(self.offset, line))
+            if len(self.pending) >= CHUNK_SIZE:
+                # Don't buffer an unbounded line (progress bars, minified output)
+                self.offset += len(self.pending)
+                events.append(_sse_event(self.offset, self.pending))
+                self.pending = b''
+            self.last_sent = time.monotonic()
+            return events, False
+
+        if self.finished:
+            # The log was drained after the job finished, so nothing more will arrive
+            events = []
+            if self.pending:
+                self.offset += len(self.pending)
+                events.append(_sse_event(self.offset, self.pending))
+            events.append(f"event: end\nid: {self.offset}\ndata: {self.finished}\n\n")
+            self.done = True
+            return events, False
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            # Give the connection back; EventSource reconnects with Last-Event-ID and resumes
+            self.done = True
+            return [], False
+        status = DeploymentJob.objects.filter(pk=self.job_id).values_list('status', flat=True).first()
+        if status is None:
+            self.done = True
+            return ["event: error\ndata: Job not found\n\n"], False
+        if status in ('succeeded', 'failed'):
+            self.finished = status
+            return [], False
+        if time.monotonic() - self.last_sent > HEARTBEAT_SECONDS:
+            self.last_sent = time.monotonic()
+            return [": keepalive\n\n"], True
+        return [], True
+
+
+def stream_job_log(job_id, offset=0, poll_interval=0.25, max_seconds=None):
+    """
+    The job log as server-sent events (see _LogFollower), for WSGI. The stream
+    ends with an `end` event once the job has finished and the log is drained,
+    or after `max_seconds` so a slow job doesn't hold a worker for its whole run.
+    """
+    follower = _LogFollower(job_id, offset, max_seconds)
+    while not follower.done:
+        events, idle = follower.poll()
+        yield from events
+        if idle:
+            time.sleep(poll_interval)
+
+
+async def astream_job_log(job_id, offset=0, poll_interval=0.25, max_seconds=None):
+    """stream_job_log for ASGI: file and database reads run off the event loop, waits don't block it."""
+    follower = _LogFollower(job_id, offset, max_seconds)
+    poll = sync_to_async(follower.poll)
+    while not follower.done:
+        events, idle = await poll()
+        for event in events:
+            yield event
+        if idle:
+            await asyncio.sleep(poll_interval)
\ No newline at end of file
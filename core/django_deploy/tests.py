@@ -1,3 +1,1462 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import secrets
+import shlex
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.db import connection
+from django.db.models import F, Value
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now
+
+from benchmarks.standin import COMMIT_SHA, StandIn
+
+from .bootstrap import PACKAGES, plan_bootstrap, prefetch_script
+from .expressions import SecondsBetween
+from .fleet import run_fleet_operation
+from .gitsync import git_sync_script, mirror_path
+from .inventory import ContainerInventory, ContainerRecord, parse_docker_ps
+from .jobs import DeploymentWorkerPool, JobQueueFull
+from .metrics import collect_host, downsample, pick_resolution, prune
+from .models import ContainerMetric, Deployment, DeploymentJob, DeploymentPhase, HostMetric, InstanceUsageDaily
+from .models import UserInstance, VPS
+from .nginx import NginxSites
+from .pagination import MAX_LIMIT, decode_cursor, encode_cursor, keyset_page, parse_limit
+from .phases import PhaseTimer, percentile, phase_stats
+from .pipelines import _bluegreen_switch, _health_check_command, _start_traffic_probe, _stop_traffic_probe
+from .pipelines import redeploy_on_host
+from .remote import _StreamDemux, build_batch_script, run_script
+from .ssh_pool import SSHSessionPool, ssh_pool
+from .state import StateWriter, state_writer
+from .streams import _LogFollower, astream_job_log, job_log_path, stream_job_log
+from .transfer import _members_from_files, upload_directory, upload_files
+from .tuning import gunicorn_command, requirement_names, tune_gunicorn
+from .usage import rollup_closed_days, rollup_day, usage_report
+from .utils import DEFAULT_PROXY_PROFILE, compose_command, deployment_fingerprint, generate_dockerfile
+from .utils import generate_system_nginx_conf, last_deployed_fingerprint, merge_profile
+from .warmpool import WarmPool, vps_name
+
+
+def create_missing_tables():
+    """django_deploy has no committed migrations, so its tables are created here for the test database."""
+    existing = set(connection.introspection.table_names())
+    with connection.schema_editor() as editor:
+        for model in apps.get_models():
+            if model._meta.managed and model._meta.db_table not in existing:
+                editor.create_model(model)
+                existing.add(model._meta.db_table)
+
+
+class StandInTestCase(TestCase):
+    """
+    Runs the benchmarks' stand-in SSH server (real bash, shimmed git/docker/nginx)
+    for the class, with ssh_pool pointed at it and `cls.vps` connected to it.
+    """
+    containers = 5
+
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        root = tempfile.TemporaryDirectory(prefix='devdeploy-test-')
+        cls.addClassCleanup(root.cleanup)
+        cls.standin = StandIn(root.name, containers=cls.containers)
+        patcher = mock.patch.object(ssh_pool, 'port', cls.standin.start())
+        patcher.start()
+        cls.addClassCleanup(cls.standin.stop)
+        cls.addClassCleanup(patcher.stop)
+        cls.addClassCleanup(ssh_pool.close_all)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.vps = VPS.objects.create(ip_address=cls.standin.ips[0], name='stand-in', pem_file_name='test.pem',
+                                     pem_file_content=cls.standin.client_pem(), connected=True)
+
+    def host_path(self, path):
+        """Where an absolute path on the stand-in host lives locally."""
+        return f"{self.standin.root}/hosts/{self.vps.ip_address}{path}"
+
+
+class StubEC2:
+    """Just enough of the boto3 EC2 client for aws.launch_instances / wait_until_running / terminate_instances."""
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.ips = {}
+        self.terminated = []
+
+    def run_instances(self, MinCount, MaxCount, **kwargs):
+        instances = []
+        for _ in range(MinCount):
+            n = next(self.ids)
+            instance_id = f"i-{n:04d}"
+            self.ips[instance_id] = f"10.0.0.{n}"
+            instances.append({'InstanceId': instance_id})
+        return {'Instances': instances}
+
+    def get_waiter(self, name):
+        return mock.Mock()
+
+    def describe_instances(self, InstanceIds):
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': i, 'PublicIpAddress': self.ips[i]} for i in InstanceIds
+        ]}]}
+
+    def terminate_instances(self, InstanceIds):
+        self.terminated += InstanceIds
+
+
+class WarmPoolTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        self.ec2 = StubEC2()
+        self.pool = WarmPool(size=2, client=self.ec2, lease_seconds=60)
+        self.provision = mock.Mock(return_value=([], [], []))
+        patcher = mock.patch.object(state_writer, 'batched', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for target, replacement in (
+            ('register_vps', lambda instance: VPS.objects.create(name=vps_name(instance),
+                                                                 ip_address=instance.ip_address)),
+            ('wait_for_ssh', mock.Mock()),
+            ('ssh_pool', mock.MagicMock()),
+            ('provision_host', self.provision),
+        ):
+            patcher = mock.patch(f'django_deploy.warmpool.{target}', replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Refills started by acquire would run on a thread; the tests call refill() themselves
+        patcher = mock.patch.object(self.pool, 'refill_in_background')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refill_prepares_instances_up_to_size(self):
+        self.assertEqual(self.pool.refill(), 2)
+        self.assertEqual(UserInstance.objects.filter(pool_state='warm', bootstrapped=True).count(), 2)
+        self.assertEqual(set(VPS.objects.values_list('ip_address', flat=True)), {'10.0.0.1', '10.0.0.2'})
+        self.assertEqual(self.pool.refill(), 0)
+
+    def test_refill_counts_instances_another_process_is_preparing(self):
+        other = UserInstance.objects.create(instance_id='i-other', pool_state='bootstrapping', pool_heartbeat_at=now())
+        self.assertEqual(self.pool.refill(), 1)
+        other.refresh_from_db()
+        self.assertEqual(other.pool_state, 'bootstrapping')
+        self.assertNotIn('i-other', self.ec2.terminated)
+
+    def test_refill_discards_instances_with_a_stale_heartbeat(self):
+        stale = UserInstance.objects.create(instance_id='i-stale', pool_state='launching',
+                                            pool_heartbeat_at=now() - timedelta(seconds=61))
+        with self.assertLogs('django_deploy.warmpool', 'WARNING'):
+            self.assertEqual(self.pool.refill(), 2)
+        stale.refresh_from_db()
+        self.assertEqual((stale.pool_state, stale.status), ('failed', 'terminated'))
+        self.assertEqual(self.ec2.terminated, ['i-stale'])
+
+    def test_acquire_claims_the_oldest_warm_instance(self):
+        self.pool.refill()
+        first = UserInstance.objects.filter(pool_state='warm').order_by('started_at').first()
+        instance = self.pool.acquire(mock.Mock())
+        self.assertEqual(instance.pk, first.pk)
+        self.assertEqual(instance.pool_state, 'assigned')
+        self.assertIsNotNone(instance.assigned_at)
+        self.pool.refill_in_background.assert_called_once()
+
+    def test_acquire_launches_on_demand_without_counting_it_towards_the_pool(self):
+        self.pool.size = 1
+        instance = self.pool.acquire(mock.Mock())
+        self.assertEqual((instance.pool_state, instance.bootstrapped), ('assigned', True))
+        self.assertEqual(self.pool.refill(), 1)
+
+    def test_failed_bootstrap_is_logged_and_terminated(self):
+        self.provision.return_value = ([], [{'command': 'sudo apt update'}], [])
+        with self.assertLogs('django_deploy.warmpool', 'ERROR') as logs:
+            self.pool.refill()
+        self.assertEqual(sorted(line.split()[3] for line in logs.output), ['i-0001', 'i-0002'])
+        self.assertEqual(UserInstance.objects.filter(pool_state='failed', status='terminated').count(), 2)
+        self.assertEqual(sorted(self.ec2.terminated), ['i-0001', 'i-0002'])
+        self.assertFalse(VPS.objects.exists())
+
+    def test_discarded_orphan_takes_its_vps_row_along(self):
+        UserInstance.objects.create(instance_id='i-stale', ip_address='10.0.9.1', pool_state='bootstrapping',
+                                    pool_heartbeat_at=now() - timedelta(seconds=61))
+        UserInstance.objects.create(instance_id='i-gone', ip_address='10.0.9.2', pool_state='launching',
+                                    pool_heartbeat_at=now() - timedelta(seconds=61))
+        VPS.objects.create(name='ec2 i-stale', ip_address='10.0.9.1')
+        VPS.objects.create(name='my server', ip_address='10.0.9.2')  # the IP was reused
+        with self.assertLogs('django_deploy.warmpool', 'WARNING'):
+            self.pool.refill()
+        self.assertFalse(VPS.objects.filter(ip_address='10.0.9.1').exists())
+        self.assertTrue(VPS.objects.filter(name='my server').exists())
+
+    def test_heartbeat_renews_the_lease_of_instances_being_prepared(self):
+        instance = UserInstance.objects.create(instance_id='i-mine', pool_state='launching',
+                                               pool_heartbeat_at=now() - timedelta(seconds=59))
+        self.pool._preparing.add(instance.pk)
+        self.pool.beat()
+        instance.refresh_from_db()
+        self.assertGreater(instance.pool_heartbeat_at, now() - timedelta(seconds=5))
+
+
+class StateWriterTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        self.writer = StateWriter(batched=True, retry_delay=0)
+        self.job = DeploymentJob.objects.create(kind='deploy', ip_address='10.0.0.1')
+
+    def test_updates_of_a_row_are_merged(self):
+        self.writer.update(DeploymentJob, self.job.pk, status='running')
+        self.writer.update(DeploymentJob, self.job.pk, step='build')
+        self.writer.flush()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.step), ('running', 'build'))
+
+    def test_failed_update_is_logged_with_model_and_pk(self):
+        with self.assertLogs('django_deploy.state', 'ERROR') as logs:
+            self.writer.update(DeploymentJob, self.job.pk, no_such_field=1)
+            self.writer.flush()
+        self.assertIn(f"DeploymentJob pk={self.job.pk}", logs.output[0])
+        self.assertEqual(self.writer.stats()['errors'], 1)
+
+    def test_batch_is_retried_when_the_commit_fails(self):
+        apply = self.writer._apply
+        failures = [Exception("database is locked")]
+
+        def flaky(batch):
+            if failures:
+                raise failures.pop()
+            return apply(batch)
+
+        with mock.patch.object(self.writer, '_apply', side_effect=flaky), \
+                self.assertLogs('django_deploy.state', 'WARNING'):
+            updated = self.writer.call(DeploymentJob.objects.filter(pk=self.job.pk).update, status='succeeded')
+        self.assertEqual(updated, 1)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'succeeded')
+        self.assertEqual(self.writer.stats()['retries'], 1)
+
+
+class ConnectVpsListTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        VPS.objects.bulk_create([
+            VPS(ip_address=f"10.0.1.{i}", name=f"vps{i}", pem_file_name='key.pem', pem_file_content=b'secret')
+            for i in range(5)
+        ])
+
+    def test_lists_every_vps_without_limit_or_cursor(self):
+        data = self.client.get('/api/django/connect-vps/').json()
+        self.assertEqual([v['name'] for v in data['vps']], [f"vps{i}" for i in range(5)])
+        self.assertIsNone(data['next_cursor'])
+        self.assertNotIn('pem_file_content', data['vps'][0])
+
+    def test_pages_follow_next_cursor(self):
+        names, cursor = [], None
+        while True:
+            params = {'limit': 2, **({'cursor': cursor} if cursor else {})}
+            data = self.client.get('/api/django/connect-vps/', params).json()
+            names += [v['name'] for v in data['vps']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, [f"vps{i}" for i in range(5)])
+
+
+class DockerfileTests(SimpleTestCase):
+    def test_requirement_names_are_normalized(self):
+        requirements = "Django==5.2\npsycopg2>=2.9  # db\n-r base.txt\n\n# comment\nuvicorn[standard]\nMy_Package.Name\n"
+        self.assertEqual(requirement_names(requirements), ['django', 'psycopg2', 'uvicorn', 'my-package-name'])
+
+    def test_runtime_libraries_are_installed_in_the_slim_stage(self):
+        dockerfile = generate_dockerfile('core/core/wsgi.py', requirements=['django', 'psycopg2', 'mysqlclient'])
+        runtime_stage = dockerfile.split('FROM python:3.10-slim', 1)[1]
+        self.assertIn("apt-get install -y --no-install-recommends libmariadb3 libpq5", runtime_stage)
+
+    def test_no_apt_layer_without_native_packages(self):
+        self.assertNotIn('apt-get', generate_dockerfile('core/core/wsgi.py', requirements=['django']))
+
+
+class SSHSessionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = SSHSessionPool()
+        for patcher in (
+            mock.patch('django_deploy.ssh_pool.paramiko.SSHClient', side_effect=mock.MagicMock),
+            mock.patch('django_deploy.ssh_pool.load_private_key', side_effect=lambda pem: pem),
+            mock.patch.object(self.pool, '_ensure_reaper'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.vps = VPS(ip_address='10.0.0.9', pem_file_content=b'old key')
+
+    def test_released_session_is_reused(self):
+        with self.pool.session(self.vps) as first:
+            pass
+        with self.pool.session(self.vps) as second:
+            self.assertIs(second, first)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+
+    def test_session_opened_with_a_replaced_key_is_closed_on_release(self):
+        old = self.pool.acquire(self.vps)
+        self.pool.invalidate(self.vps.ip_address)
+        self.vps.pem_file_content = b'new key'
+        with self.pool.session(self.vps) as new:
+            self.assertIsNot(new, old)
+        self.pool.release(self.vps, old)
+        old.close.assert_called_once()
+        with self.pool.session(self.vps) as again:
+            self.assertIs(again, new)
+
+
+class BatchScriptTests(SimpleTestCase):
+    nonce = 'abc123'
+    begin = b'__DD_BEGIN_abc123_'
+    end = b'__DD_END_abc123_'
+
+    def run_batch(self, commands, stop_on_error=False, chunk=7):
+        """Run the script with the local bash and demux its output, fed in small chunks."""
+        script = build_batch_script(commands, self.nonce, stop_on_error)
+        proc = subprocess.run(['bash', '-s'], input=script.encode(), capture_output=True, timeout=30)
+        out = _StreamDemux(self.begin, self.end, len(commands))
+        err = _StreamDemux(self.begin, self.end, len(commands))
+        for demux, data in ((out, proc.stdout), (err, proc.stderr)):
+            for i in range(0, len(data), chunk):
+                demux.feed(data[i:i + chunk])
+            demux.close()
+        return out, err
+
+    def test_output_and_exit_status_per_command(self):
+        out, err = self.run_batch(["echo one; echo two", "echo oops >&2; exit 3", "printf 'no newline'"])
+        self.assertEqual([out.tails[i].text() for i in range(3)], ['one\ntwo\n', '', 'no newline'])
+        self.assertEqual(err.tails[1].text(), 'oops\n')
+        self.assertEqual([out.results[i][0] for i in range(3)], [0, 3, 0])
+
+    def test_commands_run_in_their_own_subshell(self):
+        out, _ = self.run_batch(["cd /tmp; pwd", "pwd"])
+        self.assertEqual(out.tails[0].text(), '/tmp\n')
+        self.assertNotEqual(out.tails[1].text(), '/tmp\n')
+
+    def test_stop_on_error_skips_the_remaining_commands(self):
+        out, _ = self.run_batch(["false", "echo never"], stop_on_error=True)
+        self.assertEqual(out.results[0][0], 1)
+        self.assertNotIn(1, out.results)
+        self.assertEqual(out.tails[1].text(), '')
+
+    def test_marker_lookalikes_in_the_middle_of_a_line_are_output(self):
+        demux = _StreamDemux(self.begin, self.end, 1)
+        demux.feed(self.begin + b'0\nsee ' + self.end + b'0 1 2\n' + self.end + b'0 0 5\n')
+        self.assertEqual(demux.tails[0].text(), 'see __DD_END_abc123_0 1 2')
+        self.assertEqual(demux.results, {0: (0, 5)})
+
+    def test_long_lines_are_flushed_before_their_newline(self):
+        sink = mock.Mock()
+        demux = _StreamDemux(self.begin, self.end, 1, sink=sink)
+        demux.feed(self.begin + b'0\n' + b'x' * 5000)
+        sink.write.assert_called_once_with(b'x' * 5000)
+
+
+class KeysetPageTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        base = datetime.datetime(2026, 1, 1, 12, 0, 0, 123456, tzinfo=datetime.timezone.utc)
+        for i in range(7):
+            deployment = Deployment.objects.create(ip_address='10.0.2.1', repo_url='https://example.com/r.git',
+                                                   django_root='app', status='deployed')
+            # Pairs share a timestamp, so the id has to break the tie
+            Deployment.objects.filter(pk=deployment.pk).update(deployed_at=base + timedelta(microseconds=i // 2))
+
+    def walk(self, limit):
+        rows, cursor, pages = [], None, 0
+        while True:
+            page, cursor = keyset_page(Deployment.objects.all(), ['-deployed_at', '-id'], ['id'],
+                                       cursor=cursor, limit=limit)
+            rows += page
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        expected = list(Deployment.objects.order_by('-deployed_at', '-id').values('id'))
+        for limit in (1, 2, 3, 7, 10):
+            rows, pages = self.walk(limit)
+            self.assertEqual(rows, expected)
+            self.assertEqual(pages, -(-len(expected) // limit))  # no trailing empty page
+
+    def test_ordering_columns_not_asked_for_are_left_out(self):
+        rows, cursor = keyset_page(Deployment.objects.all(), ['-deployed_at', '-id'], ['id', 'status'], limit=2)
+        self.assertEqual(set(rows[0]), {'id', 'status'})
+        self.assertEqual(len(decode_cursor(cursor)), 2)
+
+    def test_cursor_round_trip_keeps_microseconds(self):
+        at = datetime.datetime(2026, 1, 1, 12, 0, 0, 123457, tzinfo=datetime.timezone.utc)
+        self.assertEqual(decode_cursor(encode_cursor([at, 5])), [at.isoformat(), 5])
+
+    def test_invalid_cursors_are_rejected(self):
+        for cursor in ('not base64!', encode_cursor({'id': 1}), encode_cursor([1]), encode_cursor(['x', 1])):
+            with self.assertRaisesMessage(Exception, "Invalid cursor"):
+                keyset_page(Deployment.objects.all(), ['-deployed_at', '-id'], ['id'], cursor=cursor)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit(None), 100)
+        self.assertEqual(parse_limit(''), 100)
+        self.assertEqual(parse_limit('25'), 25)
+        self.assertEqual(parse_limit(str(MAX_LIMIT)), MAX_LIMIT)
+        for value in ('0', str(MAX_LIMIT + 1), '-3', 'ten'):
+            with self.assertRaises(Exception):
+                parse_limit(value)
+
+
+class TuneGunicornTests(SimpleTestCase):
+    def host(self, cpus, memory_mb, asgi=False):
+        return {'cpus': cpus, 'memory_mb': memory_mb, 'asgi': asgi, 'requirements': []}
+
+    def test_sync_workers_when_they_fit_in_memory(self):
+        config = tune_gunicorn(self.host(2, 4096))
+        self.assertEqual((config['workers'], config['worker_class'], config['threads']), (5, 'sync', 1))
+        self.assertGreater(config['keep_alive'], 60)  # above nginx's upstream keepalive_timeout
+
+    def test_gthread_makes_up_for_workers_memory_cannot_hold(self):
+        config = tune_gunicorn(self.host(4, 1024))
+        self.assertEqual((config['workers'], config['worker_class'], config['threads']), (4, 'gthread', 6))
+        config = tune_gunicorn(self.host(1, 256))
+        self.assertEqual((config['workers'], config['worker_class'], config['threads']), (1, 'gthread', 6))
+
+    def test_asgi_projects_get_one_uvicorn_worker_per_cpu(self):
+        config = tune_gunicorn(self.host(4, 8192, asgi=True))
+        self.assertEqual((config['workers'], config['worker_class']), (4, 'uvicorn'))
+        self.assertIn('core.asgi:application', gunicorn_command('core', config))
+
+    def test_unknown_memory_and_cpus_fall_back_to_the_cpu_formula(self):
+        self.assertEqual(tune_gunicorn(self.host(0, 0))['workers'], 3)
+
+    def test_overrides_win_and_blank_ones_are_ignored(self):
+        config = tune_gunicorn(self.host(2, 4096), {'workers': '3', 'worker_class': 'gthread', 'threads': ''})
+        self.assertEqual((config['workers'], config['worker_class'], config['threads']), (3, 'gthread', 1))
+        self.assertIn('--threads 1', gunicorn_command('core', config))
+        with self.assertRaisesMessage(Exception, "Unknown worker_class 'gevent'"):
+            tune_gunicorn(self.host(2, 4096), {'worker_class': 'gevent'})
+
+
+class PlanBootstrapTests(SimpleTestCase):
+    images = ['python:3.10', 'python:3.10-slim']
+
+    def state(self, **overrides):
+        ready = {
+            'versions': {**{p: '1.0' for p in PACKAGES}, 'docker-compose-plugin': '2.0'},
+            'apt_index_age': 60,
+            'docker_enabled': True,
+            'docker_active': True,
+            'images': list(self.images),
+        }
+        return {**ready, **overrides}
+
+    def plan(self, state, force=False):
+        steps, skipped = plan_bootstrap(state, self.images, force, apt_max_age=3600)
+        return [step for step, _ in steps], {s['step']: s['reason'] for s in skipped}
+
+    def test_ready_host_skips_every_step(self):
+        steps, skipped = self.plan(self.state())
+        self.assertEqual(steps, [])
+        self.assertEqual(skipped['apt_update'], 'all packages already installed')
+        self.assertEqual(skipped['install_compose'], 'docker-compose-plugin 2.0 already installed')
+        self.assertEqual(skipped['start_docker'], 'docker service already running')
+        self.assertIn('python:3.10-slim', skipped['prefetch_images'])
+
+    def test_missing_package_with_a_fresh_index_skips_apt_update(self):
+        versions = {p: '1.0' for p in PACKAGES if p != 'nginx'}
+        steps, skipped = self.plan(self.state(versions={**versions, 'docker-compose': '1.29'}))
+        self.assertEqual(steps, ['install_packages'])
+        self.assertEqual(skipped['apt_update'], 'package index is 1 min old')
+
+    def test_stale_or_unknown_index_is_updated(self):
+        for age in (7200, None):
+            steps, _ = self.plan(self.state(versions={}, apt_index_age=age))
+            self.assertEqual(steps[:3], ['apt_update', 'install_packages', 'install_compose'])
+
+    def test_stopped_docker_and_missing_images(self):
+        steps, skipped = self.plan(self.state(docker_active=False, images=['python:3.10']))
+        self.assertEqual(steps, ['start_docker', 'prefetch_images'])
+        self.assertEqual(skipped['enable_docker'], 'docker service already enabled')
+        plan, _ = plan_bootstrap(self.state(images=[]), self.images, apt_max_age=3600)
+        self.assertIn(shlex.quote(prefetch_script(['python:3.10', 'python:3.10-slim'])), plan[0][1][0])
+
+    def test_prefetch_pulls_every_image_even_after_a_failure(self):
+        with tempfile.TemporaryDirectory() as bin_dir:
+            with open(f"{bin_dir}/docker", 'w') as f:
+                f.write('#!/bin/sh\necho "pull $2" >> "$(dirname "$0")/pulls"\n[ "$2" != "nosuch:1" ] || exit 3\n')
+            os.chmod(f"{bin_dir}/docker", 0o755)
+            result = subprocess.run(['sh', '-c', prefetch_script(['python:3.10', 'nosuch:1', 'node:18'])],
+                                    capture_output=True, text=True, env={'PATH': f"{bin_dir}:/usr/bin:/bin"})
+            with open(f"{bin_dir}/pulls") as f:
+                self.assertEqual(f.read().split('\n')[:3], ['pull python:3.10', 'pull nosuch:1', 'pull node:18'])
+        self.assertEqual(result.stdout.splitlines(), [
+            'prefetch: pulled python:3.10', 'prefetch: failed to pull nosuch:1 (exit 3)', 'prefetch: pulled node:18',
+        ])
+
+    def test_force_runs_every_install_step(self):
+        steps, skipped = self.plan(self.state(), force=True)
+        self.assertEqual(steps, ['apt_update', 'install_packages', 'install_compose', 'enable_docker', 'start_docker'])
+        self.assertEqual(list(skipped), ['prefetch_images'])
+
+
+class ParseDockerPsTests(SimpleTestCase):
+    def test_records_from_json_lines(self):
+        web = {
+            'ID': 'abc123', 'Names': 'shop-web-1', 'Image': 'shop-web', 'State': 'running', 'Status': 'Up 2 hours',
+            'Ports': '0.0.0.0:8000->8000/tcp', 'CreatedAt': '2026-01-01 12:00:00 +0000 UTC',
+            'Labels': 'com.docker.compose.project=shop,com.docker.compose.service=web,maintainer=a=b',
+        }
+        output = "\n".join([
+            json.dumps(web),
+            "",
+            "WARNING: not json",
+            json.dumps(['not', 'a', 'container']),
+            json.dumps({'ID': 'def456', 'Names': 'lonely', 'State': 'exited'}),
+        ])
+        records = parse_docker_ps(output)
+        self.assertEqual([r.id for r in records], ['abc123', 'def456'])
+        self.assertEqual((records[0].project, records[0].service), ('shop', 'web'))
+        self.assertEqual(records[0].as_dict()['Ports'], '0.0.0.0:8000->8000/tcp')
+        self.assertEqual(records[1], ContainerRecord('def456', 'lonely', '', 'exited', '', '', '', '', ''))
+
+    def test_empty_output(self):
+        self.assertEqual(parse_docker_ps(''), [])
+
+
+class ContainerInventoryTests(StandInTestCase):
+    containers = 500  # ~120 KB of docker ps output, more than run_script's default tail
+
+    def test_refresh_reads_the_whole_docker_ps_output(self):
+        snapshot = ContainerInventory().refresh(self.vps)
+        self.assertEqual(len(snapshot.records), 500)
+        self.assertEqual(snapshot.records[0].names, 'bench_web_1')
+
+    def test_truncated_output_fails_instead_of_being_cached(self):
+        inventory = ContainerInventory()
+        with mock.patch('django_deploy.inventory.FULL_OUTPUT_BYTES', 64 * 1024):
+            with self.assertRaisesMessage(Exception, "larger than 65536 bytes"):
+                inventory.refresh(self.vps)
+        self.assertEqual(inventory._snapshots, {})
+
+    def list_containers(self, **params):
+        return self.client.get('/api/django/docker-containers/', dict(params, ip=self.vps.ip_address)).json()
+
+    def test_pages(self):
+        page = self.list_containers(page=2, page_size=200)
+        self.assertEqual((page['count'], page['page'], page['page_size']), (500, 2, 200))
+        self.assertEqual(len(page['containers']), 200)
+        self.assertEqual(page['containers'][0]['Names'], 'bench_web_201')
+        self.assertEqual(len(self.list_containers(page=3, page_size=200)['containers']), 100)
+        self.assertEqual(len(self.list_containers()['containers']), 500)
+
+    def test_page_and_page_size_below_one_are_rejected(self):
+        for params in ({'page': 0}, {'page': -1}, {'page_size': 0}, {'page_size': -5}, {'page': 2, 'page_size': -1}):
+            with self.subTest(**params):
+                self.assertEqual(self.list_containers(**params),
+                                 {'status': 'error', 'message': 'page and page_size must be at least 1'})
+        self.assertEqual(self.list_containers(page='two')['message'], 'page and page_size must be integers')
+
+
+class MetricsTests(TestCase):
+    base = datetime.datetime(2026, 1, 1, 10, 0, tzinfo=datetime.timezone.utc)
+
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        patcher = mock.patch.object(state_writer, 'batched', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sample(self, seconds, load1, resolution='raw', samples=1):
+        return HostMetric.objects.create(
+            ip_address='10.0.3.1', resolution=resolution, bucket=self.base + timedelta(seconds=seconds),
+            samples=samples, load1=load1, load5=load1, mem_used_mb=512, mem_total_mb=1024,
+            disk_used_gb=10, disk_total_gb=20,
+        )
+
+    def buckets(self, resolution):
+        return list(HostMetric.objects.filter(resolution=resolution).order_by('bucket')
+                    .values_list('bucket', 'load1', 'samples'))
+
+    def test_hours_are_weighted_by_the_samples_of_each_minute(self):
+        self.sample(10, 1)
+        self.sample(40, 3)
+        self.sample(70, 5)
+        downsample(self.base + timedelta(minutes=2, seconds=30))
+        self.assertEqual(self.buckets('1m'), [(self.base, 2.0, 2), (self.base + timedelta(minutes=1), 5.0, 1)])
+        self.assertEqual(self.buckets('1h'), [])  # the hour isn't complete yet
+        downsample(self.base + timedelta(hours=1, seconds=30))
+        self.assertEqual(self.buckets('1h'), [(self.base, 3.0, 3)])  # (2 * 2 + 5) / 3, not (2 + 5) / 2
+
+    def test_rollup_resumes_after_the_newest_bucket(self):
+        self.sample(10, 1)
+        downsample(self.base + timedelta(minutes=1, seconds=30))
+        self.sample(20, 100)  # late sample for a minute already rolled up: left out
+        self.sample(130, 4)
+        downsample(self.base + timedelta(minutes=3))
+        self.assertEqual(self.buckets('1m'), [(self.base, 1.0, 1), (self.base + timedelta(minutes=2), 4.0, 1)])
+        downsample(self.base + timedelta(minutes=3))
+        self.assertEqual(len(self.buckets('1m')), 2)
+
+    def test_prune_keeps_each_resolution_for_its_retention(self):
+        at = self.base + timedelta(days=2)
+        self.sample(0, 1)  # raw, 2 days old: past 24h
+        self.sample(0, 1, resolution='1m')  # kept 7 days
+        self.sample(24 * 3600 + 60, 1)  # raw, under 24h old
+        ContainerMetric.objects.create(ip_address='10.0.3.1', container='web', bucket=self.base,
+                                       cpu_pct=1, mem_used_mb=1, mem_pct=1)
+        self.assertEqual(prune(at), 2)
+        self.assertEqual(sorted(HostMetric.objects.values_list('resolution', flat=True)), ['1m', 'raw'])
+        self.assertFalse(ContainerMetric.objects.exists())
+
+    @override_settings(METRICS_INTERVAL=10)
+    def test_pick_resolution(self):
+        self.assertEqual(pick_resolution(timedelta(hours=2)), 'raw')  # 720 points
+        self.assertEqual(pick_resolution(timedelta(hours=3)), '1m')
+        self.assertEqual(pick_resolution(timedelta(hours=12)), '1m')
+        self.assertEqual(pick_resolution(timedelta(hours=13)), '1h')
+        self.assertEqual(pick_resolution(timedelta(days=30)), '1h')
+
+
+class CollectHostTests(StandInTestCase):
+    containers = 800  # ~110 KB of docker stats output
+
+    def test_every_container_of_a_large_host_is_sampled(self):
+        with mock.patch.object(state_writer, 'batched', False):
+            self.assertEqual(collect_host(self.vps), 800)
+        self.assertEqual(ContainerMetric.objects.filter(ip_address=self.vps.ip_address).count(), 800)
+        self.assertEqual(HostMetric.objects.filter(ip_address=self.vps.ip_address).count(), 1)
+
+    def test_truncated_docker_stats_fails_the_sample(self):
+        with mock.patch('django_deploy.metrics.FULL_OUTPUT_BYTES', 64 * 1024):
+            with self.assertRaisesMessage(Exception, "docker stats output"):
+                collect_host(self.vps)
+        self.assertFalse(HostMetric.objects.exists())
+
+
+class SecondsBetweenTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def test_sqlite_difference_in_seconds(self):
+        start = datetime.datetime(2026, 1, 1, 23, 59, 59, 500000, tzinfo=datetime.timezone.utc)
+        instance = UserInstance.objects.create(instance_id='i-sb')
+        UserInstance.objects.filter(pk=instance.pk).update(started_at=start, stopped_at=start + timedelta(hours=25, seconds=1.25))
+        seconds = UserInstance.objects.annotate(s=SecondsBetween('started_at', 'stopped_at')).get(pk=instance.pk).s
+        self.assertAlmostEqual(seconds, 25 * 3600 + 1.25, places=2)
+
+    def test_sql_per_backend(self):
+        compiler = mock.Mock()
+        compiler.compile.side_effect = lambda expression: (
+            ('"stopped_at"', ['end']) if getattr(expression, 'name', None) == 'stopped_at' else ('%s', ['start']))
+        expression = SecondsBetween(Value(now()), F('stopped_at'))
+        expected = {
+            'as_sql': 'CAST(EXTRACT(EPOCH FROM ("stopped_at" - %s)) AS DOUBLE PRECISION)',
+            'as_sqlite': '((julianday("stopped_at") - julianday(%s)) * 86400.0)',
+            'as_mysql': '(-TIMESTAMPDIFF(MICROSECOND, "stopped_at", %s) / 1000000.0)',
+        }
+        for method, sql in expected.items():
+            self.assertEqual(getattr(expression, method)(compiler, connection), (sql, ('end', 'start')))
+
+
+class UsageTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def instance(self, instance_id, started_at, stopped_at=None, rate='1.000', status=None):
+        instance = UserInstance.objects.create(instance_id=instance_id, hourly_rate=rate)
+        UserInstance.objects.filter(pk=instance.pk).update(
+            started_at=started_at, stopped_at=stopped_at, status=status or ('terminated' if stopped_at else 'running'))
+        return instance
+
+    def test_rollup_day_clips_instances_to_the_day(self):
+        day = datetime.date(2026, 3, 10)
+        midnight = datetime.datetime(2026, 3, 10, tzinfo=datetime.timezone.utc)
+        self.instance('i-across', midnight - timedelta(hours=2), midnight + timedelta(hours=2))
+        self.instance('i-ends-at-midnight', midnight - timedelta(hours=5), midnight)
+        self.instance('i-whole-day', midnight - timedelta(days=3), rate='0.500')
+        self.instance('i-next-day', midnight + timedelta(days=1, hours=1))
+        self.assertEqual(rollup_day(day), 2)
+        usage = {row.instance.instance_id: (row.runtime_seconds, row.cost) for row in InstanceUsageDaily.objects.all()}
+        self.assertEqual(set(usage), {'i-across', 'i-whole-day'})
+        self.assertAlmostEqual(usage['i-across'][0], 2 * 3600, places=1)
+        self.assertAlmostEqual(usage['i-whole-day'][0], 24 * 3600, places=1)
+        self.assertAlmostEqual(usage['i-whole-day'][1], 12.0, places=3)
+        self.assertEqual(rollup_day(day), 2)  # rewritten, not duplicated
+        self.assertEqual(InstanceUsageDaily.objects.count(), 2)
+
+    def test_live_report_matches_the_rolled_up_one(self):
+        today = now().date()
+        midnight = datetime.datetime.combine(today, datetime.time(), tzinfo=datetime.timezone.utc)
+        self.instance('i-a', midnight - timedelta(days=3, hours=6), midnight - timedelta(days=1, hours=12), rate='0.500')
+        self.instance('i-b', midnight - timedelta(hours=2))
+        self.instance('i-c', midnight - timedelta(days=40), midnight - timedelta(days=38))
+        # Up to yesterday: today's numbers grow between the two reports
+        since, until = today - timedelta(days=45), today - timedelta(days=1)
+        for group_by in ('day', 'status', 'instance'):
+            with self.subTest(group_by=group_by):
+                InstanceUsageDaily.objects.all().delete()
+                # last rolled day, earliest start, then one query per 31 live days
+                with self.assertNumQueries(4):
+                    live = usage_report(since, until, group_by)
+                rollup_closed_days()
+                rolled = usage_report(since, until, group_by)
+                self.assertEqual(live['rows'], rolled['rows'])
+                self.assertAlmostEqual(live['total_runtime_hours'], rolled['total_runtime_hours'], places=1)
+        by_status = {row['status']: row for row in usage_report(since, until, 'status')['rows']}
+        self.assertEqual(by_status['terminated']['instance_days'], 3 + 2)
+        self.assertEqual(by_status['running']['instance_days'], 1)
+
+
+class HealthCheckCommandTests(SimpleTestCase):
+    def run_check(self, code):
+        """Run the health check locally with a curl that always answers `code`."""
+        with tempfile.TemporaryDirectory() as bin_dir:
+            with open(f"{bin_dir}/curl", 'w') as f:
+                f.write(f"#!/bin/sh\necho {code}\n")
+            subprocess.run(['chmod', '+x', f"{bin_dir}/curl"], check=True)
+            return subprocess.run(['bash', '-c', _health_check_command(8001, 'example.com', timeout=1)],
+                                  capture_output=True, text=True, env={'PATH': f"{bin_dir}:/usr/bin:/bin"})
+
+    def test_answers_below_500_are_healthy(self):
+        for code in ('200', '302', '404'):
+            with self.subTest(code=code):
+                result = self.run_check(code)
+                self.assertEqual(result.returncode, 0)
+                self.assertEqual(result.stdout.strip(), f"healthy: HTTP {code}")
+
+    def test_errors_and_refused_connections_time_out(self):
+        for code in ('500', '502', '000'):
+            with self.subTest(code=code):
+                result = self.run_check(code)
+                self.assertEqual(result.returncode, 1)
+                self.assertIn(f"port 8001 did not become healthy within 1s (last: HTTP {code})", result.stderr)
+
+    def test_server_name_and_path_are_quoted(self):
+        command = _health_check_command(8000, "a b'c", path='/health?x=1&y=2')
+        self.assertIn("'Host: a b'\"'\"'c'", command)
+        self.assertIn("'http://127.0.0.1:8000/health?x=1&y=2'", command)
+
+
+class TrafficProbeTests(StandInTestCase):
+    def test_stop_counts_requests_and_failures(self):
+        probe_id = secrets.token_hex(4)
+        with open(f"/tmp/devdeploy-probe-{probe_id}.log", 'w') as f:
+            f.write("200\n000\n302\n502\n404\n")
+        with ssh_pool.session(self.vps) as ssh:
+            self.assertEqual(_stop_traffic_probe(ssh, probe_id), {'requests': 5, 'failed': 2})
+        self.assertFalse(os.path.exists(f"/tmp/devdeploy-probe-{probe_id}.log"))
+
+    def test_probe_runs_in_the_background_until_stopped(self):
+        probe_id = secrets.token_hex(4)
+        with ssh_pool.session(self.vps) as ssh:
+            _start_traffic_probe(ssh, 'example.com', probe_id)
+            self.assertTrue(os.path.exists(f"/tmp/devdeploy-probe-{probe_id}.run"))
+            # Wait for the first request rather than a fixed time, the loop starts in the background
+            log, deadline = f"/tmp/devdeploy-probe-{probe_id}.log", time.monotonic() + 10
+            while not (os.path.exists(log) and os.path.getsize(log)) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            probe = _stop_traffic_probe(ssh, probe_id)
+        self.assertGreater(probe['requests'], 0)
+        self.assertFalse(os.path.exists(f"/tmp/devdeploy-probe-{probe_id}.run"))
+
+    def test_no_log_means_no_requests(self):
+        with ssh_pool.session(self.vps) as ssh:
+            self.assertEqual(_stop_traffic_probe(ssh, secrets.token_hex(4)), {'requests': 0, 'failed': 0})
+
+
+class BlueGreenSwitchTests(SimpleTestCase):
+    def switch(self, health_ok=True, nginx_error=None):
+        """Run _bluegreen_switch from blue with every remote step replaced by a recorded call."""
+        calls = []
+
+        def run_script(ssh, commands, sink=None, stop_on_error=False):
+            calls.append(('run', commands))
+            failed = [] if health_ok or len(commands) < 3 else [{'command': commands[-1], 'stderr': 'unhealthy'}]
+            details = [{'command': c, 'exit_status': 1 if failed and c == commands[-1] else 0} for c in commands]
+            return details, failed
+
+        def upload(ssh, conf, server_name):
+            calls.append(('nginx', 'server 127.0.0.1:8001;' in conf))
+            if nginx_error:
+                raise nginx_error
+            return {'changed': True, 'reloaded': True}
+
+        with mock.patch('django_deploy.pipelines.run_script', run_script), \
+                mock.patch('django_deploy.pipelines.upload_and_enable_nginx_conf', upload), \
+                mock.patch('django_deploy.pipelines.set_active_color',
+                           lambda ssh, path, color: calls.append(('color', color))), \
+                mock.patch('django_deploy.pipelines._start_traffic_probe', lambda *a: calls.append(('probe', 'start'))), \
+                mock.patch('django_deploy.pipelines._stop_traffic_probe',
+                           lambda *a: calls.append(('probe', 'stop')) or {'requests': 10, 'failed': 0}):
+            try:
+                result = _bluegreen_switch(None, '/home/ubuntu/shop/app', 'blue', 'example.com')
+            except Exception as e:
+                result = e
+        return result, calls
+
+    def test_nginx_switches_after_green_is_healthy_and_before_blue_stops(self):
+        result, calls = self.switch()
+        self.assertEqual(result['color'], 'green')
+        self.assertEqual(result['probe'], {'requests': 10, 'failed': 0})
+        self.assertEqual([kind for kind, _ in calls], ['run', 'probe', 'nginx', 'color', 'run', 'probe'])
+        self.assertIn('-p appgreen up --build -d', calls[0][1][1])
+        self.assertIn('127.0.0.1:8001', calls[0][1][2])  # health check against green
+        self.assertTrue(calls[2][1])  # nginx points at green's port
+        self.assertEqual(calls[3][1], 'green')
+        self.assertIn('docker-compose down --timeout 30', calls[4][1][1])  # blue, compose's default project
+
+    def test_unhealthy_green_is_stopped_and_blue_keeps_serving(self):
+        result, calls = self.switch(health_ok=False)
+        self.assertEqual((result['status'], result['color']), ('error', 'blue'))
+        self.assertEqual([kind for kind, _ in calls], ['run', 'run'])
+        self.assertEqual(calls[1][1], [f"{compose_command('/home/ubuntu/shop/app', 'green')} down"])
+
+    def test_failed_nginx_switch_stops_green_and_keeps_blue(self):
+        result, calls = self.switch(nginx_error=Exception("nginx -t failed"))
+        self.assertEqual(str(result), "nginx -t failed")
+        self.assertEqual([kind for kind, _ in calls], ['run', 'probe', 'nginx', 'run', 'probe'])
+        self.assertEqual(calls[3][1], [f"{compose_command('/home/ubuntu/shop/app', 'green')} down"])
+
+
+class RedeployRecordTests(StandInTestCase):
+    repo_url = 'https://example.com/shop.git'
+    files = {'Dockerfile': 'FROM python\n', '.dockerignore': '.git\n', 'docker-compose.yml': 'services: {}\n'}
+
+    def setUp(self):
+        patcher = mock.patch.object(state_writer, 'batched', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = self.host_path('/home/ubuntu/shop/app')
+        os.makedirs(self.app, exist_ok=True)
+        for name, content in dict(self.files, **{'.env': 'DEBUG=0\n'}).items():
+            self.write(name, content)
+
+    def write(self, name, content):
+        with open(f"{self.app}/{name}", 'w') as f:
+            f.write(content)
+
+    def redeploy(self):
+        return redeploy_on_host(mock.Mock(), self.vps.ip_address, self.repo_url, 'app', strategy='inplace')
+
+    def test_redeploy_is_recorded_and_skipped_until_something_changes(self):
+        result = self.redeploy()
+        self.assertEqual((result['status'], result['build_skipped']), ('success', False))
+        deployment = Deployment.objects.get(pk=result['deployment_id'])
+        self.assertEqual(deployment.fingerprint, deployment_fingerprint(COMMIT_SHA, self.files, 'DEBUG=0\n'))
+        self.assertEqual((deployment.status, deployment.color, deployment.commit_sha), ('deployed', 'blue', COMMIT_SHA))
+        self.assertEqual([p['name'] for p in result['phases']], ['connect', 'build'])
+        self.assertEqual(deployment.phases.count(), 2)
+
+        self.assertTrue(self.redeploy()['build_skipped'])
+
+        self.write('.env', 'DEBUG=1\n')
+        changed = self.redeploy()
+        self.assertFalse(changed['build_skipped'])
+        self.assertNotEqual(changed['fingerprint'], deployment.fingerprint)
+        self.assertTrue(self.redeploy()['build_skipped'])
+
+    def test_failed_redeploy_is_not_the_last_deployed_fingerprint(self):
+        self.redeploy()
+        self.write('Dockerfile', 'FROM python:3.12\n')
+
+        def failing_build(ssh, commands, *args, **kwargs):
+            return run_script(ssh, [c.replace('up --build -d', 'up --build -d && false') for c in commands],
+                              *args, **kwargs)
+
+        with mock.patch('django_deploy.pipelines.run_script', failing_build):
+            failed = self.redeploy()
+        self.assertEqual(failed['status'], 'error')
+        self.assertEqual(Deployment.objects.get(pk=failed['deployment_id']).status, 'failed')
+        self.assertEqual(failed['phases'][-1]['exit_code'], 1)
+        # The containers are up, but the build that started them failed: not a reason to skip
+        self.assertFalse(self.redeploy()['build_skipped'])
+
+    def test_unexpected_errors_are_recorded_as_failed(self):
+        with mock.patch('django_deploy.pipelines.run_script', side_effect=Exception("connection lost")):
+            with self.assertRaisesMessage(Exception, "connection lost"):
+                self.redeploy()
+        self.assertEqual(list(Deployment.objects.values_list('status', flat=True)), ['failed'])
+
+
+class DeploymentFingerprintTests(TestCase):
+    files = {'Dockerfile': 'FROM python\n', 'docker-compose.yml': 'services: {}\n'}
+
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def test_commit_artifacts_and_env_each_change_the_fingerprint(self):
+        base = deployment_fingerprint('a' * 40, self.files, 'DEBUG=0\n')
+        self.assertEqual(base, deployment_fingerprint('a' * 40, dict(reversed(self.files.items())), 'DEBUG=0\n'))
+        changed = [
+            deployment_fingerprint('c' * 40, self.files, 'DEBUG=0\n'),
+            deployment_fingerprint('a' * 40, dict(self.files, Dockerfile='FROM python:3.12\n'), 'DEBUG=0\n'),
+            deployment_fingerprint('a' * 40, dict(self.files, **{'.dockerignore': '.git\n'}), 'DEBUG=0\n'),
+            deployment_fingerprint('a' * 40, self.files, 'DEBUG=1\n'),
+            deployment_fingerprint('a' * 40, self.files),
+        ]
+        self.assertEqual(len({base, *changed}), len(changed) + 1)
+
+    def test_names_and_contents_do_not_run_together(self):
+        self.assertNotEqual(deployment_fingerprint('a', {'ab': 'c'}), deployment_fingerprint('a', {'a': 'bc'}))
+
+    def deployment(self, fingerprint, minutes_ago, status='deployed', **fields):
+        fields = dict(dict(ip_address='10.0.4.1', repo_url='https://example.com/shop.git', django_root='app'),
+                      **fields)
+        deployment = Deployment.objects.create(fingerprint=fingerprint, status=status, **fields)
+        # deployed_at is auto_now_add, so it is set afterwards
+        Deployment.objects.filter(pk=deployment.pk).update(deployed_at=now() - timedelta(minutes=minutes_ago))
+
+    def test_last_deployed_fingerprint_skips_failed_deploys(self):
+        self.deployment('old', 30)
+        self.deployment('good', 20)
+        self.deployment('broken', 10, status='failed')
+        self.deployment('other-host', 5, ip_address='10.0.4.2')
+        self.deployment('other-root', 5, django_root='api')
+        self.assertEqual(last_deployed_fingerprint('10.0.4.1', 'https://example.com/shop.git', 'app'), 'good')
+
+    def test_no_successful_deploy_means_no_fingerprint(self):
+        self.deployment('broken', 1, status='failed')
+        self.assertIsNone(last_deployed_fingerprint('10.0.4.1', 'https://example.com/shop.git', 'app'))
+
+
+class TransferTests(StandInTestCase):
+    def read(self, path, mode='r'):
+        with open(self.host_path(path), mode) as f:
+            return f.read()
+
+    def test_upload_files_round_trip(self):
+        files = {'Dockerfile': 'FROM python\n', 'nested/dir/.env': 'DEBUG=0\n', 'blob.bin': bytes(range(256)) * 64}
+        with ssh_pool.session(self.vps) as ssh:
+            result = upload_files(ssh, '/home/ubuntu/shop/app', files)
+        self.assertEqual((result['files'], result['bytes']), (3, 12 + 8 + 256 * 64))
+        self.assertLess(result['wire_bytes'], result['bytes'])
+        self.assertEqual(self.read('/home/ubuntu/shop/app/Dockerfile'), 'FROM python\n')
+        self.assertEqual(self.read('/home/ubuntu/shop/app/nested/dir/.env'), 'DEBUG=0\n')
+        self.assertEqual(self.read('/home/ubuntu/shop/app/blob.bin', 'rb'), files['blob.bin'])
+        # The manifest is removed once checked
+        self.assertEqual(sorted(os.listdir(self.host_path('/home/ubuntu/shop/app'))),
+                         ['Dockerfile', 'blob.bin', 'nested'])
+
+    def test_upload_directory_round_trip(self):
+        with tempfile.TemporaryDirectory() as local:
+            os.makedirs(f"{local}/static/css")
+            with open(f"{local}/static/css/site.css", 'w') as f:
+                f.write('body {}\n')
+            with open(f"{local}/run.sh", 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(f"{local}/run.sh", 0o755)
+            os.symlink('static/css/site.css', f"{local}/latest.css")
+            with ssh_pool.session(self.vps) as ssh:
+                result = upload_directory(ssh, local, '/home/ubuntu/site')
+        self.assertEqual((result['files'], result['bytes']), (2, 18))
+        self.assertEqual(self.read('/home/ubuntu/site/static/css/site.css'), 'body {}\n')
+        self.assertEqual(os.stat(self.host_path('/home/ubuntu/site/run.sh')).st_mode & 0o777, 0o755)
+        self.assertEqual(os.readlink(self.host_path('/home/ubuntu/site/latest.css')), 'static/css/site.css')
+
+    def test_manifest_mismatch_fails_the_upload(self):
+        def corrupted(files):
+            for info, fileobj, digest in _members_from_files(files):
+                yield info, fileobj, '0' * 64
+
+        with mock.patch('django_deploy.transfer._members_from_files', corrupted):
+            with ssh_pool.session(self.vps) as ssh:
+                with self.assertRaisesMessage(Exception, "Upload to /home/ubuntu/shop/app failed (exit 1)"):
+                    upload_files(ssh, '/home/ubuntu/shop/app', {'Dockerfile': 'FROM python\n'})
+
+    def test_remote_errors_are_reported(self):
+        with open(self.host_path('/home/ubuntu/not-a-dir'), 'w') as f:
+            f.write('')
+        with ssh_pool.session(self.vps) as ssh:
+            with self.assertRaisesMessage(Exception, "Upload to /home/ubuntu/not-a-dir/app failed"):
+                upload_files(ssh, '/home/ubuntu/not-a-dir/app', {'Dockerfile': 'FROM python\n'})
+            # The same connection still works afterwards
+            self.assertEqual(upload_files(ssh, '/home/ubuntu/ok', {'a': 'b'})['files'], 1)
+
+    def test_names_outside_the_target_are_refused(self):
+        for name in ('../escape', '/etc/passwd', 'a/../../b', ''):
+            with self.subTest(name=name):
+                with self.assertRaisesMessage(Exception, "not a plain relative path"):
+                    upload_files(None, '/home/ubuntu/shop', {name: 'x'})
+
+
+class NginxSitesTests(StandInTestCase):
+    def setUp(self):
+        sites = tempfile.TemporaryDirectory(prefix='devdeploy-nginx-')
+        self.addCleanup(sites.cleanup)
+        self.available, self.enabled = f"{sites.name}/sites-available", f"{sites.name}/sites-enabled"
+        os.makedirs(self.available)
+        os.makedirs(self.enabled)
+        for name, value in (('SITES_AVAILABLE', self.available), ('SITES_ENABLED', self.enabled)):
+            patcher = mock.patch(f'django_deploy.nginx.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # nginx that logs its arguments and fails `-t` while any site says "broken"
+        self.calls = f"{sites.name}/nginx-calls"
+        shim = f"{self.standin.root}/bin/nginx"
+        with open(shim) as f:
+            self.addCleanup(self.write_shim, shim, f.read())
+        self.write_shim(shim, f'#!/bin/bash\necho "$*" >> {self.calls}\n'
+                                   f'if [ "$1" = "-t" ] && grep -rqs broken {self.available}; then\n'
+                                   '    echo "nginx: [emerg] unknown directive" >&2; exit 1\nfi\n')
+
+    @staticmethod
+    def write_shim(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def nginx_tests(self):
+        with open(self.calls) as f:
+            return f.read().split('\n').count('-t')
+
+    def apply(self, **sites):
+        with ssh_pool.session(self.vps) as ssh:
+            staged = NginxSites(ssh)
+            for name, conf in sites.items():
+                staged.stage(name, conf)
+            return staged.apply()
+
+    def read(self, name):
+        with open(f"{self.available}/{name}") as f:
+            return f.read()
+
+    def test_only_changed_sites_are_written_and_tested_once(self):
+        result = self.apply(shop='server {}\n', blog='server {}\n')
+        self.assertEqual((sorted(result['changed']), result['reloaded']), (['blog', 'shop'], True))
+        self.assertEqual(self.nginx_tests(), 1)
+        self.assertEqual(os.readlink(f"{self.enabled}/shop"), f"{self.available}/shop")
+
+        self.assertEqual(self.apply(shop='server {}\n', blog='server {}\n'),
+                         {'changed': [], 'unchanged': ['shop', 'blog'], 'reloaded': False})
+        self.assertEqual(self.nginx_tests(), 1)
+
+        result = self.apply(shop='server { listen 80; }\n', blog='server {}\n')
+        self.assertEqual((result['changed'], result['unchanged']), (['shop'], ['blog']))
+        self.assertEqual(self.nginx_tests(), 2)
+        self.assertEqual(self.read('shop'), 'server { listen 80; }\n')
+
+    def test_disabled_site_is_enabled_again(self):
+        self.apply(shop='server {}\n')
+        os.remove(f"{self.enabled}/shop")
+        self.assertEqual(self.apply(shop='server {}\n')['changed'], ['shop'])
+        self.assertTrue(os.path.islink(f"{self.enabled}/shop"))
+
+    def test_failed_test_restores_every_written_site(self):
+        self.apply(shop='server {}\n')
+        with self.assertRaisesMessage(Exception, "Failed to run 'sudo nginx -t': nginx: [emerg] unknown directive"):
+            self.apply(shop='broken\n', blog='server {}\n')
+        self.assertEqual(self.read('shop'), 'server {}\n')
+        self.assertEqual(os.readlink(f"{self.enabled}/shop"), f"{self.available}/shop")
+        self.assertEqual(os.listdir(self.available), ['shop'])  # no new site, no backup left behind
+        self.assertEqual(os.listdir(self.enabled), ['shop'])
+        self.assertEqual(self.nginx_tests(), 2)
+
+
+class SystemNginxConfTests(SimpleTestCase):
+    def conf(self, **overrides):
+        profile = merge_profile(DEFAULT_PROXY_PROFILE, {'proxy_profile': overrides}, 'proxy_profile')
+        return generate_system_nginx_conf('shop.example.com', proxy_port=8001, profile=profile)
+
+    def test_upstream_keeps_connections_alive(self):
+        conf = self.conf(keepalive=8)
+        self.assertIn("upstream devdeploy_shop_example_com {\n    server 127.0.0.1:8001;\n    keepalive 8;", conf)
+        self.assertIn("    proxy_http_version 1.1;\n    proxy_set_header Connection \"\";", conf)
+        self.assertIn("        proxy_pass http://devdeploy_shop_example_com;", conf)
+        self.assertNotIn("proxy_cache", conf)
+
+    def test_micro_cache_locations_and_bypass(self):
+        conf = self.conf(micro_cache=True, micro_cache_paths={'/api/products/': '10s'},
+                         cache_bypass_cookies=['sessionid', 'csrftoken'], cache_bypass_headers=['X-Api-Key'])
+        self.assertIn("proxy_cache_path /var/cache/nginx/devdeploy_shop_example_com ", conf)
+        self.assertIn("    proxy_cache_bypass $devdeploy_shop_example_com_skip_method $cookie_sessionid "
+                      "$cookie_csrftoken $http_x_api_key;", conf)
+        self.assertIn("    location / {\n        proxy_pass http://devdeploy_shop_example_com;\n"
+                      "        proxy_cache_valid 200 301 302 1s;\n    }", conf)
+        self.assertIn("    location /api/products/ {\n        proxy_pass http://devdeploy_shop_example_com;\n"
+                      "        proxy_cache_valid 200 301 302 10s;\n    }", conf)
+        self.assertEqual(conf.count("location /static/"), 1)
+
+    def test_micro_cache_paths_are_validated(self):
+        for paths, message in (
+                ({'/static/': '10s'}, "'/static/' is already served by nginx"),
+                ({'/media/': '10s'}, "'/media/' is already served by nginx"),
+                ({'api/': '10s'}, "'api/' must start with /"),
+                ({'/a b/': '10s'}, "'/a b/' must start with /"),
+                ({'/api/ { }': '10s'}, "must start with / and contain no spaces, braces or ;"),
+                ({'/api/': 'ten'}, "TTL of '/api/' must be an nginx time"),
+                (['/api/'], "micro_cache_paths must be a JSON object"),
+        ):
+            with self.subTest(paths=paths):
+                with self.assertRaisesMessage(Exception, message):
+                    merge_profile(DEFAULT_PROXY_PROFILE, {'proxy_profile': {'micro_cache_paths': paths}},
+                                  'proxy_profile')
+
+
+class JobLogStreamTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory(prefix='devdeploy-logs-')
+        self.addCleanup(log_dir.cleanup)
+        settings = override_settings(JOB_LOG_DIR=log_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.job = DeploymentJob.objects.create(kind='deploy', status='running')
+
+    def append(self, data):
+        with open(job_log_path(self.job.pk), 'ab') as f:
+            f.write(data)
+
+    def finish(self, status='succeeded'):
+        DeploymentJob.objects.filter(pk=self.job.pk).update(status=status)
+
+    def test_stream_ends_once_the_finished_job_is_drained(self):
+        self.append(b"one\ntwo\nthree\n")
+        self.finish()
+        self.assertEqual(list(stream_job_log(self.job.pk)), [
+            "id: 4\ndata: one\n\n", "id: 8\ndata: two\n\n", "id: 14\ndata: three\n\n",
+            "event: end\nid: 14\ndata: succeeded\n\n",
+        ])
+
+    def test_resume_from_the_last_event_id(self):
+        self.append(b"one\ntwo\nthree\n")
+        self.finish('failed')
+        self.assertEqual(list(stream_job_log(self.job.pk, offset=4)), [
+            "id: 8\ndata: two\n\n", "id: 14\ndata: three\n\n", "event: end\nid: 14\ndata: failed\n\n",
+        ])
+        response = self.client.get(f'/api/django/jobs/{self.job.pk}/stream/', HTTP_LAST_EVENT_ID='8')
+        self.assertEqual(b''.join(response.streaming_content).decode(),
+                         "id: 14\ndata: three\n\nevent: end\nid: 14\ndata: failed\n\n")
+
+    def test_partial_lines_wait_for_their_newline(self):
+        follower = _LogFollower(self.job.pk)
+        self.append(b"one\ntw")
+        self.assertEqual(follower.poll(), (["id: 4\ndata: one\n\n"], False))
+        self.assertEqual(follower.poll(), ([], True))
+        self.append(b"o\r\nthr")
+        self.assertEqual(follower.poll(), (["id: 9\ndata: two\n\n"], False))
+        # The job ends without a final newline: what is left is sent before `end`
+        self.finish()
+        self.assertEqual(follower.poll(), ([], False))
+        self.assertEqual(follower.poll(), (["id: 12\ndata: thr\n\n", "event: end\nid: 12\ndata: succeeded\n\n"], False))
+        self.assertTrue(follower.done)
+
+    def test_overlong_lines_are_sent_in_pieces(self):
+        self.append(b"x" * 20 + b"\n")
+        self.finish()
+        with mock.patch('django_deploy.streams.CHUNK_SIZE', 8):
+            events = list(stream_job_log(self.job.pk))
+        self.assertEqual(events[:3], ["id: 8\ndata: xxxxxxxx\n\n", "id: 16\ndata: xxxxxxxx\n\n",
+                                      "id: 21\ndata: xxxx\n\n"])
+
+    def test_async_stream_waits_for_new_output(self):
+        async def collect():
+            events = []
+            async for event in astream_job_log(self.job.pk, offset=4, poll_interval=0.01):
+                events.append(event)
+                if len(events) == 1:
+                    await sync_to_async(self.append)(b"two\n")
+                    await sync_to_async(self.finish)()
+            return events
+
+        self.append(b"one\nzero\n")
+        self.assertEqual(asyncio.run(collect()), [
+            "id: 9\ndata: zero\n\n", "id: 13\ndata: two\n\n", "event: end\nid: 13\ndata: succeeded\n\n",
+        ])
+
+    def test_unknown_job(self):
+        self.assertEqual(list(stream_job_log(uuid.uuid4())), ["event: error\ndata: Job not found\n\n"])
+
+
+class GitSyncScriptTests(SimpleTestCase):
+    """Runs git_sync_script with the real git against local upstream repositories."""
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory(prefix='devdeploy-git-')
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        self.home = f"{self.root}/home"
+        os.makedirs(self.home)
+        self.env = dict(os.environ, HOME=self.home, GIT_CONFIG_NOSYSTEM='1', GIT_CONFIG_GLOBAL='/dev/null',
+                        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@example.com',
+                        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@example.com')
+        self.shop = self.upstream('shop')
+
+    def git(self, *args, cwd=None):
+        return subprocess.run(['git', *args], cwd=cwd, env=self.env, check=True, capture_output=True,
+                              text=True).stdout.strip()
+
+    def upstream(self, name):
+        path = f"{self.root}/{name}"
+        self.git('init', '-q', '-b', 'main', path)
+        self.commit(path, 'app.py', name)
+        return path
+
+    def commit(self, repo, name, content):
+        with open(f"{repo}/{name}", 'w') as f:
+            f.write(content)
+        self.git('add', name, cwd=repo)
+        self.git('commit', '-q', '-m', f"{name}: {content}", cwd=repo)
+        return self.git('rev-parse', 'HEAD', cwd=repo)
+
+    def sync(self, repo_url, **kwargs):
+        result = subprocess.run(['bash', '-c', git_sync_script(repo_url, 'app', **kwargs)], env=self.env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout.strip().splitlines()[-1]
+
+    def read(self, name):
+        with open(f"{self.home}/app/{name}") as f:
+            return f.read()
+
+    def test_incremental_sync_clones_shallow_then_fetches_only_the_new_commit(self):
+        first = self.git('rev-parse', 'HEAD', cwd=self.shop)
+        self.assertEqual(self.sync(self.shop), first)
+        self.assertTrue(os.path.exists(f"{self.home}/app/.git/shallow"))
+        with open(f"{self.home}/app/.env", 'w') as f:
+            f.write('DEBUG=0\n')
+
+        second = self.commit(self.shop, 'app.py', 'v2')
+        self.assertEqual(self.sync(self.shop), second)
+        self.assertEqual(self.read('app.py'), 'v2')
+        self.assertEqual(self.read('.env'), 'DEBUG=0\n')  # untracked files survive
+
+    def test_ref_selects_a_branch_or_commit(self):
+        first = self.git('rev-parse', 'HEAD', cwd=self.shop)
+        self.git('checkout', '-q', '-b', 'feature', cwd=self.shop)
+        feature = self.commit(self.shop, 'app.py', 'feature')
+        self.git('checkout', '-q', 'main', cwd=self.shop)
+        self.assertEqual(self.sync(self.shop, ref='feature'), feature)
+        self.assertEqual(self.sync(self.shop, ref='main'), first)
+
+    def test_changed_remote_url_starts_a_new_checkout(self):
+        self.sync(self.shop)
+        with open(f"{self.home}/app/stale.txt", 'w') as f:
+            f.write('from the old repository')
+        blog = self.upstream('blog')
+        self.assertEqual(self.sync(blog), self.git('rev-parse', 'HEAD', cwd=blog))
+        self.assertEqual(self.git('-C', f"{self.home}/app", 'remote', 'get-url', 'origin'), blog)
+        self.assertEqual(self.read('app.py'), 'blog')
+        self.assertFalse(os.path.exists(f"{self.home}/app/stale.txt"))
+
+    def test_mirror_is_shared_and_updated(self):
+        self.sync(self.shop, use_mirror=True)
+        mirror = mirror_path(self.shop).replace('$HOME', self.home)
+        with open(f"{self.home}/app/.git/objects/info/alternates") as f:
+            self.assertEqual(f.read().strip(), f"{mirror}/objects")
+        self.assertFalse(os.path.exists(f"{self.home}/app/.git/shallow"))
+
+        second = self.commit(self.shop, 'app.py', 'v2')
+        self.assertEqual(self.sync(self.shop, use_mirror=True), second)
+        self.assertEqual(self.git('--git-dir', mirror, 'rev-parse', 'main'), second)
+        self.assertEqual(self.read('app.py'), 'v2')
+
+    def test_fresh_sync_reclones(self):
+        self.sync(self.shop)
+        with open(f"{self.home}/app/.env", 'w') as f:
+            f.write('DEBUG=0\n')
+        first = self.git('rev-parse', 'HEAD', cwd=self.shop)
+        self.commit(self.shop, 'app.py', 'v2')
+        self.assertEqual(self.sync(self.shop, mode='fresh', ref=first), first)
+        self.assertEqual(self.read('app.py'), 'shop')
+        self.assertFalse(os.path.exists(f"{self.home}/app/.env"))
+
+    def test_unknown_mode(self):
+        with self.assertRaisesMessage(Exception, "Unknown sync mode 'mirror'"):
+            git_sync_script(self.shop, 'app', mode='mirror')
+
+
+class PhaseStatsTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        patcher = mock.patch.object(state_writer, 'batched', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.deployment = Deployment.objects.create(ip_address='10.0.5.1', repo_url='https://example.com/shop.git',
+                                                    django_root='app', status='deployed')
+
+    def phase(self, name, duration_ms, hours_ago=1, succeeded=True, **fields):
+        return DeploymentPhase.objects.create(deployment=self.deployment, name=name, duration_ms=duration_ms,
+                                              started_at=now() - timedelta(hours=hours_ago), succeeded=succeeded,
+                                              **fields)
+
+    def test_percentile_of_few_samples(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual([percentile([7], pct) for pct in (1, 50, 99, 100)], [7, 7, 7, 7])
+        self.assertEqual([percentile([3, 9], pct) for pct in (1, 50, 51, 99)], [3, 3, 9, 9])
+
+    def test_single_sample_phase(self):
+        self.phase('upload', 120, bytes=2048)
+        self.assertEqual(phase_stats(now() - timedelta(days=1))['upload'], {
+            'count': 1, 'failed': 0, 'p50_ms': 120, 'p95_ms': 120, 'p99_ms': 120, 'max_ms': 120,
+            'mean_ms': 120.0, 'p50_bytes': 2048,
+        })
+
+    def test_only_phases_inside_the_window_count(self):
+        self.phase('build', 100, hours_ago=1)
+        self.phase('build', 300, hours_ago=3, succeeded=False)
+        self.phase('build', 900, hours_ago=30)
+        self.phase('connect', 5, hours_ago=0.5)
+        stats = phase_stats(now() - timedelta(hours=24), now() - timedelta(hours=2))
+        self.assertEqual(list(stats), ['build'])
+        self.assertEqual((stats['build']['count'], stats['build']['failed'], stats['build']['p50_bytes']), (1, 1, None))
+        stats = phase_stats(now() - timedelta(hours=24))
+        self.assertEqual(list(stats), ['connect', 'build'])  # pipeline order
+        self.assertEqual((stats['build']['p50_ms'], stats['build']['p99_ms'], stats['build']['mean_ms']),
+                         (100, 300, 200.0))
+
+    @override_settings(PHASE_STATS_MAX_DAYS=30)
+    def test_window_is_capped(self):
+        with self.assertRaisesMessage(Exception, "longer than 30 days"):
+            phase_stats(now() - timedelta(days=31))
+
+    def test_timer_records_failed_phases(self):
+        timer = PhaseTimer()
+        with timer.phase('upload') as phase:
+            phase['bytes'] = 10
+        with timer.phase('build') as phase:
+            phase['exit_code'] = 2
+        with self.assertRaises(ValueError):
+            with timer.phase('start'):
+                raise ValueError("boom")
+        self.assertEqual([(p['name'], p['succeeded']) for p in timer.phases],
+                         [('upload', True), ('build', False), ('start', False)])
+        self.assertEqual(timer.summary()[:2], [
+            {'name': 'upload', 'duration_ms': timer.phases[0]['duration_ms'], 'bytes': 10, 'exit_code': None},
+            {'name': 'build', 'duration_ms': timer.phases[1]['duration_ms'], 'bytes': None, 'exit_code': 2},
+        ])
+        deployment = timer.record(ip_address='10.0.5.2', repo_url='https://example.com/shop.git', django_root='app',
+                                  status='failed')
+        self.assertEqual(list(deployment.phases.order_by('pk').values_list('name', 'succeeded')),
+                         [('upload', True), ('build', False), ('start', False)])
+
+
+class DeploymentWorkerPoolTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_missing_tables()
+        super().setUpClass()
+
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory(prefix='devdeploy-logs-')
+        self.addCleanup(log_dir.cleanup)
+        settings = override_settings(JOB_LOG_DIR=log_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        patcher = mock.patch.object(state_writer, 'batched', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_job(self, func):
+        pool = DeploymentWorkerPool(workers=1, max_queue=4)
+        job = pool.submit('deploy', func, ip_address='10.0.6.1')
+        pool._queue.join()
+        job.refresh_from_db()
+        return job
+
+    def test_full_queue_rejects_the_job_and_marks_it_failed(self):
+        pool = DeploymentWorkerPool(workers=0, max_queue=1)  # no workers: the first job stays queued
+        queued = pool.submit('deploy', mock.Mock())
+        with self.assertRaisesMessage(JobQueueFull, "Deployment queue is full"):
+            pool.submit('deploy', mock.Mock())
+        self.assertEqual(pool.queue_size(), 1)
+        rejected = DeploymentJob.objects.exclude(pk=queued.pk).get()
+        self.assertEqual((rejected.status, rejected.message), ('failed', 'Deployment queue is full'))
+        self.assertIsNotNone(rejected.finished_at)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'queued')
+
+    def test_exception_fails_the_job_with_its_message(self):
+        def deploy(progress):
+            progress.step('connecting')
+            raise Exception("VPS not reachable")
+
+        job = self.run_job(deploy)
+        self.assertEqual((job.status, job.step, job.message), ('failed', 'connecting', 'VPS not reachable'))
+        self.assertIsNotNone(job.finished_at)
+        with open(job_log_path(job.pk)) as f:
+            self.assertEqual(f.read(), "==> connecting\n==> failed: VPS not reachable\n")
+
+    def test_error_result_fails_the_job(self):
+        job = self.run_job(lambda progress: {'status': 'error', 'message': 'Some commands failed', 'failed': [1]})
+        self.assertEqual((job.status, job.message), ('failed', 'Some commands failed'))
+        self.assertEqual(job.result['failed'], [1])
+        self.assertNotEqual(job.step, 'done')
+
+    def test_successful_job_links_its_deployment(self):
+        deployment = Deployment.objects.create(ip_address='10.0.6.1', repo_url='https://example.com/shop.git',
+                                               django_root='app', status='deployed')
+        job = self.run_job(lambda progress: {'status': 'success', 'message': 'Project deployed',
+                                             'deployment_id': deployment.pk})
+        self.assertEqual((job.status, job.step, job.deployment_id), ('succeeded', 'done', deployment.pk))
+        self.assertNotIn('deployment_id', job.result)
+
+
+class FleetOperationTests(SimpleTestCase):
+    def test_partial_failure_reports_every_host(self):
+        def install(progress, ip):
+            if ip == '10.0.7.2':
+                raise Exception("SSH connection refused")
+            if ip == '10.0.7.3':
+                return {'status': 'error', 'message': 'Some commands failed'}
+            progress.step('installing')
+            return {'status': 'success', 'message': 'Dependencies installed'}
+
+        progress = mock.Mock(log=None)
+        ips = ['10.0.7.1', '10.0.7.2', '10.0.7.3']
+        with mock.patch('django_deploy.fleet.install_host_dependencies', install):
+            result = run_fleet_operation(progress, 'install_dependencies', ips, {}, concurrency=2)
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(result['message'], "install_dependencies succeeded on 1/3 hosts")
+        self.assertEqual((result['succeeded'], result['failed'], result['concurrency']),
+                         (['10.0.7.1'], ['10.0.7.2', '10.0.7.3'], 2))
+        self.assertEqual(result['hosts']['10.0.7.2']['message'], "SSH connection refused")
+        self.assertEqual(result['hosts']['10.0.7.3']['status'], 'error')
+        self.assertEqual([s['step'] for s in result['hosts']['10.0.7.1']['steps']], ['installing'])
+        # One partial result per finished host, the last one with every host done
+        self.assertEqual(progress.partial_result.call_count, 3)
+        last = progress.partial_result.call_args[0][0]
+        self.assertNotIn('pending', [host['status'] for host in last['hosts'].values()])
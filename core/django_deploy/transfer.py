@@ -0,0 +1,188 @@
+# deployer/transfer.py
+import hashlib
+import io
+import os
+import secrets
+import shlex
+import tarfile
+import time
+import zlib
+
+from .streams import pump_channel
+
+COMPRESS_LEVEL = 6
+ERROR_BYTES = 4096
+
+
+def _transport(conn):
+    """The SSH transport behind an SSHClient, an SFTPClient or a Transport."""
+    if hasattr(conn, 'get_transport'):
+        return conn.get_transport()
+    if hasattr(conn, 'get_channel'):
+        return conn.get_channel().get_transport()
+    return conn
+
+
+class _GzipChannelWriter:
+    """
+    File object the tar stream is written to: gzips it and sends it down the
+    channel, counting and hashing what goes over the wire.
+    """
+
+    def __init__(self, channel, level=COMPRESS_LEVEL):
+        self.channel = channel
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+        self.digest = hashlib.sha256()
+        self.wire_bytes = 0
+
+    def _send(self, data):
+        if data:
+            self.channel.sendall(data)
+            self.digest.update(data)
+            self.wire_bytes += len(data)
+
+    def write(self, data):
+        self._send(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self._send(self.compressor.flush())
+
+
+class _HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _check_name(name):
+    if not name or '\n' in name or name.startswith('/') or '..' in name.split('/'):
+        raise Exception(f"Refusing to upload '{name}': not a plain relative path")
+
+
+def _members_from_files(files):
+    """(TarInfo, file object, sha256) for {relative name: str | bytes}."""
+    mtime = time.time()
+    for name, content in files.items():
+        data = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+        info = tarfile.TarInfo(name)
+        info.size, info.mode, info.mtime = len(data), 0o644, mtime
+        yield info, io.BytesIO(data), hashlib.sha256(data).hexdigest()
+
+
+def _pack(tar, members, manifest_name):
+    """Write the members and, last, a sha256sum manifest of the regular files. Returns (files, bytes)."""
+    lines, size = [], 0
+    for info, fileobj, digest in members:
+        if fileobj is None:
+            tar.addfile(info)
+            continue
+        reader = fileobj if digest else _HashingReader(fileobj)
+        tar.addfile(info, reader)
+        lines.append(f"{digest or reader.digest.hexdigest()}  {info.name}\n")
+        size += info.size
+    manifest = ''.join(lines).encode('utf-8')
+    info = tarfile.TarInfo(manifest_name)
+    info.size, info.mode, info.mtime = len(manifest), 0o600, time.time()
+    tar.addfile(info, io.BytesIO(manifest))
+    return len(lines), size
+
+
+def _stream(conn, remote_path, add):
+    """
+    Run `tar -x` into remote_path on one exec channel and feed it the gzipped
+    tar that `add(tar, manifest_name)` writes. The remote checks every file
+    against the manifest before the command succeeds.
+    """
+    nonce = secrets.token_hex(6)
+    manifest = f".devdeploy-transfer-{nonce}.sha256"
+    quoted = shlex.quote(remote_path)
+    command = (
+        f"mkdir -p {quoted} && cd {quoted} && tar -xzf - --no-same-owner && "
+        f"sha256sum --quiet --strict -c {manifest}; status=$?; rm -f {manifest}; exit $status"
+    )
+    started = time.monotonic()
+    channel = _transport(conn).open_session()
+    try:
+        channel.exec_command(command)
+        writer = _GzipChannelWriter(channel)
+        send_error = None
+        try:
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                files, size = add(tar, manifest)
+            writer.close()
+        except OSError as e:
+            # The remote side went away (e.g. mkdir failed); its stderr says why
+            send_error, files, size = e, 0, 0
+        channel.shutdown_write()
+        out, err = [], []
+        status = pump_channel(channel, out.append, err.append)
+    finally:
+        channel.close()
+    if status != 0 or send_error is not None:
+        stderr = b''.join(err).decode('utf-8', errors='replace')[-ERROR_BYTES:].strip()
+        raise Exception(f"Upload to {remote_path} failed (exit {status}): {stderr or send_error}")
+    seconds = time.monotonic() - started
+    return {
+        'files': files,
+        'bytes': size,
+        'wire_bytes': writer.wire_bytes,
+        'sha256': writer.digest.hexdigest(),
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(size / 2 ** 20 / seconds, 2) if seconds else None,
+    }
+
+
+def upload_files(conn, remote_path, files):
+    """
+    Write {relative name: str | bytes} under remote_path (created if missing) in
+    one round trip. `conn` is an SSHClient, SFTPClient or Transport.
+    Returns {'files', 'bytes', 'wire_bytes', 'sha256' (of the gzip stream), 'seconds', 'mb_per_s'}.
+    """
+    for name in files:
+        _check_name(name)
+    return _stream(conn, remote_path, lambda tar, manifest: _pack(tar, _members_from_files(files), manifest))
+
+
+def upload_directory(conn, local_dir, remote_path):
+    """Copy the tree under local_dir into remote_path (see upload_files), symlinks included."""
+    def members():
+        for root, dirs, names in os.walk(local_dir):
+            dirs.sort()
+            for name in sorted(dirs) + sorted(names):
+                path = os.path.join(root, name)
+                arcname = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                _check_name(arcname)
+                info = tarfile.TarInfo(arcname)
+                st = os.lstat(path)
+                info.mode, info.mtime = st.st_mode & 0o7777, st.st_mtime
+                if os.path.islink(path):
+                    info.type, info.linkname = tarfile.SYMTYPE, os.readlink(path)
+                    yield info, None, None
+                elif os.path.isdir(path):
+                    info.type = tarfile.DIRTYPE
+                    yield info, None, None
+                elif os.path.isfile(path):
+                    info.size = st.st_size
+                    with open(path, 'rb') as f:
+                        yield info, f, None
+
+    return _stream(conn, remote_path, lambda tar, manifest: _pack(tar, members(), manifest))
+
+
+def make_dirs(conn, remote_directory):
+    """mkdir -p on the remote, over the connection's transport."""
+    channel = _transport(conn).open_session()
+    try:
+        channel.exec_command(f"mkdir -p {shlex.quote(remote_directory)}")
+        err = []
+        status = pump_channel(channel, lambda data: None, err.append)
+    finally:
+        channel.close()
+    if status != 0:
+        raise Exception(f"Failed to create {remote_directory}: {b''.join(err).decode('utf-8', errors='replace')}")
@@ -0,0 +1,131 @@
+# deployer/tuning.py
+import math
+import re
+
+from .remote import run_script
+
+WORKER_MEMORY_MB = 150  # rough resident size of one Django worker
+MEMORY_SHARE = 0.6  # leave the rest to nginx, docker and the OS
+MAX_THREADS = 8
+
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'gthread': 'gthread',
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+
+# Accepted keys of the `gunicorn` deploy option, unset ones are autotuned
+GUNICORN_OVERRIDES = dict.fromkeys([
+    'workers', 'worker_class', 'threads', 'max_requests', 'max_requests_jitter',
+    'timeout', 'graceful_timeout', 'keep_alive',
+])
+
+
+def requirement_names(requirements):
+    """Normalized distribution names (PEP 503) listed in a requirements.txt."""
+    names = []
+    for line in requirements.splitlines():
+        match = re.match(r'[A-Za-z0-9][A-Za-z0-9._-]*', line.strip())
+        if match:
+            names.append(re.sub(r'[-_.]+', '-', match.group()).lower())
+    return names
+
+
+def probe_host(ssh, repo_path, django_root, wsgi_path):
+    """
+    CPU count and memory of the host, the packages in requirements.txt and
+    whether the project can run under uvicorn (an asgi.py next to wsgi.py and
+    uvicorn in requirements.txt). One round trip over the open session.
+    """
+    asgi_dir = wsgi_path.rsplit('/', 1)[0] if '/' in wsgi_path else '.'
+    commands = [
+        "nproc",
+        "awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo",
+        f"test -f {repo_path}/{asgi_dir}/asgi.py || test -f {repo_path}/{django_root}/{asgi_dir}/asgi.py",
+        f"cat {repo_path}/{django_root}/requirements.txt",
+    ]
+    details, _ = run_script(ssh, commands)
+    values = [d['stdout'].strip() for d in details]
+    requirements = requirement_names(details[3]['stdout']) if details[3]['exit_status'] == 0 else []
+    return {
+        'cpus': int(values[0]) if values[0].isdigit() else 1,
+        'memory_mb': int(values[1]) if values[1].isdigit() else 0,
+        'asgi': details[2]['exit_status'] == 0 and 'uvicorn' in requirements,
+        'requirements': requirements,
+    }
+
+
+def tune_gunicorn(host, overrides=None):
+    """
+    Pick gunicorn settings for `host` (see probe_host):
+
+    - workers: 2 * cpus + 1, capped by what fits in MEMORY_SHARE of RAM.
+    - worker class: uvicorn (one worker per CPU) for ASGI projects; sync when the CPU-based worker
+      count fits in memory, otherwise gthread with enough threads to make up
+      the missing concurrency.
+    - max_requests with 10% jitter so workers don't all recycle at once.
+    - keep_alive above nginx's upstream keepalive_timeout, so nginx never
+      reuses a connection gunicorn is about to close.
+
+    Values in `overrides` win. Returns the settings, with the host facts under 'host'.
+    """
+    overrides = {k: v for k, v in (overrides or {}).items() if v not in (None, '')}
+    cpus = max(1, host['cpus'])
+    cpu_workers = 2 * cpus + 1
+    if host['memory_mb']:
+        memory_workers = max(1, int(host['memory_mb'] * MEMORY_SHARE // WORKER_MEMORY_MB))
+    else:
+        memory_workers = cpu_workers
+    workers = max(1, min(cpu_workers, memory_workers))
+
+    if host['asgi']:
+        # An event loop per core is enough, extra async workers only add memory
+        worker_class, threads = 'uvicorn', 1
+        workers = min(workers, cpus)
+    elif workers < cpu_workers:
+        worker_class, threads = 'gthread', min(MAX_THREADS, math.ceil(cpu_workers / workers) * 2)
+    else:
+        worker_class, threads = 'sync', 1
+
+    config = {
+        'workers': workers,
+        'worker_class': worker_class,
+        'threads': threads,
+        'max_requests': 1000,
+        'max_requests_jitter': 100,
+        'timeout': 30,
+        'graceful_timeout': 30,
+        'keep_alive': 65,
+    }
+    config.update(overrides)
+    if config['worker_class'] not in WORKER_CLASSES:
+        raise Exception(f"Unknown worker_class '{config['worker_class']}', expected one of: {', '.join(WORKER_CLASSES)}")
+    for key in ('workers', 'threads', 'max_requests', 'max_requests_jitter', 'timeout', 'graceful_timeout', 'keep_alive'):
+        config[key] = int(config[key])
+    config['host'] = host
+    return config
+
+
+def gunicorn_command(project_module, config=None, port=8000):
+    """gunicorn command line for the container, with the settings from tune_gunicorn."""
+    if not config:
+        return f"gunicorn {project_module}.wsgi:application --bind 0.0.0.0:{port}"
+    if config['worker_class'] == 'uvicorn':
+        app = f"{project_module}.asgi:application"
+    else:
+        app = f"{project_module}.wsgi:application"
+    args = [
+        f"gunicorn {app} --bind 0.0.0.0:{port}",
+        f"--workers {config['workers']}",
+        f"--worker-class {WORKER_CLASSES[config['worker_class']]}",
+    ]
+    if config['worker_class'] == 'gthread':
+        args.append(f"--threads {config['threads']}")
+    args += [
+        f"--max-requests {config['max_requests']}",
+        f"--max-requests-jitter {config['max_requests_jitter']}",
+        f"--timeout {config['timeout']}",
+        f"--graceful-timeout {config['graceful_timeout']}",
+        f"--keep-alive {config['keep_alive']}",
+    ]
+    return ' '.join(args)
@@ -8,7 +8,17 @@ urlpatterns = [
     path('connect-vps/', views.connect_vps_view),
     path('install-dependencies/', views.install_dependencies),
     path('deploy-project/', views.deploy_project),
+    path('redeploy-project/', views.redeploy_project),
     path('deploy-project-aws/', views.deploy_project_aws),
+    path('aws/warm-pool/', views.aws_warm_pool),
+    path('aws/usage/', views.aws_usage),
     path('docker-containers/', views.docker_containers),
     path('delete-docker-container/', views.delete_docker_container),
+    path('fleet/operations/', views.fleet_operation),
+    path('metrics/', views.host_metrics),
+    path('deployments/', views.deployment_history),
+    path('deployments/phase-stats/', views.deployment_phase_stats),
+    path('ssh-pool-stats/', views.ssh_pool_stats),
+    path('jobs/<uuid:job_id>/', views.deployment_job_status),
+    path('jobs/<uuid:job_id>/stream/', views.deployment_job_stream),
 ]
\ No newline at end of file
@@ -0,0 +1,152 @@
+# deployer/usage.py
+import datetime
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils.timezone import now
+
+from .models import InstanceUsageDaily, UserInstance, UserInstanceQuerySet
+
+GROUPS = {
+    'day': 'day',
+    'status': 'status',
+    'instance': 'instance__instance_id',
+}
+# The same groups on UserInstance, for days computed live (None: one row for all instances)
+LIVE_GROUPS = {
+    'day': None,
+    'status': 'status',
+    'instance': 'instance_id',
+}
+LIVE_DAYS_PER_QUERY = 31
+
+
+def day_bounds(day):
+    """[start, end) of a UTC day as aware datetimes."""
+    start = datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+    return start, start + datetime.timedelta(days=1)
+
+
+def today():
+    return now().astimezone(datetime.timezone.utc).date()
+
+
+@transaction.atomic
+def rollup_day(day):
+    """(Re)write the InstanceUsageDaily rows of one day. Returns the number of rows."""
+    start, end = day_bounds(day)
+    rows = (
+        UserInstance.objects.overlapping(start, end).with_usage(start, end)
+        .values('pk', 'status', 'runtime_seconds', 'cost')
+    )
+    InstanceUsageDaily.objects.filter(day=day).delete()
+    created = InstanceUsageDaily.objects.bulk_create([
+        InstanceUsageDaily(day=day, instance_id=row['pk'], status=row['status'],
+                           runtime_seconds=row['runtime_seconds'], cost=row['cost'])
+        for row in rows
+    ])
+    return len(created)
+
+
+def rollup_closed_days(rebuild_from=None):
+    """
+    Roll up every finished day that isn't yet: from the day after the last rolled
+    up one (or `rebuild_from`) to yesterday. Idle stretches with no instance
+    running are skipped. Returns {day: rows}.
+    """
+    last_closed = today() - datetime.timedelta(days=1)
+    if rebuild_from is not None:
+        first = rebuild_from
+    else:
+        last_rolled = InstanceUsageDaily.objects.aggregate(last=Max('day'))['last']
+        first = last_rolled + datetime.timedelta(days=1) if last_rolled else None
+    # Nothing ran before the earliest start of an instance still relevant from `first` on
+    relevant = UserInstance.objects.all()
+    if first is not None:
+        relevant = relevant.filter(Q(stopped_at__isnull=True) | Q(stopped_at__gte=day_bounds(first)[0]))
+    earliest = relevant.aggregate(earliest=Min('started_at'))['earliest']
+    if earliest is None:
+        return {}
+    day = max(first or earliest.date(), earliest.astimezone(datetime.timezone.utc).date())
+    done = {}
+    while day <= last_closed:
+        done[day] = rollup_day(day)
+        day += datetime.timedelta(days=1)
+    return done
+
+
+def _live_usage(first, last, group_by):
+    """
+    (group, runtime_seconds, cost, instance_days) for each day from `first` to
+    `last` (dates, inclusive), straight from UserInstance: today and days not
+    rolled up yet. Every day is a set of columns of one grouped query, so the
+    database does the clipping and summing; one query per LIVE_DAYS_PER_QUERY days.
+    """
+    field = LIVE_GROUPS[group_by]
+    while first <= last:
+        days = [first + datetime.timedelta(days=i) for i in range(min(LIVE_DAYS_PER_QUERY, (last - first).days + 1))]
+        columns = {}
+        for i, day in enumerate(days):
+            start, end = day_bounds(day)
+            runtime = UserInstanceQuerySet.runtime_expression(start, end)
+            columns[f'seconds_{i}'] = Sum(runtime)
+            columns[f'cost_{i}'] = Sum(UserInstanceQuerySet.cost_expression(runtime))
+            columns[f'n_{i}'] = Count('pk', filter=Q(started_at__lt=end) & (
+                Q(stopped_at__isnull=True) | Q(stopped_at__gt=start)))
+        instances = UserInstance.objects.overlapping(day_bounds(days[0])[0], day_bounds(days[-1])[1])
+        if field is None:
+            rows = [instances.aggregate(**columns)]
+        else:
+            rows = instances.values(field).annotate(**columns).order_by()
+        for row in rows:
+            for i, day in enumerate(days):
+                if row[f'n_{i}']:
+                    yield day if field is None else row[field], row[f'seconds_{i}'], row[f'cost_{i}'], row[f'n_{i}']
+        first = days[-1] + datetime.timedelta(days=1)
+
+
+def usage_report(since, until, group_by='day'):
+    """
+    Runtime and cost from `since` to `until` (dates, inclusive) grouped by day,
+    status or instance. Days rolled up by rollup_instance_usage (run by the
+    collect_metrics loop, or on its own from cron) come from InstanceUsageDaily;
+    later ones, today included, are computed live. Nothing is written.
+    """
+    key = GROUPS[group_by]
+    groups = {}
+
+    def add(group, runtime_seconds, cost, instance_days):
+        entry = groups.setdefault(group, {'runtime_seconds': 0.0, 'cost': 0.0, 'instance_days': 0})
+        entry['runtime_seconds'] += runtime_seconds or 0.0
+        entry['cost'] += cost or 0.0
+        entry['instance_days'] += instance_days
+
+    last_rolled = InstanceUsageDaily.objects.aggregate(last=Max('day'))['last']
+    if last_rolled is not None and last_rolled >= since:
+        closed = (
+            InstanceUsageDaily.objects.filter(day__gte=since, day__lte=min(until, last_rolled))
+            .values(key).annotate(seconds=Sum('runtime_seconds'), total=Sum('cost'), n=Count('id'))
+            .order_by(key)
+        )
+        for row in closed:
+            add(row[key], row['seconds'], row['total'], row['n'])
+    if last_rolled is not None:
+        first_live = last_rolled + datetime.timedelta(days=1)
+    else:
+        # Nothing rolled up yet: nothing ran before the first instance started
+        earliest = UserInstance.objects.aggregate(earliest=Min('started_at'))['earliest']
+        first_live = earliest.astimezone(datetime.timezone.utc).date() if earliest else today() + datetime.timedelta(days=1)
+    for usage in _live_usage(max(since, first_live), min(until, today()), group_by):
+        add(*usage)
+
+    rows = [
+        {group_by: group if group_by != 'day' else group.isoformat(),
+         'runtime_hours': round(entry['runtime_seconds'] / 3600, 2), 'cost': round(entry['cost'], 4),
+         'instance_days': entry['instance_days']}
+        for group, entry in sorted(groups.items(), key=lambda item: str(item[0]))
+    ]
+    return {
+        'rows': rows,
+        'total_runtime_hours': round(sum(e['runtime_seconds'] for e in groups.values()) / 3600, 2),
+        'total_cost': round(sum(e['cost'] for e in groups.values()), 4),
+    }
@@ -9,9 +9,17 @@ def connect_vps(ip, pem_path, username="ubuntu"):
 
 
 # deployer/utils.py
+import hashlib
+import json
 import os
+import re
 import tempfile
 
+from .nginx import NginxSites
+from .transfer import upload_files
+from .remote import run_script
+from .tuning import gunicorn_command
+
 def write_pem_tempfile(pem_name, pem_content):
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f"_{pem_name}")
     temp_file.write(pem_content)
@@ -20,16 +28,80 @@ def write_pem_tempfile(pem_name, pem_content):
     os.chmod(temp_file.name, 0o600)
     return temp_file.name
 
-def generate_dockerfile(wsgi_path):
+# Base images used by the generated Dockerfiles (also pre-pulled on fresh hosts)
+PYTHON_BUILD_IMAGE = "python:3.10"
+PYTHON_RUNTIME_IMAGE = "python:3.10-slim"
+
+# Shared libraries that packages built from source in the build image link
+# against, missing from the slim runtime image (Debian package names)
+RUNTIME_LIBRARIES = {
+    'psycopg2': ['libpq5'],
+    'psycopg': ['libpq5'],
+    'mysqlclient': ['libmariadb3'],
+    'pillow': ['libjpeg62-turbo', 'zlib1g', 'libfreetype6'],
+    'lxml': ['libxml2', 'libxslt1.1'],
+}
+
+# Prefix for docker/docker-compose commands so builds use BuildKit (cache mounts)
+BUILDKIT_ENV = "DOCKER_BUILDKIT=1 COMPOSE_DOCKER_CLI_BUILD=1"
+
+
+def runtime_libraries(requirements):
+    """Debian packages the runtime image needs for `requirements` (names, see tuning.requirement_names)."""
+    return sorted({lib for name in requirements or () for lib in RUNTIME_LIBRARIES.get(name, ())})
+
+
+def generate_dockerfile(wsgi_path, runtime_image: str = PYTHON_RUNTIME_IMAGE, gunicorn=None, requirements=None):
+    """
+    Multi-stage Dockerfile: wheels are built from requirements.txt alone, so the
+    dependency layers stay cached until requirements.txt changes and code-only
+    edits just re-run the final COPY. Needs BuildKit (see BUILDKIT_ENV).
+    gunicorn: settings from tuning.tune_gunicorn, gunicorn's defaults if omitted.
+    requirements: package names from requirements.txt; the shared libraries the
+    known ones need at runtime (RUNTIME_LIBRARIES) are installed in the slim
+    stage. Anything else linking system libraries needs runtime_image=PYTHON_BUILD_IMAGE.
+    """
     project_module = wsgi_path.split("/")[-2]  # Get Django project module name
-    return f"""
-FROM python:3.10
+    libraries = runtime_libraries(requirements)
+    apt_install = ""
+    if libraries:
+        apt_install = (
+            "RUN apt-get update && apt-get install -y --no-install-recommends "
+            f"{' '.join(libraries)} \\\n    && rm -rf /var/lib/apt/lists/*\n"
+        )
+    return f"""# syntax=docker/dockerfile:1
+FROM {PYTHON_BUILD_IMAGE} AS deps
 WORKDIR /app
+COPY requirements.txt .
+RUN --mount=type=cache,target=/root/.cache/pip \\
+    pip install --upgrade pip && pip wheel --wheel-dir /wheels -r requirements.txt
+
+FROM {runtime_image}
+ENV PYTHONDONTWRITEBYTECODE=1 PYTHONUNBUFFERED=1
+{apt_install}WORKDIR /app
+COPY requirements.txt .
+RUN --mount=type=bind,from=deps,source=/wheels,target=/wheels \\
+    pip install --no-cache-dir --no-index --find-links=/wheels -r requirements.txt
 COPY . /app
-RUN pip install --upgrade pip && pip install -r requirements.txt
-CMD gunicorn {project_module}.wsgi:application --bind 0.0.0.0:8000
+CMD {gunicorn_command(project_module, gunicorn)}
 """
 
+
+def generate_dockerignore():
+    return "\n".join([
+        ".git",
+        ".dockerignore",
+        "Dockerfile",
+        "docker-compose.yml",
+        "**/__pycache__",
+        "**/*.py[cod]",
+        ".venv",
+        "venv",
+        "env",
+        "node_modules",
+        "",
+    ])
+
 def generate_docker_compose(env_file: bool = True):
     compose = [
         "version: '3.8'",
@@ -41,7 +113,8 @@ def generate_docker_compose(env_file: bool = True):
         compose.append("    env_file:\n      - .env")
     compose += [
         "    ports:",
-        "      - '8000:8000'",
+        # Host port comes from the blue/green color being started (see compose_command)
+        "      - '${DEVDEPLOY_PORT:-8000}:8000'",
         "    volumes:",
         "      - .:/app",
         "    restart: always"
@@ -92,70 +165,246 @@ server {
 }
 '''
 
-def generate_system_nginx_conf(server_name: str, static_root: str = "/home/ubuntu/static", media_root: str = "/home/ubuntu/media", proxy_port: int = 8000, ssl: bool = False):
+# Tunables for the nginx -> gunicorn proxy, override per deploy with `proxy_profile`.
+DEFAULT_PROXY_PROFILE = {
+    'keepalive': 32,  # idle upstream connections kept per nginx worker
+    'keepalive_requests': 1000,
+    'keepalive_timeout': '60s',
+    'proxy_connect_timeout': '5s',
+    'proxy_send_timeout': '60s',
+    'proxy_read_timeout': '60s',
+    'proxy_buffering': True,
+    'proxy_buffer_size': '16k',
+    'proxy_buffers': '16 16k',
+    'proxy_busy_buffers_size': '32k',
+    'client_max_body_size': '20m',
+    'micro_cache': False,
+    'micro_cache_ttl': '1s',
+    'micro_cache_paths': {},  # {'/api/products/': '10s'}, longest prefix wins
+    'micro_cache_size': '256m',
+    # Requests carrying any of these are never served from or stored in the cache
+    'cache_bypass_cookies': ['sessionid'],
+    'cache_bypass_headers': ['Authorization'],
+}
+
+
+def merge_profile(defaults, data, key):
+    """
+    `defaults` with the overrides from data[key] (a JSON object, or a JSON
+    string of one for form posts). Unknown keys are rejected.
+    """
+    overrides = data.get(key) or {}
+    if isinstance(overrides, str):
+        try:
+            overrides = json.loads(overrides)
+        except ValueError:
+            raise Exception(f"{key} must be a JSON object")
+    if not isinstance(overrides, dict):
+        raise Exception(f"{key} must be a JSON object")
+    unknown = set(overrides) - set(defaults)
+    if unknown:
+        raise Exception(f"Unknown {key} keys: {', '.join(sorted(unknown))}")
+    if 'micro_cache_paths' in overrides:
+        _check_micro_cache_paths(key, overrides['micro_cache_paths'])
+    return {**defaults, **overrides}
+
+
+# generate_system_nginx_conf already has location blocks for these
+RESERVED_LOCATIONS = ('/static/', '/media/')
+
+
+def _check_micro_cache_paths(key, paths):
+    """Each path becomes a `location` block in the nginx config, so it has to be one nginx accepts."""
+    if not isinstance(paths, dict):
+        raise Exception(f"{key} micro_cache_paths must be a JSON object of path prefix to TTL")
+    for path, ttl in paths.items():
+        if not re.fullmatch(r'/[^\s{};]*', path):
+            raise Exception(f"{key} micro_cache_paths: '{path}' must start with / and contain no spaces, braces or ;")
+        if path in RESERVED_LOCATIONS:
+            raise Exception(f"{key} micro_cache_paths: '{path}' is already served by nginx, it can't be cached")
+        if not isinstance(ttl, str) or not re.fullmatch(r'\d+(ms|s|m|h|d)?', ttl):
+            raise Exception(f"{key} micro_cache_paths: TTL of '{path}' must be an nginx time such as '10s'")
+
+
+def _nginx_name(server_name):
+    return re.sub(r'[^A-Za-z0-9_]', '_', server_name)
+
+
+def generate_system_nginx_conf(server_name: str, static_root: str = "/home/ubuntu/static", media_root: str = "/home/ubuntu/media", proxy_port: int = 8000, ssl: bool = False, profile=None):
     """
     Generate nginx config for system nginx (not Docker), proxying to Dockerized Django app.
+    Connections to gunicorn are kept alive through a named upstream (HTTP/1.1).
+    With profile['micro_cache'], anonymous GET/HEAD responses are cached for a
+    short per-path TTL; responses setting a cookie are never cached.
     If ssl=True, include commented SSL config for easy enabling.
     """
+    p = {**DEFAULT_PROXY_PROFILE, **(profile or {})}
+    name = f"devdeploy_{_nginx_name(server_name)}"
     ssl_block = '''
     # listen 443 ssl;
     # ssl_certificate /etc/letsencrypt/live/{server_name}/fullchain.pem;
     # ssl_certificate_key /etc/letsencrypt/live/{server_name}/privkey.pem;
     ''' if ssl else ''
+
+    # upstream, proxy_cache_path and map live in the http context, which is where sites-enabled is included
+    http_block = f'''upstream {name} {{
+    server 127.0.0.1:{proxy_port};
+    keepalive {p['keepalive']};
+    keepalive_requests {p['keepalive_requests']};
+    keepalive_timeout {p['keepalive_timeout']};
+}}
+'''
+    proxy = [
+        "    proxy_http_version 1.1;",
+        '    proxy_set_header Connection "";',
+        "    proxy_set_header Host $host;",
+        "    proxy_set_header X-Real-IP $remote_addr;",
+        "    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;",
+        "    proxy_set_header X-Forwarded-Proto $scheme;",
+        "    proxy_redirect off;",
+        f"    proxy_connect_timeout {p['proxy_connect_timeout']};",
+        f"    proxy_send_timeout {p['proxy_send_timeout']};",
+        f"    proxy_read_timeout {p['proxy_read_timeout']};",
+        f"    proxy_buffering {'on' if p['proxy_buffering'] else 'off'};",
+        f"    proxy_buffer_size {p['proxy_buffer_size']};",
+        f"    proxy_buffers {p['proxy_buffers']};",
+        f"    proxy_busy_buffers_size {p['proxy_busy_buffers_size']};",
+        f"    client_max_body_size {p['client_max_body_size']};",
+    ]
+    locations = {'/': None}
+    if p['micro_cache']:
+        http_block += f'''
+proxy_cache_path /var/cache/nginx/{name} levels=1:2 keys_zone={name}:10m max_size={p['micro_cache_size']} inactive=10m use_temp_path=off;
+
+map $request_method ${name}_skip_method {{
+    default 1;
+    GET 0;
+    HEAD 0;
+}}
+'''
+        bypass = [f"${name}_skip_method"]
+        bypass += [f"$cookie_{c}" for c in p['cache_bypass_cookies']]
+        bypass += [f"$http_{h.lower().replace('-', '_')}" for h in p['cache_bypass_headers']]
+        proxy += [
+            f"    proxy_cache {name};",
+            "    proxy_cache_methods GET HEAD;",
+            f"    proxy_cache_bypass {' '.join(bypass)};",
+            f"    proxy_no_cache {' '.join(bypass)};",
+            "    proxy_cache_lock on;",
+            "    proxy_cache_background_update on;",
+            "    proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;",
+            "    add_header X-Cache-Status $upstream_cache_status always;",
+        ]
+        locations['/'] = p['micro_cache_ttl']
+        locations.update(p['micro_cache_paths'])
+
+    location_blocks = []
+    for path, ttl in locations.items():
+        body = [f"        proxy_pass http://{name};"]
+        if ttl:
+            body.append(f"        proxy_cache_valid 200 301 302 {ttl};")
+        location_blocks.append(f"    location {path} {{\n" + "\n".join(body) + "\n    }")
+    proxy_settings = "\n".join(proxy)
+    proxy_locations = "\n".join(location_blocks)
     return f'''
+{http_block}
 server {{
     listen 80;
     server_name {server_name};
 {ssl_block}
+{proxy_settings}
+
     location /static/ {{
         alias {static_root}/;
     }}
     location /media/ {{
         alias {media_root}/;
     }}
-    location / {{
-        proxy_pass http://127.0.0.1:{proxy_port};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        proxy_set_header X-Forwarded-Proto $scheme;
-        proxy_redirect off;
-    }}
+{proxy_locations}
 }}
 '''
 
-def upload_and_enable_nginx_conf(ssh, sftp, conf_content, server_name):
+def upload_and_enable_nginx_conf(ssh, conf_content, server_name, reload=False):
     """
-    Upload nginx config to /home/ubuntu/{server_name}, move to /etc/nginx/sites-available/{server_name} with sudo, symlink to sites-enabled, and reload nginx.
+    Install conf_content as the nginx site {server_name} and enable it.
+    Nothing is written or reloaded when the host already has this exact config
+    (unless reload=True). Returns {'changed', 'unchanged', 'reloaded'}.
     """
-    user_tmp_path = f"/home/ubuntu/{server_name}"
-    remote_conf_path = f"/etc/nginx/sites-available/{server_name}"
-    # Upload to user-writable location
-    with sftp.file(user_tmp_path, 'w') as f:
-        f.write(conf_content)
-    # Move to nginx config dir and reload
-    commands = [
-        f"sudo mv {user_tmp_path} {remote_conf_path}",
-        f"sudo ln -sf {remote_conf_path} /etc/nginx/sites-enabled/{server_name}",
-        "sudo nginx -t",
-        "sudo systemctl reload nginx"
-    ]
-    for cmd in commands:
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            raise Exception(f"Failed to run '{cmd}': {stderr.read().decode()}")
+    return NginxSites(ssh).stage(server_name, conf_content).apply(reload=reload)
 
 def sftp_write_files(sftp, remote_path, files_dict):
     """
-    Write multiple files to a remote path using SFTP.
+    Write multiple files to a remote path as one tar stream over the SFTP
+    session's transport (see transfer.upload_files).
     files_dict: {filename: content}
     """
-    for filename, content in files_dict.items():
-        with sftp.file(f"{remote_path}/{filename}", 'w') as f:
-            f.write(content)
+    return upload_files(sftp, remote_path, files_dict)
 
 def sftp_write_env_file(sftp, remote_path, env_file):
-    with sftp.file(f"{remote_path}/.env", 'w') as f:
-        for chunk in env_file.chunks():
-            f.write(chunk.decode('utf-8'))
+    return upload_files(sftp, remote_path, {'.env': b''.join(env_file.chunks())})
+
+def sftp_write_env_content(sftp, remote_path, env_content):
+    return upload_files(sftp, remote_path, {'.env': env_content})
+
+
+def deployment_fingerprint(commit_sha, artifacts, env_content=None):
+    """
+    sha256 over everything that determines what a deploy builds: the commit,
+    the generated files ({filename: content}) and the .env contents.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"commit\0{commit_sha}\0".encode())
+    for name in sorted(artifacts):
+        digest.update(f"file\0{name}\0{artifacts[name]}\0".encode())
+    digest.update(f"env\0{env_content or ''}\0".encode())
+    return digest.hexdigest()
+
+
+def last_deployed_fingerprint(ip, repo_url, root):
+    from .models import Deployment
+    return Deployment.objects.filter(
+        ip_address=ip, repo_url=repo_url, django_root=root, status="deployed"
+    ).order_by('-deployed_at').values_list('fingerprint', flat=True).first()
+
+
+# Blue/green: each color is its own compose project on its own host port.
+# blue is compose's default project, so deploys made before colors existed count as blue.
+COLORS = {'blue': 8000, 'green': 8001}
+COLOR_STATE_DIR = "$HOME/.devdeploy/colors"
+
+
+def color_state_path(remote_path):
+    return f"{COLOR_STATE_DIR}/{remote_path.strip('/').replace('/', '_')}"
+
+
+def active_color(ssh, remote_path):
+    """The color nginx currently sends traffic to for the project in remote_path."""
+    details, _ = run_script(ssh, [f"cat {color_state_path(remote_path)} 2>/dev/null || true"])
+    color = details[0]['stdout'].strip() if details else ''
+    return color if color in COLORS else 'blue'
+
+
+def set_active_color(ssh, remote_path, color):
+    path = color_state_path(remote_path)
+    details, failed = run_script(ssh, [f'mkdir -p "$(dirname {path})" && echo {color} > {path}'])
+    if failed:
+        raise Exception(f"Failed to record active color: {failed[0]['stderr']}")
+
+
+def compose_command(remote_path, color='blue'):
+    """`cd` into remote_path and invoke docker-compose for the given color's project and port."""
+    project = ''
+    if color != 'blue':
+        name = re.sub(r'[^a-z0-9]', '', os.path.basename(os.path.normpath(remote_path)).lower())
+        project = f" -p {name}{color}"
+    return f"cd {remote_path} && sudo DEVDEPLOY_PORT={COLORS[color]} {BUILDKIT_ENV} docker-compose{project}"
+
+
+def compose_is_running(ssh, remote_path, color='blue'):
+    """True if the compose project in remote_path has containers and all of them are running."""
+    cmd = (
+        f"ids=$({compose_command(remote_path, color)} ps -q) && [ -n \"$ids\" ] "
+        "&& ! sudo docker inspect -f '{{.State.Running}}' $ids | grep -qv true"
+    )
+    details, failed = run_script(ssh, [cmd])
+    return not failed
@@ -1,18 +1,30 @@
 # deployer/views.py
+import hashlib
 import os
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils.timezone import now
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view, parser_classes
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.response import Response
-from .utils import connect_vps
-from .utils import write_pem_tempfile, generate_dockerfile, generate_docker_compose, generate_nginx_conf
-from .utils import generate_docker_compose_for_deploy, generate_nginx_conf_for_deploy, sftp_write_files, sftp_write_env_file
-from .utils import generate_system_nginx_conf, upload_and_enable_nginx_conf
-from .models import Deployment, VPS
-
-
-from .aws import create_instance
-from .models import UserInstance
-from django.utils.timezone import now
+from .models import Deployment, DeploymentJob, VPS
+from .ssh_pool import ssh_pool
+from .state import state_writer
+from .inventory import container_inventory
+from .fleet import OPERATIONS, run_fleet_operation, select_fleet
+from .jobs import deploy_workers
+from .metrics import metric_series, parse_window
+from .pagination import keyset_page, parse_limit
+from .phases import phase_stats
+from .pipelines import deploy_django_project, deploy_django_project_aws, deploy_options, install_host_dependencies, provision_host
+from .pipelines import REDEPLOY_STRATEGIES, redeploy_on_host
+from .streams import astream_job_log, stream_job_log
+from .usage import GROUPS as USAGE_GROUPS, today as usage_today, usage_report
+from .warmpool import warm_pool
+from .utils import DEFAULT_PROXY_PROFILE, merge_profile
 
 
 
@@ -22,9 +34,23 @@ from django.utils.timezone import now
 @parser_classes([MultiPartParser, FormParser])
 def connect_vps_view(request):
     if request.method == 'GET':
-        # Return all available VPSs (do not include sensitive pem_file_content)
-        vps_list = VPS.objects.all().values('id', 'ip_address', 'name', 'connected', 'pem_file_name')
-        return Response({'status': 'success', 'vps': list(vps_list)})
+        # VPSs by id (never includes pem_file_content). Query: connected, limit, cursor;
+        # without limit or cursor every VPS is returned, as the dashboard expects
+        params = request.query_params
+        fields = ['id', 'ip_address', 'name', 'connected', 'pem_file_name']
+        try:
+            vps_list = VPS.objects.all()
+            if params.get('connected') not in (None, ''):
+                vps_list = vps_list.filter(connected=params['connected'].lower() in ('1', 'true', 'yes'))
+            if not params.get('limit') and not params.get('cursor'):
+                rows, next_cursor = list(vps_list.order_by('id').values(*fields)), None
+            else:
+                rows, next_cursor = keyset_page(
+                    vps_list, ['id'], fields, cursor=params.get('cursor'), limit=parse_limit(params.get('limit')),
+                )
+        except Exception as e:
+            return Response({'status': 'error', 'message': str(e)})
+        return Response({'status': 'success', 'vps': rows, 'next_cursor': next_cursor})
 
     # POST method: connect a new VPS
     ip = request.data.get('ip')
@@ -34,7 +60,8 @@ def connect_vps_view(request):
         return Response({'status': 'error', 'message': 'Missing required fields'})
     try:
         pem_content = pem_file.read()
-        vps_obj, created = VPS.objects.update_or_create(
+        vps_obj, created = state_writer.call(
+            VPS.objects.update_or_create,
             ip_address=ip,
             defaults={
                 'name': name,
@@ -43,17 +70,17 @@ def connect_vps_view(request):
                 'connected': False  # Initially false, update after success
             }
         )
-        pem_path = write_pem_tempfile(pem_file.name, pem_content)
-        ssh = connect_vps(ip, pem_path)
-        ssh.close()
-        os.unlink(pem_path)
+        # Drop sessions opened with a previous key, then verify and warm the pool
+        ssh_pool.invalidate(ip)
+        with ssh_pool.session(vps_obj):
+            pass
 
-        vps_obj.connected = True
-        vps_obj.save()
+        state_writer.call(VPS.objects.filter(pk=vps_obj.pk).update, connected=True)
 
         return Response({'status': 'success', 'message': 'VPS connected successfully'})
     except Exception as e:
-        VPS.objects.update_or_create(
+        state_writer.call(
+            VPS.objects.update_or_create,
             ip_address=ip,
             defaults={
                 'name': name,
@@ -66,48 +93,29 @@ def connect_vps_view(request):
 
 @api_view(['POST'])
 def install_dependencies(request):
+    """
+    Install the deploy toolchain on a VPS. With async=true the install runs as a
+    background job whose output can be followed at jobs/<job_id>/stream/.
+    Steps the host already satisfies are skipped (listed under `skipped`); force=true runs them all.
+    """
     ip = request.data.get('ip')
     if not ip:
         return Response({'status': 'error', 'message': 'IP is required'})
+    force = str(request.data.get('force', '')).lower() in ('1', 'true', 'yes')
     try:
         vps = VPS.objects.get(ip_address=ip)
-        pem_path = write_pem_tempfile(vps.pem_file_name, vps.pem_file_content)
-        ssh = connect_vps(ip, pem_path)
-
-        commands = [
-            # Update and basic tools
-            "sudo apt update",
-            "sudo apt install -y git curl python3 python3-pip python3-venv",
-            # Docker
-            "sudo apt install -y docker.io",
-            "sudo systemctl enable docker",
-            "sudo systemctl start docker",
-            # Docker Compose (modern Ubuntu: as plugin)
-            "sudo apt install -y docker-compose || sudo apt install -y docker-compose-plugin || true",
-            # Nginx
-            "sudo apt install -y nginx"
-        ]
-        failed = []
-        details = []
-        for cmd in commands:
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-            exit_status = stdout.channel.recv_exit_status()
-            out = stdout.read().decode()
-            err = stderr.read().decode()
-            details.append({
-                'command': cmd,
-                'exit_status': exit_status,
-                'stdout': out,
-                'stderr': err
-            })
-            if exit_status != 0:
-                failed.append({'command': cmd, 'stderr': err})
-        ssh.close()
-        os.unlink(pem_path)
+        if str(request.data.get('async', '')).lower() in ('1', 'true', 'yes'):
+            job = deploy_workers.submit('install', install_host_dependencies, ip, force, ip_address=ip)
+            return Response({'status': 'queued', 'message': 'Install queued', 'job_id': str(job.pk)})
+
+        with ssh_pool.session(vps) as ssh:
+            details, failed, skipped = provision_host(ssh, force=force)
 
         if failed:
-            return Response({'status': 'error', 'message': 'Some commands failed', 'details': details, 'failed': failed})
-        return Response({'status': 'success', 'message': 'Dependencies installed', 'details': details})
+            return Response({'status': 'error', 'message': 'Some commands failed', 'details': details, 'failed': failed,
+                             'skipped': skipped})
+        message = 'Dependencies installed' if details else 'Dependencies already installed'
+        return Response({'status': 'success', 'message': message, 'details': details, 'skipped': skipped})
     except VPS.DoesNotExist:
         return Response({'status': 'error', 'message': 'VPS not found. Connect VPS first.'})
     except Exception as e:
@@ -123,69 +131,24 @@ def deploy_project(request):
     env_file = request.FILES.get('env_file')
     server_name = request.data.get('server_name', ip)  # allow custom domain, fallback to IP
 
+    if not ip or not repo_url or  not wsgi_path:
+        return Response({'status': 'error', 'message': 'Missing required fields'})
+
     project_name = os.path.basename(repo_url).replace('.git', '')
     if not django_root:
         django_root = project_name
 
-    if not ip or not repo_url or  not wsgi_path:
-        return Response({'status': 'error', 'message': 'Missing required fields'})
-
+    if not VPS.objects.filter(ip_address=ip).exists():
+        return Response({'status': 'error', 'message': 'VPS not found. Connect VPS first.'})
     try:
-        vps = VPS.objects.get(ip_address=ip)
-        pem_path = write_pem_tempfile(vps.pem_file_name, vps.pem_file_content)
-        ssh = connect_vps(ip, pem_path)
-
-        # Remove any existing project folder
-        ssh.exec_command(f"rm -rf {project_name}")
-        ssh.exec_command(f"git clone {repo_url}")
-
-        # Generate deployment files using utils
-        dockerfile = generate_dockerfile(wsgi_path)
-        # Compose file: only web service, no nginx, no static volume, .env only if present
-        compose_file = generate_docker_compose(env_file=bool(env_file))
-        remote_path = f"/home/ubuntu/{project_name}/{django_root}"
-        sftp = ssh.open_sftp()
-
-        # Write Dockerfile, docker-compose.yml
-        sftp_write_files(sftp, remote_path, {
-            "Dockerfile": dockerfile,
-            "docker-compose.yml": compose_file
-        })
-
-        # Write .env if provided
-        if env_file:
-            sftp_write_env_file(sftp, remote_path, env_file)
-
-        # Generate and upload system nginx config
-        nginx_conf = generate_system_nginx_conf(server_name)
-        upload_and_enable_nginx_conf(ssh, sftp, nginx_conf, server_name)
-
-        sftp.close()
-
-        # Build and run docker-compose, capture output
-        start_cmd = f"cd {project_name}/{django_root} && sudo docker-compose up --build -d"
-        stdin, stdout, stderr = ssh.exec_command(start_cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-
-        ssh.close()
-        os.unlink(pem_path)
-
-        if exit_status != 0:
-            return Response({'status': 'error', 'message': 'docker-compose up failed', 'stdout': out, 'stderr': err})
-
-        Deployment.objects.create(
-            ip_address=ip,
-            repo_url=repo_url,
-            django_root=django_root,
-            wsgi_path=wsgi_path,
-            status="deployed"
+        # The upload is gone once the request ends, so hand its content to the worker
+        env_content = env_file.read().decode('utf-8') if env_file else None
+        job = deploy_workers.submit(
+            'django', deploy_django_project, ip, repo_url, django_root, wsgi_path, server_name, env_content,
+            deploy_options(request.data),
+            ip_address=ip, repo_url=repo_url,
         )
-
-        return Response({'status': 'success', 'message': f'Project deployed at http://{server_name}', 'stdout': out})
-    except VPS.DoesNotExist:
-        return Response({'status': 'error', 'message': 'VPS not found. Connect VPS first.'})
+        return Response({'status': 'queued', 'message': 'Deployment queued', 'job_id': str(job.pk)})
     except Exception as e:
         return Response({'status': 'error', 'message': str(e)})
 
@@ -199,40 +162,21 @@ def redeploy_project(request):
     repo_url = request.data.get('repo_url')
     if not ip or not django_root or not repo_url:
         return Response({'status': 'error', 'message': 'Missing required fields'})
-    try:
-        vps = VPS.objects.get(ip_address=ip)
-        pem_path = write_pem_tempfile(vps.pem_file_name, vps.pem_file_content)
-        ssh = connect_vps(ip, pem_path)
-        project_name = os.path.basename(repo_url).replace('.git', '')
-        remote_path = f"/home/ubuntu/{project_name}/{django_root}"
-        # Stop and remove running containers,git pull then rebuild and restart
-        commands = [
-            f"cd {remote_path} && sudo docker-compose down",
-            # f"cd {remote_path} && git pull",
-            f"cd {remote_path} && sudo docker-compose up --build -d"
-        ]
-        details = []
-        failed = []
-        for cmd in commands:
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-            exit_status = stdout.channel.recv_exit_status()
-            out = stdout.read().decode()
-            err = stderr.read().decode()
-            details.append({
-                'command': cmd,
-                'exit_status': exit_status,
-                'stdout': out,
-                'stderr': err
-            })
-            if exit_status != 0:
-                failed.append({'command': cmd, 'stderr': err})
-        ssh.close()
-        os.unlink(pem_path)
-        if failed:
-            return Response({'status': 'error', 'message': 'Some commands failed', 'details': details, 'failed': failed})
-        return Response({'status': 'success', 'message': 'Project redeployed', 'details': details})
-    except VPS.DoesNotExist:
+    force = str(request.data.get('force', '')).lower() in ('1', 'true', 'yes')
+    strategy = request.data.get('strategy') or 'bluegreen'
+    if strategy not in REDEPLOY_STRATEGIES:
+        return Response({'status': 'error', 'message': f"strategy must be one of: {', '.join(REDEPLOY_STRATEGIES)}"})
+    if not VPS.objects.filter(ip_address=ip).exists():
         return Response({'status': 'error', 'message': 'VPS not found. Connect VPS first.'})
+    try:
+        job = deploy_workers.submit(
+            'redeploy', redeploy_on_host, ip, repo_url, django_root, force, strategy,
+            request.data.get('server_name', ip),
+            merge_profile(DEFAULT_PROXY_PROFILE, request.data, 'proxy_profile'),
+            request.data.get('health_path') or '/',
+            ip_address=ip, repo_url=repo_url,
+        )
+        return Response({'status': 'queued', 'message': 'Redeploy queued', 'job_id': str(job.pk)})
     except Exception as e:
         return Response({'status': 'error', 'message': str(e)})
 
@@ -247,81 +191,171 @@ def deploy_project_aws(request):
     wsgi_path = request.data.get('wsgi_path')
     env_file = request.FILES.get('env_file')
 
+    if not repo_url or not wsgi_path:
+        return Response({'status': 'error', 'message': 'Missing required fields'})
     try:
-        # 🔥 Create EC2 instance
-        instance_id, ip_address = create_instance()
-
-        # 💾 Save to DB
-        UserInstance.objects.create(
-            instance_id=instance_id,
-            ip_address=ip_address
+        env_content = env_file.read().decode('utf-8') if env_file else None
+        job = deploy_workers.submit(
+            'django_aws', deploy_django_project_aws, repo_url, django_root, wsgi_path, env_content,
+            deploy_options(request.data),
+            repo_url=repo_url,
         )
+        return Response({'status': 'queued', 'message': 'Deployment queued', 'job_id': str(job.pk)})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
+
+
+@api_view(['GET', 'POST'])
+def aws_warm_pool(request):
+    """GET: warm pool size and instances per state. POST: top the pool up in the background."""
+    try:
+        if request.method == 'POST':
+            warm_pool.refill_in_background()
+        return Response({'status': 'success', **warm_pool.status()})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
+
+@api_view(['GET'])
+def aws_usage(request):
+    """
+    EC2 runtime and cost between since and until (YYYY-MM-DD, inclusive; default the last 30 days),
+    grouped by day, status or instance (group_by).
+    """
+    params = request.query_params
+    group_by = params.get('group_by', 'day')
+    if group_by not in USAGE_GROUPS:
+        return Response({'status': 'error', 'message': f"group_by must be one of {', '.join(USAGE_GROUPS)}"})
+    try:
+        until = date.fromisoformat(params['until']) if params.get('until') else usage_today()
+        since = date.fromisoformat(params['since']) if params.get('since') else until - timedelta(days=29)
+    except ValueError:
+        return Response({'status': 'error', 'message': 'since and until must be dates (YYYY-MM-DD)'})
+    try:
+        report = usage_report(since, until, group_by)
+        return Response({'status': 'success', 'since': since, 'until': until, 'group_by': group_by, **report})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
 
-        # 🔐 Connect via SSH
-        pem_path = '/path/to/deploy-key.pem'  # Your local .pem path
-        ssh = connect_vps(ip_address, pem_path)
-
-        # 🧰 Install dependencies
-        commands = [
-            "sudo apt update",
-            "sudo apt install -y git docker.io docker-compose nginx",
-            "sudo systemctl enable docker",
-            "sudo systemctl start docker"
-        ]
-        for cmd in commands:
-            ssh.exec_command(cmd)
-
-        # 📦 Clone repo and deploy (same as before)
-        project_name = os.path.basename(repo_url).replace('.git', '')
-        django_root = request.data.get('django_root')
-        project_name = os.path.basename(repo_url).replace('.git', '')
-        if not django_root:
-            django_root = project_name
-        dockerfile = generate_dockerfile(wsgi_path)
-        compose_file = generate_docker_compose(env_file=bool(env_file))
-        remote_path = f"/home/ubuntu/{project_name}/{django_root}"
-        ssh.exec_command(f"rm -rf {project_name}")
-        ssh.exec_command(f"git clone {repo_url}")
-        sftp = ssh.open_sftp()
-        sftp_write_files(sftp, remote_path, {
-            "Dockerfile": dockerfile,
-            "docker-compose.yml": compose_file
-        })
-        if env_file:
-            sftp_write_env_file(sftp, remote_path, env_file)
-        nginx_conf = generate_system_nginx_conf(ip_address)
-        upload_and_enable_nginx_conf(ssh, sftp, nginx_conf, ip_address)
-        sftp.close()
-        start_cmd = f"cd {project_name}/{django_root} && sudo docker-compose up --build -d"
-        stdin, stdout, stderr = ssh.exec_command(start_cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        ssh.close()
-        if exit_status != 0:
-            return Response({'status': 'error', 'message': 'docker-compose up failed', 'stdout': out, 'stderr': err})
-        return Response({'status': 'success', 'message': f'Deployed at http://{ip_address}', 'stdout': out})
+@api_view(['POST'])
+@parser_classes([JSONParser, MultiPartParser, FormParser])
+def fleet_operation(request):
+    """
+    Run install_dependencies, deploy (Django) or deploy_react on many VPSes in parallel.
+    Targets are `vps_ids` or a `selector` such as "all_connected"; `concurrency`
+    caps how many hosts run at once. Per-host results appear on the job as they finish.
+    """
+    operation = request.data.get('operation')
+    if operation not in OPERATIONS:
+        return Response({'status': 'error', 'message': f"operation must be one of: {', '.join(OPERATIONS)}"})
+    vps_ids = request.data.get('vps_ids') or []
+    if isinstance(vps_ids, str):
+        vps_ids = [v for v in vps_ids.split(',') if v.strip()]
+    try:
+        ips = select_fleet(vps_ids, request.data.get('selector'))
+        if not ips:
+            return Response({'status': 'error', 'message': 'No VPS matched'})
+        concurrency = int(request.data.get('concurrency') or 0) or None
+
+        params = {}
+        if operation in ('deploy', 'deploy_react'):
+            repo_url = request.data.get('repo_url')
+            if not repo_url:
+                return Response({'status': 'error', 'message': 'Missing required fields'})
+            project_name = os.path.basename(repo_url).replace('.git', '')
+            env_file = request.FILES.get('env_file')
+            params = {
+                'repo_url': repo_url,
+                'django_root': request.data.get('django_root') or project_name,
+                'wsgi_path': request.data.get('wsgi_path'),
+                'app_root': request.data.get('app_root') or '.',
+                'env_content': env_file.read().decode('utf-8') if env_file else None,
+                'options': deploy_options(request.data),
+            }
+            if operation == 'deploy_react':
+                from react_deploy.utils import static_profile
+                params['options']['static_profile'] = static_profile(request.data)
+            if operation == 'deploy' and not params['wsgi_path']:
+                return Response({'status': 'error', 'message': 'Missing required fields'})
+
+        job = deploy_workers.submit(
+            f'fleet_{operation}', run_fleet_operation, operation, ips, params, concurrency,
+            repo_url=params.get('repo_url', ''),
+        )
+        return Response({'status': 'queued', 'message': f'{operation} queued on {len(ips)} hosts',
+                         'job_id': str(job.pk), 'hosts': ips})
     except Exception as e:
         return Response({'status': 'error', 'message': str(e)})
 
 
+MAX_PAGE_SIZE = 500
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get('If-None-Match', '')
+    candidates = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return f'"{etag}"' in candidates or '*' in candidates
+
 
 @api_view(['GET'])
 def docker_containers(request):
-    """List all Docker containers (running and stopped) on the VPS."""
-    ip = request.query_params.get('ip')  # <-- use query_params for GET
+    """
+    List Docker containers (running and stopped) on the VPS from the inventory cache.
+    Optional filters: name (substring), state (comma separated), project (compose project);
+    page/page_size to paginate (everything when page_size is omitted); refresh=true to bypass the cache.
+    Answers 304 when If-None-Match carries the current ETag.
+    """
+    params = request.query_params
+    ip = params.get('ip')  # <-- use query_params for GET
     if not ip:
         return Response({'status': 'error', 'message': 'Missing required field: ip'})
+    try:
+        page = int(params.get('page') or 1)
+        page_size = int(params['page_size']) if params.get('page_size') else None
+    except ValueError:
+        return Response({'status': 'error', 'message': 'page and page_size must be integers'})
+    if page < 1 or (page_size is not None and page_size < 1):
+        return Response({'status': 'error', 'message': 'page and page_size must be at least 1'})
     try:
         vps = VPS.objects.get(ip_address=ip)
-        pem_path = write_pem_tempfile(vps.pem_file_name, vps.pem_file_content)
-        ssh = connect_vps(ip, pem_path)
-        cmd = "sudo docker ps -a --format '{{json .}}'"
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        containers = [eval(line) for line in stdout.read().decode().splitlines() if line.strip()]
-        ssh.close()
-        os.unlink(pem_path)
-        return Response({'status': 'success', 'containers': containers})
+        refresh = str(params.get('refresh', '')).lower() in ('1', 'true', 'yes')
+        snapshot, cached = container_inventory.get(vps, refresh=refresh)
+
+        records = snapshot.records
+        name = params.get('name', '').lower()
+        if name:
+            records = [r for r in records if name in r.names.lower()]
+        states = {s for s in params.get('state', '').split(',') if s}
+        if states:
+            records = [r for r in records if r.state in states]
+        project = params.get('project')
+        if project:
+            records = [r for r in records if r.project == project]
+
+        page_size = min(page_size, MAX_PAGE_SIZE) if page_size else len(records) or 1
+
+        # Same inventory + same query = same body
+        query = '&'.join(f"{k}={params[k]}" for k in sorted(params) if k != 'refresh')
+        etag = hashlib.sha256(f"{snapshot.etag}?{query}".encode()).hexdigest()[:32]
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if _etag_matches(request, etag):
+            return Response(status=304, headers=headers)
+
+        counts = {}
+        for r in records:
+            counts[r.state] = counts.get(r.state, 0) + 1
+        return Response({
+            'status': 'success',
+            'containers': [r.as_dict() for r in records[(page - 1) * page_size:page * page_size]],
+            'count': len(records),
+            'counts': counts,
+            'page': page,
+            'page_size': page_size,
+            'cached': cached,
+            'fetched_at': snapshot.fetched_wall,
+        }, headers=headers)
     except Exception as e:
         return Response({'status': 'error', 'message': str(e)})
 
@@ -334,14 +368,12 @@ def delete_docker_container(request):
         return Response({'status': 'error', 'message': 'Missing required fields: ip, container'})
     try:
         vps = VPS.objects.get(ip_address=ip)
-        pem_path = write_pem_tempfile(vps.pem_file_name, vps.pem_file_content)
-        ssh = connect_vps(ip, pem_path)
         cmd = f"sudo docker rm -f {container}"
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        ssh.close()
-        os.unlink(pem_path)
+        with ssh_pool.session(vps) as ssh:
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            out = stdout.read().decode()
+            err = stderr.read().decode()
+        container_inventory.invalidate(ip)
         if err.strip():
             return Response({'status': 'error', 'message': err.strip()})
         return Response({'status': 'success', 'message': out.strip()})
@@ -349,3 +381,104 @@ def delete_docker_container(request):
         return Response({'status': 'error', 'message': str(e)})
 
 
+@api_view(['GET'])
+def host_metrics(request):
+    """
+    Host and per-container resource series for a VPS.
+    Query: ip, window (e.g. 30m, 6h, 7d; default 1h), resolution (auto, raw, 1m, 1h), container.
+    """
+    params = request.query_params
+    ip = params.get('ip')
+    if not ip:
+        return Response({'status': 'error', 'message': 'Missing required field: ip'})
+    resolution = params.get('resolution', 'auto')
+    if resolution not in ('auto', 'raw', '1m', '1h'):
+        return Response({'status': 'error', 'message': 'resolution must be one of auto, raw, 1m, 1h'})
+    try:
+        series = metric_series(ip, parse_window(params.get('window')), resolution, params.get('container'))
+        return Response({'status': 'success', **series})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
+
+@api_view(['GET'])
+def deployment_history(request):
+    """
+    Deployments, newest first, one page at a time.
+    Query: ip, status, repo_url, limit, cursor (next_cursor of the previous page).
+    """
+    params = request.query_params
+    deployments = Deployment.objects.all()
+    for field, param in (('ip_address', 'ip'), ('status', 'status'), ('repo_url', 'repo_url')):
+        if params.get(param):
+            deployments = deployments.filter(**{field: params[param]})
+    try:
+        rows, next_cursor = keyset_page(
+            deployments, ['-deployed_at', '-id'],
+            ['id', 'ip_address', 'repo_url', 'django_root', 'git_ref', 'commit_sha',
+             'build_skipped', 'color', 'status', 'deployed_at'],
+            cursor=params.get('cursor'), limit=parse_limit(params.get('limit')),
+        )
+        return Response({'status': 'success', 'deployments': rows, 'next_cursor': next_cursor})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
+
+@api_view(['GET'])
+def deployment_phase_stats(request):
+    """
+    p50/p95/p99 duration of each deploy phase (connect, git_sync, upload, build, ...).
+    Query: ip, repo_url, window (e.g. 24h, 7d; default 7d, at most PHASE_STATS_MAX_DAYS).
+    """
+    params = request.query_params
+    try:
+        window = parse_window(params.get('window'), default='7d')
+        until = now()
+        stats = phase_stats(until - window, until, ip=params.get('ip'), repo_url=params.get('repo_url'))
+        return Response({'status': 'success', 'window_seconds': int(window.total_seconds()), 'phases': stats})
+    except Exception as e:
+        return Response({'status': 'error', 'message': str(e)})
+
+
+@api_view(['GET'])
+def ssh_pool_stats(request):
+    """Hit/miss counters and per-host session usage of the SSH session pool."""
+    return Response({'status': 'success', 'pool': ssh_pool.stats()})
+
+
+@api_view(['GET'])
+def deployment_job_status(request, job_id):
+    """Cheap status lookup for a queued/running deployment job."""
+    job = DeploymentJob.objects.filter(pk=job_id).values(
+        'id', 'kind', 'ip_address', 'repo_url', 'status', 'step', 'steps', 'message',
+        'result', 'deployment_id', 'created_at', 'started_at', 'finished_at'
+    ).first()
+    if job is None:
+        return Response({'status': 'error', 'message': 'Job not found'})
+    return Response({'status': 'success', 'job': job})
+
+
+# Plain Django view: EventSource sends Accept: text/event-stream, which DRF's
+# content negotiation would reject before the view runs.
+@require_GET
+def deployment_job_stream(request, job_id):
+    """
+    Server-sent events with the live output of a job. Resume with ?offset=<bytes>
+    or the Last-Event-ID header the browser sends when it reconnects. A stream is
+    closed after JOB_STREAM_MAX_SECONDS; EventSource then reconnects and resumes.
+    """
+    offset = request.GET.get('offset') or request.headers.get('Last-Event-ID') or 0
+    try:
+        offset = max(0, int(offset))
+    except ValueError:
+        offset = 0
+    max_seconds = getattr(settings, 'JOB_STREAM_MAX_SECONDS', 300)
+    if isinstance(request, ASGIRequest):
+        # Under ASGI a sync iterator would be collected whole before anything is sent
+        events = astream_job_log(job_id, offset, max_seconds=max_seconds)
+    else:
+        events = stream_job_log(job_id, offset, max_seconds=max_seconds)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let an nginx in front buffer the stream
+    return response
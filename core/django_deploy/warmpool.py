@@ -0,0 +1,255 @@
+# deployer/warmpool.py
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils.timezone import now
+
+from .aws import launch_instances, terminate_instances, wait_until_running
+from .models import UserInstance, VPS
+from .pipelines import provision_host
+from .ssh_pool import ssh_pool
+from .state import state_writer
+
+SSH_RETRY_SECONDS = 5
+PREPARING_STATES = ('launching', 'bootstrapping')
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """
+    EC2 instances kept booted, registered as a VPS and bootstrapped, so an AWS
+    deploy can start on one straight away.
+
+    `acquire` hands out the oldest warm instance (or launches one when the pool
+    is empty) and starts a background refill back up to `size`. The pool state
+    lives in UserInstance.pool_state, shared by every process using the pool.
+    While an instance is being prepared its process refreshes pool_heartbeat_at;
+    one whose heartbeat is older than `lease_seconds` was left behind by a
+    process that stopped and is terminated on the next refill.
+    `client` replaces the shared boto3 client (e.g. a stub in tests).
+    """
+
+    def __init__(self, size=0, client=None, lease_seconds=120):
+        self.size = size
+        self.client = client
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._preparing = set()  # UserInstance pks launched by this process and not ready yet
+        self._refilling = False
+        self._heartbeat = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            size=getattr(settings, 'AWS_WARM_POOL_SIZE', 0),
+            lease_seconds=getattr(settings, 'AWS_WARM_POOL_LEASE_SECONDS', 120),
+        )
+
+    def claim(self):
+        """Mark the oldest warm instance as assigned and return it (None if there is none)."""
+        for instance in UserInstance.objects.filter(pool_state='warm').order_by('started_at'):
+            # Conditional update, so two deploys can't claim the same instance
+            if state_writer.call(UserInstance.objects.filter(pk=instance.pk, pool_state='warm').update,
+                                 pool_state='assigned', assigned_at=now()):
+                instance.refresh_from_db()
+                return instance
+        return None
+
+    def acquire(self, progress):
+        instance = self.claim()
+        if instance is None:
+            progress.note("no warm instance available, launching one")
+            instance = self._launch(1, assigned=True)[0]
+            self.prepare(instance, 'assigned', progress)
+        self.refill_in_background()
+        return instance
+
+    def _launch(self, count, assigned=False):
+        """Launch `count` instances; assigned ones go straight to a deploy and don't count towards the pool."""
+        instances = [
+            state_writer.call(UserInstance.objects.create, instance_id=instance_id, pool_state='launching',
+                              pool_heartbeat_at=now(), assigned_at=now() if assigned else None)
+            for instance_id in launch_instances(count, client=self.client)
+        ]
+        with self._lock:
+            self._preparing.update(i.pk for i in instances)
+        self._ensure_heartbeat()
+        return instances
+
+    def prepare(self, instance, final_state='warm', progress=None):
+        """Wait for the instance to boot, register it as a VPS and install the toolchain."""
+        try:
+            ips = wait_until_running([instance.instance_id], client=self.client)
+            instance.ip_address = ips[instance.instance_id]
+            instance.pool_state = 'bootstrapping'
+            instance.pool_heartbeat_at = now()
+            state_writer.update(UserInstance, instance.pk, ip_address=instance.ip_address,
+                                pool_state=instance.pool_state, pool_heartbeat_at=instance.pool_heartbeat_at)
+
+            vps = register_vps(instance)
+            wait_for_ssh(vps, getattr(settings, 'AWS_SSH_READY_TIMEOUT', 300))
+            if progress is not None:
+                progress.step('installing')
+            with ssh_pool.session(vps) as ssh:
+                details, failed, _ = provision_host(ssh, progress.log if progress is not None else None)
+            if failed:
+                raise Exception(f"Bootstrap of {instance.instance_id} failed running '{failed[0]['command']}'")
+            state_writer.call(VPS.objects.filter(pk=vps.pk).update, connected=True)
+
+            instance.bootstrapped = True
+            instance.pool_state = final_state
+            instance.assigned_at = now() if final_state == 'assigned' else None
+            state_writer.call(UserInstance.objects.filter(pk=instance.pk).update, bootstrapped=True,
+                              pool_state=final_state, assigned_at=instance.assigned_at)
+            return instance
+        except Exception:
+            logger.exception("warm pool: preparing %s failed, terminating it", instance.instance_id)
+            self._discard(instance)
+            raise
+        finally:
+            with self._lock:
+                self._preparing.discard(instance.pk)
+
+    def _discard(self, instance):
+        state_writer.call(UserInstance.objects.filter(pk=instance.pk).update,
+                          pool_state='failed', status='terminated', stopped_at=now())
+        if instance.ip_address:
+            # Only the row register_vps made: the IP may since belong to a VPS added by hand
+            state_writer.call(VPS.objects.filter(ip_address=instance.ip_address, name=vps_name(instance)).delete)
+            ssh_pool.invalidate(instance.ip_address)
+        try:
+            terminate_instances([instance.instance_id], client=self.client)
+        except Exception:
+            # Still marked failed; it shows up in the AWS console
+            logger.exception("warm pool: terminating %s failed", instance.instance_id)
+
+    def refill(self):
+        """
+        Launch and prepare instances until `size` are warm or being prepared (by
+        any process). Returns how many were launched.
+        """
+        stale = now() - timedelta(seconds=self.lease_seconds)
+        orphans = UserInstance.objects.filter(pool_state__in=PREPARING_STATES).filter(
+            Q(pool_heartbeat_at__lt=stale) | Q(pool_heartbeat_at__isnull=True))
+        for orphan in orphans:
+            logger.warning("warm pool: %s has had no heartbeat since %s, terminating it",
+                           orphan.instance_id, orphan.pool_heartbeat_at)
+            self._discard(orphan)
+        missing = self.size - UserInstance.objects.filter(
+            Q(pool_state='warm') | Q(pool_state__in=PREPARING_STATES, assigned_at__isnull=True)).count()
+        if missing <= 0:
+            return 0
+        instances = self._launch(missing)
+
+        def prepare(instance):
+            try:
+                self.prepare(instance)
+            except Exception:
+                pass  # logged and discarded by prepare; the next refill launches a replacement
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(max_workers=len(instances), thread_name_prefix='warm-pool') as pool:
+            list(pool.map(prepare, instances))
+        return len(instances)
+
+    def refill_in_background(self):
+        with self._lock:
+            if self._refilling or self.size <= 0:
+                return
+            self._refilling = True
+
+        def run():
+            try:
+                self.refill()
+            except Exception:
+                # e.g. AWS limits; retried on the next acquire
+                logger.exception("warm pool: refill failed")
+            finally:
+                with self._lock:
+                    self._refilling = False
+                close_old_connections()
+
+        threading.Thread(target=run, name='warm-pool-refill', daemon=True).start()
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_forever, name="warm-pool-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def _heartbeat_forever(self):
+        while True:
+            time.sleep(max(1, self.lease_seconds / 4))
+            self.beat()
+            close_old_connections()
+
+    def beat(self):
+        """Renew the lease on the instances this process is preparing."""
+        with self._lock:
+            preparing = list(self._preparing)
+        if not preparing:
+            return
+        try:
+            state_writer.call(UserInstance.objects.filter(pk__in=preparing, pool_state__in=PREPARING_STATES).update,
+                              pool_heartbeat_at=now())
+        except Exception:
+            logger.exception("warm pool: heartbeat failed")
+
+    def status(self):
+        counts = {state: 0 for state, _ in UserInstance.POOL_STATE_CHOICES}
+        for state in UserInstance.objects.values_list('pool_state', flat=True):
+            counts[state] = counts.get(state, 0) + 1
+        with self._lock:
+            refilling = self._refilling
+        return {'size': self.size, 'refilling': refilling, 'instances': counts}
+
+
+def vps_name(instance):
+    return f"ec2 {instance.instance_id}"
+
+
+def register_vps(instance):
+    """Store the launched instance as a VPS that ssh_pool can connect to with AWS_PEM_PATH."""
+    pem_path = getattr(settings, 'AWS_PEM_PATH', None)
+    if not pem_path:
+        raise Exception("AWS_PEM_PATH is not set, cannot SSH into launched instances")
+    with open(pem_path, 'rb') as f:
+        pem_content = f.read()
+    ssh_pool.invalidate(instance.ip_address)  # public IPs get reused
+    vps, _ = state_writer.call(
+        VPS.objects.update_or_create,
+        ip_address=instance.ip_address,
+        defaults={
+            'name': vps_name(instance),
+            'pem_file_name': os.path.basename(pem_path),
+            'pem_file_content': pem_content,
+            'connected': False,
+        },
+    )
+    return vps
+
+
+def wait_for_ssh(vps, timeout):
+    """sshd comes up a little after EC2 reports the instance as running."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with ssh_pool.session(vps):
+                return
+        except Exception as e:
+            if time.monotonic() > deadline:
+                raise Exception(f"SSH on {vps.ip_address} not reachable after {timeout}s: {e}")
+            time.sleep(SSH_RETRY_SECONDS)
+
+
+warm_pool = WarmPool.from_settings()
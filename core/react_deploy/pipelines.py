@@ -0,0 +1,94 @@
+import os
+
+from django_deploy.inventory import container_inventory
+from django_deploy.models import VPS
+from django_deploy.phases import PhaseTimer
+from django_deploy.pipelines import deploy_options, sync_project_source
+from django_deploy.remote import run_script
+from django_deploy.ssh_pool import ssh_pool
+from django_deploy.transfer import upload_files
+from django_deploy.utils import deployment_fingerprint, last_deployed_fingerprint
+from .releases import current_path, publish_release
+from .utils import generate_build_dockerfile, generate_build_docker_compose, generate_dockerignore, generate_static_nginx_conf, static_profile, build_and_export_dist, upload_and_enable_nginx_conf
+
+
+def deploy_react_project(progress, ip, repo_url, app_root, server_name, env_content=None, options=None):
+    options = options or deploy_options({})
+    profile = options.get('static_profile') or static_profile({})
+    project_name = os.path.basename(repo_url).replace('.git', '')
+    vps = VPS.objects.get(ip_address=ip)
+    timer = PhaseTimer()
+    record = dict(ip_address=ip, repo_url=repo_url, django_root=app_root, git_ref=options['git_ref'] or '')
+    progress.step('connecting')
+    try:
+        with timer.session(vps) as ssh:
+            with timer.phase('git_sync'):
+                commit_sha = sync_project_source(progress, ssh, repo_url, options)
+
+            # Generate build-only Dockerfile and docker-compose.yml
+            progress.step('uploading')
+            artifacts = {
+                "Dockerfile": generate_build_dockerfile(profile),
+                ".dockerignore": generate_dockerignore(),
+                "docker-compose.yml": generate_build_docker_compose(),
+            }
+            fingerprint = deployment_fingerprint(commit_sha, artifacts, env_content)
+            remote_path = f"/home/ubuntu/{project_name}/{app_root}"
+            with timer.phase('upload') as phase:
+                files = dict(artifacts, **({'.env': env_content} if env_content is not None else {}))
+                phase['bytes'] = upload_files(ssh, remote_path, files)['bytes']
+
+            # Build and export dist, unless the served build is already this one
+            remote_dist_path = f"/home/ubuntu/{project_name}/dist"
+            served_path = current_path(project_name)
+            build_skipped = (
+                not options['force']
+                and fingerprint == last_deployed_fingerprint(ip, repo_url, app_root)
+                and not run_script(ssh, [f"test -f {served_path}/index.html"])[1]
+            )
+            timings, release = {}, {}
+            if build_skipped:
+                progress.note("unchanged since the served build, skipping build")
+            else:
+                progress.step('building')
+                with timer.phase('build'):
+                    try:
+                        timings = build_and_export_dist(
+                            ssh, project_name, app_root, remote_dist_path, mode=options['build_mode'], sink=progress.log
+                        )
+                    finally:
+                        # create/compose builds start and remove containers on the host
+                        container_inventory.invalidate(ip)
+                progress.note(f"built in {timings['build_seconds']:.1f}s, extracted in {timings['extract_seconds']:.1f}s")
+                # dist is only the staging area, the release it becomes is what gets served
+                with timer.phase('release') as phase:
+                    release = publish_release(ssh, project_name, remote_dist_path, commit_sha, sink=progress.log)
+                    phase['bytes'] = release['bytes_copied']
+                progress.note(f"release {release['release']}: {release['copied']} new files, "
+                              f"{release['linked']} unchanged files linked")
+
+            # Generate and upload nginx config to serve static files
+            progress.step('configuring_nginx')
+            with timer.phase('nginx') as phase:
+                nginx_conf = generate_static_nginx_conf(server_name, static_root=served_path, profile=profile)
+                # A reload also drops open_file_cache entries that still point into the previous release
+                nginx = upload_and_enable_nginx_conf(
+                    ssh, nginx_conf, server_name, reload=bool(release) and bool(profile['open_file_cache_max'])
+                )
+                phase['bytes'] = len(nginx_conf.encode('utf-8')) if nginx['changed'] else 0
+    except Exception:
+        timer.record(status="failed", **record)
+        raise
+
+    progress.step('recording')
+    deployment = timer.record(
+        commit_sha=commit_sha,
+        fingerprint=fingerprint,
+        build_skipped=build_skipped,
+        status="deployed",
+        **record
+    )
+    message = 'Project unchanged, build skipped' if build_skipped else 'Project deployed'
+    return {'status': 'success', 'message': f'{message} at http://{server_name}', 'commit_sha': commit_sha,
+            'build_skipped': build_skipped, 'build': timings, 'release': release,
+            'nginx_reloaded': nginx['reloaded'], 'phases': timer.summary(), 'deployment_id': deployment.pk}
@@ -0,0 +1,143 @@
+# react_deploy/releases.py
+import json
+import shlex
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from django_deploy.remote import run_script
+
+# Runs on the host with python3 (installed by install-dependencies).
+# argv: staging dir, project dir, release id, commit sha, keep, max bytes
+_PUBLISH_SCRIPT = r'''
+import hashlib, json, os, shutil, sys
+
+staging, project_dir, release_id, commit_sha = sys.argv[1:5]
+keep, max_bytes = int(sys.argv[5]), int(sys.argv[6])
+releases = os.path.join(project_dir, 'releases')
+current = os.path.join(project_dir, 'current')
+os.makedirs(releases, exist_ok=True)
+# Never write into an existing release (clock skew, a rerun with the same id)
+base_id, n = release_id, 1
+while os.path.lexists(os.path.join(releases, release_id)):
+    release_id, n = f'{base_id}.{n}', n + 1
+target = os.path.join(releases, release_id)
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_path(release):
+    return os.path.join(releases, release + '.manifest.json')
+
+
+# Content hash -> file in the live release, to hard-link from
+previous = {}
+live = os.path.basename(os.path.realpath(current)) if os.path.islink(current) else None
+if live and os.path.exists(manifest_path(live)):
+    with open(manifest_path(live)) as f:
+        for rel, entry in json.load(f)['files'].items():
+            previous.setdefault(entry['sha256'], os.path.join(releases, live, rel))
+
+files = {}
+stats = {'linked': 0, 'copied': 0, 'bytes_linked': 0, 'bytes_copied': 0}
+for root, dirs, names in os.walk(staging):
+    for name in names:
+        src = os.path.join(root, name)
+        rel = os.path.relpath(src, staging)
+        dst = os.path.join(target, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.islink(src) or not os.path.isfile(src):
+            os.rename(src, dst)
+            continue
+        digest, size = sha256(src), os.path.getsize(src)
+        files[rel] = {'sha256': digest, 'size': size}
+        old = previous.get(digest)
+        try:
+            os.link(old, dst)
+            stats['linked'] += 1
+            stats['bytes_linked'] += size
+        except (TypeError, OSError):
+            # New content (or the old file vanished): take the freshly built file
+            os.rename(src, dst)
+            stats['copied'] += 1
+            stats['bytes_copied'] += size
+os.makedirs(target, exist_ok=True)
+with open(manifest_path(release_id), 'w') as f:
+    json.dump({'release': release_id, 'commit_sha': commit_sha, 'files': files}, f)
+shutil.rmtree(staging, ignore_errors=True)
+
+# Atomic switch: rename() over the old symlink, nginx never sees a missing root
+tmp_link = current + '.tmp'
+if os.path.lexists(tmp_link):
+    os.remove(tmp_link)
+os.symlink(os.path.join('releases', release_id), tmp_link)
+os.replace(tmp_link, current)
+
+# Retention: newest first; the new and the previously live release always stay
+# (rollback), older ones go once there are more than `keep` or they push the
+# total over max_bytes. Hard-linked files are counted once.
+protected = {release_id, live}
+ordered = sorted((d for d in os.listdir(releases) if os.path.isdir(os.path.join(releases, d))), reverse=True)
+seen, total, removed = set(), 0, []
+for i, release in enumerate(ordered):
+    size = 0
+    for root, dirs, names in os.walk(os.path.join(releases, release)):
+        for name in names:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+    if release not in protected and (i >= keep or total + size > max_bytes):
+        shutil.rmtree(os.path.join(releases, release))
+        if os.path.exists(manifest_path(release)):
+            os.remove(manifest_path(release))
+        removed.append(release)
+        continue
+    total += size
+
+stats.update({'release': release_id, 'files': len(files), 'removed': removed, 'releases_bytes': total})
+print(json.dumps(stats))
+'''
+
+
+def current_path(project_name):
+    """What nginx serves: a symlink to the live release."""
+    return f"/home/ubuntu/{project_name}/current"
+
+
+def release_id(commit_sha):
+    return f"{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}-{(commit_sha or 'unknown')[:12]}"
+
+
+def publish_release(ssh, project_name, staging_path, commit_sha, sink=None):
+    """
+    Turn the freshly built dist at staging_path into a new release under
+    /home/ubuntu/{project_name}/releases and point `current` at it.
+
+    Files whose content hash matches the live release are hard-linked to it
+    instead of stored again, the rest are moved in from staging. The symlink
+    swap is a single rename, so requests are served entirely from the old or
+    the new release. Old releases are pruned per REACT_RELEASES_KEEP and
+    REACT_RELEASES_MAX_MB.
+    Returns the summary printed by the remote script (release, files, linked, copied, ...).
+    """
+    args = [
+        staging_path,
+        f"/home/ubuntu/{project_name}",
+        release_id(commit_sha),
+        commit_sha or '',
+        str(getattr(settings, 'REACT_RELEASES_KEEP', 5)),
+        str(getattr(settings, 'REACT_RELEASES_MAX_MB', 500) * 1024 * 1024),
+    ]
+    cmd = f"sudo python3 - {' '.join(shlex.quote(a) for a in args)} <<'__DD_RELEASE__'\n{_PUBLISH_SCRIPT}\n__DD_RELEASE__"
+    details, failed = run_script(ssh, [cmd], sink)
+    if failed:
+        raise Exception(f"Publishing release failed: {failed[0]['stderr'].strip()}")
+    lines = details[0]['stdout'].strip().splitlines()
+    return json.loads(lines[-1])
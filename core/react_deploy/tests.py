@@ -1,3 +1,134 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import tempfile
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .releases import _PUBLISH_SCRIPT
+from .utils import generate_build_dockerfile, generate_static_nginx_conf, static_profile
+
+
+class PublishScriptTests(SimpleTestCase):
+    """Runs the release publish script locally against a temp dir, as publish_release runs it on a host."""
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory(prefix='devdeploy-releases-')
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        self.project = f"{self.root}/shop"
+
+    def publish(self, release_id, files, keep=5, max_bytes=10 ** 9):
+        staging = f"{self.root}/staging-{release_id}"
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(f"{staging}/{name}"), exist_ok=True)
+            with open(f"{staging}/{name}", 'w') as f:
+                f.write(content)
+        result = subprocess.run(
+            [sys.executable, '-', staging, self.project, release_id, 'a' * 40, str(keep), str(max_bytes)],
+            input=_PUBLISH_SCRIPT, capture_output=True, text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertFalse(os.path.exists(staging))
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def current(self):
+        return os.readlink(f"{self.project}/current")
+
+    def releases(self):
+        return sorted(d for d in os.listdir(f"{self.project}/releases") if not d.endswith('.manifest.json'))
+
+    def inode(self, release, name):
+        return os.stat(f"{self.project}/releases/{release}/{name}").st_ino
+
+    def test_unchanged_files_are_hard_linked_to_the_live_release(self):
+        first = self.publish('r1', {'index.html': '<html>', 'assets/app.js': 'v1'})
+        self.assertEqual((first['copied'], first['linked']), (2, 0))
+        second = self.publish('r2', {'index.html': '<html>', 'assets/app.js': 'v2'})
+        self.assertEqual((second['copied'], second['linked'], second['bytes_linked']), (1, 1, 6))
+        self.assertEqual(self.inode('r1', 'index.html'), self.inode('r2', 'index.html'))
+        self.assertNotEqual(self.inode('r1', 'assets/app.js'), self.inode('r2', 'assets/app.js'))
+        with open(f"{self.project}/current/assets/app.js") as f:
+            self.assertEqual(f.read(), 'v2')
+
+    def test_manifest_lists_every_file_with_its_hash(self):
+        self.publish('r1', {'index.html': '<html>', 'assets/app.js': 'v1'})
+        with open(f"{self.project}/releases/r1.manifest.json") as f:
+            manifest = json.load(f)
+        self.assertEqual((manifest['release'], manifest['commit_sha']), ('r1', 'a' * 40))
+        self.assertEqual(manifest['files']['assets/app.js'],
+                         {'sha256': '3bfc269594ef649228e9a74bab00f042efc91d5acc6fbee31a382e80d42388fe', 'size': 2})
+
+    def test_symlink_is_swapped_by_rename(self):
+        self.publish('r1', {'index.html': 'one'})
+        self.assertEqual(self.current(), 'releases/r1')
+        # A leftover from an interrupted swap is replaced, not followed
+        os.symlink('releases/r1', f"{self.project}/current.tmp")
+        self.publish('r2', {'index.html': 'two'})
+        self.assertEqual(self.current(), 'releases/r2')
+        self.assertFalse(os.path.lexists(f"{self.project}/current.tmp"))
+
+    def test_an_existing_release_id_is_never_reused(self):
+        self.publish('r1', {'index.html': 'one'})
+        self.assertEqual(self.publish('r1', {'index.html': 'two'})['release'], 'r1.1')
+        self.assertEqual(self.current(), 'releases/r1.1')
+        with open(f"{self.project}/releases/r1/index.html") as f:
+            self.assertEqual(f.read(), 'one')
+
+    def test_retention_keeps_the_newest_releases(self):
+        for release in ('r1', 'r2', 'r3'):
+            self.publish(release, {'index.html': release}, keep=2)
+        self.assertEqual(self.releases(), ['r2', 'r3'])
+        self.assertFalse(os.path.exists(f"{self.project}/releases/r1.manifest.json"))
+
+    def test_retention_never_removes_the_live_or_the_new_release(self):
+        for release in ('r1', 'r2', 'r3'):
+            self.publish(release, {'index.html': release})
+        # Rolled back by hand to the oldest release
+        os.remove(f"{self.project}/current")
+        os.symlink('releases/r1', f"{self.project}/current")
+        result = self.publish('r4', {'index.html': 'r4'}, keep=1, max_bytes=1)
+        self.assertEqual(sorted(result['removed']), ['r2', 'r3'])
+        self.assertEqual(self.releases(), ['r1', 'r4'])
+        self.assertEqual(self.current(), 'releases/r4')
+
+
+class BuildDockerfileTests(SimpleTestCase):
+    def test_precompress_threshold_follows_the_profile(self):
+        dockerfile = generate_build_dockerfile(static_profile({'static_profile': {'gzip_min_length': 256}}))
+        self.assertIn("if (data.length < 256) continue;", dockerfile)
+        self.assertIn("if (data.length < 1024) continue;", generate_build_dockerfile())
+
+    def test_precompress_can_be_turned_off(self):
+        dockerfile = generate_build_dockerfile(static_profile({'static_profile': {'precompress': False}}))
+        self.assertNotIn("zlib", dockerfile)
+        self.assertTrue(dockerfile.endswith("FROM scratch AS export\nCOPY --from=build /app/dist /\n"))
+
+
+class StaticNginxConfTests(SimpleTestCase):
+    def conf(self, **overrides):
+        return generate_static_nginx_conf('shop.example.com', '/home/ubuntu/shop/current',
+                                          static_profile({'static_profile': overrides}))
+
+    def test_hashed_assets_are_immutable_and_never_fall_back(self):
+        conf = self.conf()
+        self.assertIn("    location ~* ^/(assets|static)/ {\n"
+                      "        add_header Cache-Control \"public, max-age=31536000, immutable\";\n"
+                      "        try_files $uri =404;", conf)
+        self.assertIn("    location = /index.html {\n        add_header Cache-Control \"no-cache\";", conf)
+        self.assertIn("    location / {\n        try_files $uri /index.html;", conf)
+        self.assertIn("    root /home/ubuntu/shop/current;", conf)
+
+    def test_compression_and_file_cache_follow_the_profile(self):
+        conf = self.conf()
+        self.assertIn("    gzip_min_length 1024;", conf)
+        self.assertIn("    gzip_static on;", conf)
+        self.assertIn("    open_file_cache max=1000 inactive=60s;", conf)
+        self.assertNotIn("brotli_static", conf)
+
+        conf = self.conf(gzip_static=False, brotli_static=True, open_file_cache_max=0, asset_paths=[])
+        self.assertIn("    gzip_static off;", conf)
+        self.assertIn("    brotli_static on;", conf)
+        self.assertNotIn("open_file_cache", conf)
+        self.assertNotIn("immutable", conf)
@@ -1,21 +1,95 @@
-import time
+import json
 
+from django_deploy.nginx import NginxSites
+from django_deploy.transfer import make_dirs, upload_files
+from django_deploy.remote import run_script
+from django_deploy.utils import BUILDKIT_ENV, merge_profile
 
-def generate_dockerfile():
-    return '''
-FROM node:18 AS build
+
+NODE_BUILD_IMAGE = "node:18"
+NODE_RUNTIME_IMAGE = "node:18-slim"
+BUILD_MODES = ('export', 'create', 'compose')
+
+# Tunables for serving a built SPA straight from nginx, override per deploy with `static_profile`.
+# brotli_static needs the ngx_brotli module (libnginx-mod-http-brotli-static), so it is opt-in;
+# the .br files are produced either way when precompress is on.
+DEFAULT_STATIC_PROFILE = {
+    'precompress': True,
+    'gzip_static': True,
+    'brotli_static': False,
+    'gzip_comp_level': 5,
+    'gzip_min_length': 1024,
+    'sendfile': True,
+    'tcp_nopush': True,
+    'open_file_cache_max': 1000,  # 0 disables the descriptor cache
+    'open_file_cache_inactive': '60s',
+    'open_file_cache_valid': '30s',
+    'open_file_cache_min_uses': 2,
+    'asset_paths': ['assets', 'static'],  # Vite and CRA put content-hashed files here
+    'asset_max_age': 31536000,
+}
+
+COMPRESSIBLE_EXTENSIONS = ['.js', '.mjs', '.css', '.html', '.json', '.svg', '.txt', '.xml', '.map', '.wasm', '.ico']
+
+# Writes .gz and .br next to every compressible file in dist of at least min_length bytes
+# (the profile's gzip_min_length), keeping only the ones that are smaller.
+# zlib output carries no timestamp, so unchanged files compress to identical bytes between builds.
+def _precompress_step(min_length):
+    return f'''RUN node - <<'EOF'
+const fs = require('fs'), path = require('path'), zlib = require('zlib');
+const exts = new Set({json.dumps(COMPRESSIBLE_EXTENSIONS)});
+const walk = d => fs.readdirSync(d, {{withFileTypes: true}}).flatMap(e => e.isDirectory() ? walk(path.join(d, e.name)) : [path.join(d, e.name)]);
+for (const file of walk('dist')) {{
+  if (!exts.has(path.extname(file))) continue;
+  const data = fs.readFileSync(file);
+  if (data.length < {int(min_length)}) continue;
+  const gz = zlib.gzipSync(data, {{level: 9}});
+  if (gz.length < data.length) fs.writeFileSync(file + '.gz', gz);
+  const br = zlib.brotliCompressSync(data, {{params: {{[zlib.constants.BROTLI_PARAM_QUALITY]: 11}}}});
+  if (br.length < data.length) fs.writeFileSync(file + '.br', br);
+}}
+EOF
+'''
+
+
+# Dependency install only sees the manifests, so it stays cached across code-only edits.
+# npm ci when a lockfile exists (reproducible, faster), npm install otherwise.
+_NPM_DEPS_STAGE = f'''# syntax=docker/dockerfile:1
+FROM {NODE_BUILD_IMAGE} AS build
 WORKDIR /app
+COPY package.json package-lock.json* npm-shrinkwrap.json* ./
+RUN --mount=type=cache,target=/root/.npm \\
+    if [ -f package-lock.json ] || [ -f npm-shrinkwrap.json ]; then npm ci; else npm install; fi
 COPY . .
-RUN npm install && npm run build
+RUN npm run build
+'''
 
-FROM node:18 AS serve
+
+def generate_dockerfile():
+    return _NPM_DEPS_STAGE + f'''
+FROM {NODE_RUNTIME_IMAGE} AS serve
 WORKDIR /app
+RUN --mount=type=cache,target=/root/.npm npm install -g serve
 COPY --from=build /app/dist ./dist
-RUN npm install -g serve
 EXPOSE 3000
 CMD ["serve", "-s", "dist", "-l", "3000"]
 '''
 
+
+def generate_dockerignore():
+    # .env stays in the build context: Vite/CRA read it at build time
+    return "\n".join([
+        ".git",
+        ".dockerignore",
+        "Dockerfile",
+        "docker-compose.yml",
+        "node_modules",
+        "dist",
+        "build",
+        "npm-debug.log*",
+        "",
+    ])
+
 def generate_docker_compose(env_file: bool = True):
     compose = [
         "version: '3.8'",
@@ -52,21 +126,73 @@ server {{
 }}
 '''
 
-def generate_build_dockerfile():
-    return '''
-FROM node:18 AS build
-WORKDIR /app
-COPY . .
-RUN npm install && npm run build
+def generate_build_dockerfile(profile=None):
+    """Build-only Dockerfile; `profile` (see static_profile) decides whether and from what size dist is precompressed."""
+    p = {**DEFAULT_STATIC_PROFILE, **(profile or {})}
+    # `export` holds nothing but the built files, so BuildKit can write it straight to the host
+    return _NPM_DEPS_STAGE + (_precompress_step(p['gzip_min_length']) if p['precompress'] else '') + '''
+FROM scratch AS export
+COPY --from=build /app/dist /
 '''
 
-def generate_static_nginx_conf(server_name: str, static_root: str):
+def static_profile(data):
+    """DEFAULT_STATIC_PROFILE with the overrides from a request's `static_profile`."""
+    return merge_profile(DEFAULT_STATIC_PROFILE, data, 'static_profile')
+
+def generate_static_nginx_conf(server_name: str, static_root: str, profile=None):
+    """
+    Serve a built SPA from static_root.
+    Content-hashed assets are cached for good and never fall back to index.html
+    (a cached HTML page under an asset URL would stick for a year); index.html
+    is revalidated on every load so a new release is picked up immediately.
+    open_file_cache is flushed by the reload that follows each new release.
+    """
+    p = {**DEFAULT_STATIC_PROFILE, **(profile or {})}
+    on = lambda flag: 'on' if flag else 'off'
+    lines = [
+        f"    sendfile {on(p['sendfile'])};",
+        f"    tcp_nopush {on(p['tcp_nopush'])};",
+    ]
+    if p['open_file_cache_max']:
+        lines += [
+            f"    open_file_cache max={p['open_file_cache_max']} inactive={p['open_file_cache_inactive']};",
+            f"    open_file_cache_valid {p['open_file_cache_valid']};",
+            f"    open_file_cache_min_uses {p['open_file_cache_min_uses']};",
+            # Don't cache misses: a brand new asset must not 404 for open_file_cache_valid
+            "    open_file_cache_errors off;",
+        ]
+    lines += [
+        "    gzip on;",
+        "    gzip_vary on;",
+        "    gzip_proxied any;",
+        f"    gzip_comp_level {p['gzip_comp_level']};",
+        f"    gzip_min_length {p['gzip_min_length']};",
+        "    gzip_types text/plain text/css text/xml application/javascript application/json application/xml image/svg+xml application/wasm;",
+        f"    gzip_static {on(p['gzip_static'])};",
+    ]
+    if p['brotli_static']:
+        lines.append("    brotli_static on;")
+    performance = '\n'.join(lines)
+    asset_paths = '|'.join(p['asset_paths'])
+    assets = f'''
+    location ~* ^/({asset_paths})/ {{
+        add_header Cache-Control "public, max-age={p['asset_max_age']}, immutable";
+        try_files $uri =404;
+    }}
+''' if asset_paths else ''
     return f'''
 server {{
     listen 80;
     server_name {server_name};
     root {static_root};
     index index.html;
+
+{performance}
+{assets}
+    location = /index.html {{
+        add_header Cache-Control "no-cache";
+    }}
+
     location / {{
         try_files $uri /index.html;
     }}
@@ -85,83 +211,95 @@ def copy_dist_from_container(ssh, project_name, app_root, container_name, remote
     if exit_status != 0:
         raise Exception(f"Failed to copy dist from container: {stderr.read().decode()}")
 
-def upload_and_enable_nginx_conf(ssh, sftp, conf_content, server_name, ssl=False):
+def upload_and_enable_nginx_conf(ssh, conf_content, server_name, ssl=False, reload=False):
     """
-    Upload nginx config to /home/ubuntu/{server_name}, move to /etc/nginx/sites-available/{server_name} with sudo, symlink to sites-enabled, and reload nginx. Remove any old config/symlink first. Test config before reload. Optionally support SSL.
+    Install conf_content as the nginx site {server_name} and enable it, skipping
+    the write and reload when it is unchanged (see django_deploy.nginx.NginxSites).
     """
-    user_tmp_path = f"/home/ubuntu/{server_name}"
-    remote_conf_path = f"/etc/nginx/sites-available/{server_name}"
-    # Remove old config and symlink if they exist
-    cleanup_cmds = [
-        f"sudo rm -f {remote_conf_path}",
-        f"sudo rm -f /etc/nginx/sites-enabled/{server_name}"
-    ]
-    for cmd in cleanup_cmds:
-        ssh.exec_command(cmd)
-    # Upload to user-writable location
-    with sftp.file(user_tmp_path, 'w') as f:
-        f.write(conf_content)
-    # Move to nginx config dir and reload
-    commands = [
-        f"sudo mv {user_tmp_path} {remote_conf_path}",
-        f"sudo ln -sf {remote_conf_path} /etc/nginx/sites-enabled/{server_name}",
-        "sudo nginx -t",
-        "sudo systemctl reload nginx"
-    ]
-    for cmd in commands:
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            error = stderr.read().decode()
-            raise Exception(f"Failed to run '{cmd}': {error}")
+    return NginxSites(ssh).stage(server_name, conf_content).apply(reload=reload)
 
 def sftp_mkdirs_react(sftp, remote_directory):
-    dirs = remote_directory.strip('/').split('/')
-    path = ''
-    for d in dirs:
-        path += '/' + d
-        try:
-            sftp.stat(path)
-        except FileNotFoundError:
-            sftp.mkdir(path)
+    make_dirs(sftp, remote_directory)
 
 def sftp_write_files_react(sftp, remote_path, files_dict):
-    sftp_mkdirs_react(sftp, remote_path)
-    for filename, content in files_dict.items():
-        with sftp.file(f"{remote_path}/{filename}", 'w') as f:
-            f.write(content)
+    # The tar stream creates remote_path itself
+    return upload_files(sftp, remote_path, files_dict)
 
 def generate_build_docker_compose():
+    # Only used by the legacy 'compose' build mode; the export stage has no shell to keep running
     return '''
 version: '3.8'
 services:
   build:
-    build: .
+    build:
+      context: .
+      target: build
     container_name: react_build_container
     command: tail -f /dev/null
 '''
 
-def build_and_copy_dist_with_compose(ssh, project_name, app_root, remote_dist_path):
+def build_image_tag(project_name):
+    return f"devdeploy-{project_name.lower()}-build"
+
+def _swap_dist(staging_path, remote_dist_path):
+    # Replace the served dist in two renames so nginx never sees a half-copied tree
+    return (f"sudo rm -rf {remote_dist_path}.old && "
+            f"if [ -e {remote_dist_path} ]; then sudo mv {remote_dist_path} {remote_dist_path}.old; fi && "
+            f"sudo mv {staging_path} {remote_dist_path} && sudo rm -rf {remote_dist_path}.old")
+
+def build_and_export_dist(ssh, project_name, app_root, remote_dist_path, mode='export', sink=None):
+    """
+    Build the React app and put its dist folder at remote_dist_path.
+
+    export: BuildKit writes the `export` stage straight to the host (`--output type=local`).
+    create: build the image, `docker create` a container that is never started and `docker cp` out of it.
+    compose: the old throwaway compose service (kept for hosts without BuildKit).
+
+    Every step blocks on the command itself finishing, nothing sleeps or polls.
+    Returns {'mode', 'build_seconds', 'extract_seconds'}.
+    """
+    if mode not in BUILD_MODES:
+        raise Exception(f"Unknown build mode '{mode}', expected one of: {', '.join(BUILD_MODES)}")
+    if mode == 'compose':
+        return build_and_copy_dist_with_compose(ssh, project_name, app_root, remote_dist_path, sink)
+
+    build_dir = f"/home/ubuntu/{project_name}/{app_root}"
+    staging_path = f"{remote_dist_path}.new"
+    tag = build_image_tag(project_name)
+    # The image build runs first in both modes so the two timings stay comparable;
+    # in export mode the second build is all cache hits and only writes the files out
+    build = f"cd {build_dir} && sudo {BUILDKIT_ENV} docker build --target build -t {tag} ."
+    if mode == 'export':
+        extract = (f"sudo rm -rf {staging_path} && cd {build_dir} && "
+                   f"sudo {BUILDKIT_ENV} docker build --target export --output type=local,dest={staging_path} .")
+    else:
+        extract = (f"sudo rm -rf {staging_path} && cid=$(sudo docker create {tag}) && "
+                   f"sudo docker cp \"$cid:/app/dist\" {staging_path}; rc=$?; sudo docker rm \"$cid\" >/dev/null; exit $rc")
+    details, failed = run_script(ssh, [build, extract, _swap_dist(staging_path, remote_dist_path)], sink,
+                                 stop_on_error=True)
+    if failed:
+        raise Exception(f"React build failed running '{failed[0]['command']}': {failed[0]['stderr']}")
+    return {
+        'mode': mode,
+        'build_seconds': details[0]['duration_ms'] / 1000,
+        'extract_seconds': (details[1]['duration_ms'] + details[2]['duration_ms']) / 1000,
+    }
+
+def build_and_copy_dist_with_compose(ssh, project_name, app_root, remote_dist_path, sink=None):
     compose_dir = f"/home/ubuntu/{project_name}/{app_root}"
-    ssh.exec_command(f"rm -rf {remote_dist_path}")
-    build_cmd = f"cd {compose_dir} && sudo docker-compose up --build -d"
-    # Log output for debugging
-    stdin, stdout, stderr = ssh.exec_command(build_cmd)
-    build_out = stdout.read().decode()
-    build_err = stderr.read().decode()
-    # Wait for the container to be up
     container_name = "react_build_container"
-    for _ in range(10):
-        stdin, stdout, stderr = ssh.exec_command(f"sudo docker ps -a --format '{{{{.Names}}}}' | grep -w {container_name}")
-        if stdout.read().decode().strip() == container_name:
-            break
-        time.sleep(1)
-    else:
-        raise Exception(f"Build container {container_name} did not start.\nCompose output:\n{build_out}\n{build_err}")
-    copy_cmd = f"sudo docker cp {container_name}:/app/dist {remote_dist_path}"
-    stdin, stdout, stderr = ssh.exec_command(copy_cmd)
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        raise Exception(f"Failed to copy dist from build container: {stderr.read().decode()}\nCompose output:\n{build_out}\n{build_err}")
-    down_cmd = f"cd {compose_dir} && sudo docker-compose down"
-    ssh.exec_command(down_cmd)
\ No newline at end of file
+    # `up -d` returns once the container is created and started, no need to poll docker ps
+    build = f"cd {compose_dir} && sudo {BUILDKIT_ENV} docker-compose up --build -d"
+    extract = [
+        f"sudo rm -rf {remote_dist_path}",
+        f"sudo docker cp {container_name}:/app/dist {remote_dist_path}",
+    ]
+    details, failed = run_script(ssh, [build] + extract, sink, stop_on_error=True)
+    run_script(ssh, [f"cd {compose_dir} && sudo docker-compose down"], sink)
+    if failed:
+        raise Exception(f"React build failed running '{failed[0]['command']}': {failed[0]['stderr']}")
+    return {
+        'mode': 'compose',
+        'build_seconds': details[0]['duration_ms'] / 1000,
+        'extract_seconds': sum(d['duration_ms'] for d in details[1:]) / 1000,
+    }
@@ -1,9 +1,12 @@
 import { useParams, useNavigate } from 'react-router-dom';
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import { ArrowLeft, Trash2 } from 'lucide-react';
 
 const API_BASE = 'http://127.0.0.1:8000/api/django';
+const JOB_POLL_MS = 2000;
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
 
 const DeployProject = () => {
   const { vpsId } = useParams();
@@ -19,6 +22,7 @@ const DeployProject = () => {
   const [status, setStatus] = useState('');
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
+  const mounted = useRef(true);
 
   // Docker containers state
   const [containers, setContainers] = useState([]);
@@ -26,6 +30,8 @@ const DeployProject = () => {
   const [deleteStatus, setDeleteStatus] = useState({});
   const [containersError, setContainersError] = useState('');
 
+  useEffect(() => () => { mounted.current = false; }, []);
+
   useEffect(() => {
     axios.get(`${API_BASE}/connect-vps/`).then(res => {
       const found = (res.data.vps || []).find(v => String(v.id) === String(vpsId));
@@ -37,6 +43,19 @@ const DeployProject = () => {
 
   const handleChange = e => setForm({ ...form, [e.target.name]: e.target.value });
 
+  // Deploys run as background jobs: poll the job until it has finished
+  const waitForJob = async (jobId) => {
+    while (mounted.current) {
+      await sleep(JOB_POLL_MS);
+      const res = await axios.get(`${API_BASE}/jobs/${jobId}/`);
+      if (res.data.status !== 'success') throw new Error(res.data.message || 'Deployment job not found');
+      const job = res.data.job;
+      if (job.status === 'succeeded' || job.status === 'failed') return job;
+      setStatus(job.status === 'queued' ? 'Deployment queued...' : `Deploying (${job.step})...`);
+    }
+    return null;
+  };
+
   const handleSubmit = async e => {
     e.preventDefault();
     setLoading(true);
@@ -53,13 +72,22 @@ const DeployProject = () => {
       const res = await axios.post(`${API_BASE}/deploy-project/`, formData, {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
-      setStatus(res.data.message || 'Deployment started!');
-      // Optionally refresh containers after deploy
-      fetchContainers(vps.ip_address);
+      if (res.data.status !== 'queued') throw new Error(res.data.message || 'Deployment failed');
+      setStatus(res.data.message || 'Deployment queued...');
+      const job = await waitForJob(res.data.job_id);
+      if (!job) return;
+      if (job.status === 'succeeded') {
+        setStatus(job.message || 'Deployment finished!');
+        fetchContainers(vps.ip_address);
+      } else {
+        setStatus('');
+        setError(job.message || 'Deployment failed');
+      }
     } catch (err) {
-      setError(err.response?.data?.message || 'Deployment failed');
+      setStatus('');
+      setError(err.response?.data?.message || err.message || 'Deployment failed');
     }
-    setLoading(false);
+    if (mounted.current) setLoading(false);
   };
 
   // Docker containers logic